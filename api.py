@@ -0,0 +1,403 @@
+import argparse
+import datetime
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pandas as pd
+
+import database as db
+import depletion_engine as engine
+import instrumentation
+import prediction_model as ml
+import results_store
+
+
+# Read-only JSON API over the depletion engine, for the ordering and ERP systems:
+#   GET /customers                                                  active customers
+#   GET /customers/<id>/depletion                                   counts, depletion rate and label counts per item type
+#   GET /customers/<id>/par-forecast[?item_type=]                   par level per item type and month
+#   GET /customers/<id>/items[?label=&item_type=&offset=&limit=]    labels and ragout predictions per RFID
+#   GET /customers/<id>/items/<rfid_id>
+# Customer endpoints take months_back / months_forward. Every response has an ETag, and a matching If-None-Match
+# gets a 304 without a body. Depletion results and response bodies are kept in LRU caches.
+# The server binds to localhost; another interface needs LAUNDRIS_API_TOKEN, which every request but /health then
+# sends as "Authorization: Bearer <token>".
+#   python api.py --port 8600
+#   LAUNDRIS_API_TOKEN=... python api.py --host 0.0.0.0 --port 8600
+
+logger = logging.getLogger("api")
+
+api_port = int(os.environ["LAUNDRIS_API_PORT"]) if os.environ.get("LAUNDRIS_API_PORT") else None
+api_host = os.environ.get("LAUNDRIS_API_HOST", "127.0.0.1")
+api_token = os.environ.get("LAUNDRIS_API_TOKEN") or None
+# Seconds before a customer's frames are re-read; an unchanged data version keeps the result and its ETags
+result_ttl = float(os.environ.get("LAUNDRIS_API_RESULT_TTL", "300"))
+max_cached_results = int(os.environ.get("LAUNDRIS_API_CACHE_RESULTS", "32"))
+max_cached_responses = int(os.environ.get("LAUNDRIS_API_CACHE_RESPONSES", "1024"))
+
+default_page_size = 100
+max_page_size = 1000
+max_months = 24
+labels = ['lost', 'ragout', 'normal', 'active']
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class CustomerResult:
+    # A DepletionResult, its data version (engine.data_version, and a short hash of it for responses) and the
+    # per-item table the item endpoints read
+    def __init__(self, result, version):
+        self.result = result
+        self.version = version
+        self.version_tag = hashlib.blake2b(repr(version).encode(), digest_size=8).hexdigest()
+        self.expires = time.monotonic() + result_ttl
+        self.items = results_store.item_table(result)
+        self.rfid_index = pd.Index(self.items['rfid_id'].astype(str))
+
+
+results = LRUCache(max_cached_results)
+responses = LRUCache(max_cached_responses)
+request_stats = {"requests": 0, "not_modified": 0, "client_errors": 0, "server_errors": 0, "unauthorized": 0, "computed": 0}
+_stats_lock = threading.Lock()
+
+# Concurrent requests for the same customer wait for one computation instead of each running it
+_compute_locks = [threading.Lock() for _ in range(64)]
+
+
+def count(name):
+    with _stats_lock:
+        request_stats[name] += 1
+
+
+def api_metrics():
+    lines = instrumentation.stats_lines("laundris_api_requests", "API request counters", request_stats)
+    for name, cache in (("results", results), ("responses", responses)):
+        with cache.lock:
+            stats = dict(cache.stats, entries=len(cache.entries))
+        lines += instrumentation.stats_lines(f"laundris_api_{name}_cache", f"API {name} cache counters", stats)
+    return lines
+
+
+instrumentation.collectors.append(api_metrics)
+
+
+def customer_result(customer_id, months_back, months_forward):
+    today = datetime.date.today()
+    key = (customer_id, today, months_back, months_forward)
+    entry = results.get(key)
+    if entry is not None and entry.expires > time.monotonic():
+        return entry
+
+    with _compute_locks[hash(key) % len(_compute_locks)]:
+        entry = results.get(key)
+        if entry is not None and entry.expires > time.monotonic():
+            return entry
+
+        with instrumentation.trace("api_customer", customer_id=customer_id):
+            _, order_cycle_df, inactive_status_df = db.fetch_frames(customer_id)
+            desired_quantity_df = db.get_desired_quantity(list(order_cycle_df.item_type_id.unique()), customer_id)
+            with instrumentation.span("engine.data_version", rows_in=order_cycle_df.shape[0]):
+                version = engine.data_version(order_cycle_df, inactive_status_df, desired_quantity_df)
+
+            if entry is not None and entry.version == version:
+                entry.expires = time.monotonic() + result_ttl
+                return entry
+
+            result = engine.get_engine().run(customer_id, order_cycle_df, inactive_status_df, desired_quantity_df,
+                                             today, version, months_back, months_forward)
+            entry = CustomerResult(result, version)
+        count("computed")
+        results.put(key, entry)
+        return entry
+
+
+def json_body(fields, frames=None):
+    # fields go through json.dumps; frames (name -> DataFrame) are written as records by DataFrame.to_json and spliced in
+    parts = [json.dumps(fields, default=str)[:-1]]
+    for name, df in (frames or {}).items():
+        parts.append(f', {json.dumps(name)}: {df.to_json(orient="records", date_format="iso")}')
+    return ("".join(parts) + "}").encode()
+
+
+def int_param(params, name, default, low, high):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ApiError(400, f"{name} must be an integer")
+    if not low <= value <= high:
+        raise ApiError(400, f"{name} must be between {low} and {high}")
+    return value
+
+
+def customers_body(params):
+    names, ids = db.fetch_inventory_list()
+    return json_body({"customers": [{"customer_id": customer_id, "customer_name": name} for customer_id, name in zip(ids, names)]})
+
+
+def header(entry):
+    return {"customer_id": entry.result.customer_id, "date": entry.result.today.isoformat(), "data_version": entry.version_tag}
+
+
+def depletion_body(entry, params):
+    result = entry.result
+    by_item_type = result.label_heatmap.astype(int).rename(columns=str.lower).rename_axis('item_type_name').reset_index()
+    fields = dict(header(entry),
+                  total_items=result.total_items,
+                  active=result.active_items.shape[0],
+                  inactive=result.n_inactive,
+                  inactive_rate=result.p_inactive / 100 if result.total_items else None,
+                  lost=result.n_lost,
+                  ragout=result.n_ragout,
+                  normal=result.n_normal,
+                  depletion_rate=result.p_depletion if result.total_items else None,
+                  months=result.interval_names)
+    return json_body(fields, {"by_item_type": by_item_type})
+
+
+def par_forecast_body(entry, params):
+    par_df = results_store.par_level_table(entry.result)
+    if params.get('item_type'):
+        par_df = par_df[par_df['item_type_name'] == params['item_type']]
+    return json_body(dict(header(entry), months=entry.result.interval_names), {"par_forecast": par_df})
+
+
+def items_body(entry, params):
+    items_df = entry.items
+    if params.get('label'):
+        if params['label'] not in labels:
+            raise ApiError(400, f"label must be one of {', '.join(labels)}")
+        items_df = items_df[items_df['label'] == params['label']]
+    if params.get('item_type'):
+        items_df = items_df[items_df['item_type_name'] == params['item_type']]
+    offset = int_param(params, 'offset', 0, 0, sys.maxsize)
+    limit = int_param(params, 'limit', default_page_size, 1, max_page_size)
+    return json_body(dict(header(entry), total=items_df.shape[0], offset=offset, limit=limit),
+                     {"items": items_df.iloc[offset:offset + limit]})
+
+
+def item_body(entry, params, rfid_id):
+    try:
+        position = entry.rfid_index.get_loc(rfid_id)
+    except KeyError:
+        raise ApiError(404, f"rfid {rfid_id} not found for customer {entry.result.customer_id}")
+    item = entry.items.iloc[[position]].to_json(orient="records", date_format="iso")
+    return json_body(dict(header(entry), item=json.loads(item)[0]))
+
+
+routes = [
+    (re.compile(r"/customers/(\d+)/depletion"), depletion_body),
+    (re.compile(r"/customers/(\d+)/par-forecast"), par_forecast_body),
+    (re.compile(r"/customers/(\d+)/items"), items_body),
+    (re.compile(r"/customers/(\d+)/items/([^/]+)"), item_body),
+]
+
+
+def handle(path, params, if_none_match=None):
+    # (status, etag, body) of a GET
+    if path == "/health":
+        return 200, None, json_body({"status": "ok"})
+
+    if path == "/customers":
+        key, version, build = (path,), None, lambda: customers_body(params)
+    else:
+        for pattern, endpoint in routes:
+            match = pattern.fullmatch(path)
+            if match:
+                break
+        else:
+            raise ApiError(404, f"no endpoint {path}")
+
+        customer_id = int(match.group(1))
+        if customer_id not in db.fetch_inventory_list()[1]:
+            raise ApiError(404, f"unknown customer {customer_id}")
+        months_back = int_param(params, 'months_back', engine.default_months_back, 0, max_months)
+        months_forward = int_param(params, 'months_forward', engine.default_months_forward, 0, max_months)
+        entry = customer_result(customer_id, months_back, months_forward)
+        args = [unquote(group) for group in match.groups()[1:]]
+        key, version, build = (path, months_back, months_forward), entry.version_tag, lambda: endpoint(entry, params, *args)
+
+    # Bodies are cached per request and data version; the ETag is a hash of the body
+    key = key + (tuple(sorted(params.items())), version, datetime.date.today())
+    cached = responses.get(key)
+    if cached is None:
+        body = build()
+        cached = ('"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"', body)
+        responses.put(key, cached)
+    etag, body = cached
+
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return 304, etag, b""
+    return 200, etag, body
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def check_bind(host, token):
+    # The API serves customer data without a login of its own, so only localhost is served without a token
+    if not is_loopback(host) and not token:
+        raise ValueError(f"serving the API on {host or 'every interface'} needs LAUNDRIS_API_TOKEN")
+
+
+def authorized(authorization, token):
+    if token is None:
+        return True
+    scheme, _, credentials = (authorization or "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle's algorithm on a keep-alive connection the body would
+    # wait for the client's delayed ACK (about 40 ms) on every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        count("requests")
+        url = urlsplit(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path != "/health" and not authorized(self.headers.get("Authorization"), getattr(self.server, "token", None)):
+                count("unauthorized")
+                raise ApiError(401, "missing or wrong bearer token")
+            status, etag, body = handle(url.path.rstrip("/") or "/", params, self.headers.get("If-None-Match"))
+        except ApiError as e:
+            status, etag, body = e.status, None, json_body({"error": str(e)})
+        except Exception as e:
+            logger.exception("GET %s failed", self.path)
+            status, etag, body = 500, None, json_body({"error": repr(e)})
+
+        if status == 304:
+            count("not_modified")
+        elif status >= 500:
+            count("server_errors")
+        elif status >= 400:
+            count("client_errors")
+
+        self.send_response(status)
+        if status == 401:
+            self.send_header("WWW-Authenticate", 'Bearer realm="laundris"')
+        if etag:
+            self.send_header("ETag", etag)
+            # Clients may keep a response but revalidate it on every use, which costs a 304
+            self.send_header("Cache-Control", "no-cache")
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def make_server(host, port, token):
+    check_bind(host, token)
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    server.token = token
+    return server
+
+
+def start_server(port=None, host=None, token=None):
+    # Serves the API from a daemon thread, next to the dashboard; one server per process, started on the first call
+    global _server
+    port = api_port if port is None else port
+    host = api_host if host is None else host
+    token = api_token if token is None else token
+    if port is None:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = make_server(host, port, token)
+            except (OSError, ValueError) as e:
+                logger.warning("API server not started on %s:%s: %r", host, port, e)
+                return None
+            threading.Thread(target=_server.serve_forever, name="laundris-api", daemon=True).start()
+    return _server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="JSON API for depletion summaries, par-level forecasts and RFID predictions")
+    parser.add_argument("--host", default=api_host, help="interface to bind (default: localhost); any other needs LAUNDRIS_API_TOKEN")
+    parser.add_argument("--port", type=int, default=api_port or 8600)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    try:
+        server = make_server(args.host, args.port, api_token)
+    except ValueError as e:
+        logger.error("%s", e)
+        return 2
+    ml.get_registry()  # load and validate the model artifacts before the first request
+    instrumentation.start_metrics_server()
+    logger.info("serving on %s:%s%s", *server.server_address[:2], " (bearer token required)" if api_token else "")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+# Concurrent clients against the JSON API (api.py), reporting latency percentiles per endpoint:
+#   python api_load_test.py --customers 45 52 --clients 16 --requests 5000          starts the API in this process
+#   python api_load_test.py --url http://localhost:8600 --clients 32 --duration 30  against a running server
+# Every endpoint is first requested once per customer (the cold requests, which compute the results); the clients
+# then pick endpoints at random and send If-None-Match with the last ETag they saw for a fraction of the requests.
+# With LAUNDRIS_API_TOKEN set, every request carries it as a bearer token.
+
+api_token = os.environ.get("LAUNDRIS_API_TOKEN") or None
+
+endpoints = ["depletion", "par-forecast", "items", "item"]
+
+
+class Client:
+    # One keep-alive connection, like an ERP poller
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.conn = None
+
+    def get(self, path, etag=None):
+        headers = {"If-None-Match": etag} if etag else {}
+        if api_token:
+            headers["Authorization"] = f"Bearer {api_token}"
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+            try:
+                start = time.perf_counter()
+                self.conn.request("GET", path, headers=headers)
+                response = self.conn.getresponse()
+                body = response.read()
+                return response.status, response.getheader("ETag"), body, time.perf_counter() - start
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle connection; retry once on a new one
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def endpoint_path(customer_id, endpoint, rfids, rng=random):
+    if endpoint == "item":
+        return f"/customers/{customer_id}/items/{rng.choice(rfids[customer_id])}"
+    if endpoint == "items":
+        return f"/customers/{customer_id}/items?label={rng.choice(['lost', 'ragout', 'normal', 'active'])}&limit=100"
+    return f"/customers/{customer_id}/{endpoint}"
+
+
+def percentiles(latencies):
+    values = np.array(latencies) * 1000
+    return {"count": int(values.size), "p50_ms": float(np.percentile(values, 50)), "p90_ms": float(np.percentile(values, 90)),
+            "p99_ms": float(np.percentile(values, 99)), "max_ms": float(values.max())}
+
+
+def run(host, port, customer_ids, clients, n_requests=None, duration=None, conditional=0.5, seed=0):
+    # Cold requests, one per customer and endpoint, sequentially; they also collect rfids for the item endpoint
+    client = Client(host, port)
+    cold = []
+    rfids = {}
+    for customer_id in customer_ids:
+        status, _, body, seconds = client.get(f"/customers/{customer_id}/items?limit=1000")
+        if status != 200:
+            raise RuntimeError(f"customer {customer_id}: HTTP {status} {body[:200]!r}")
+        cold.append(seconds)
+        rfids[customer_id] = [item["rfid_id"] for item in json.loads(body)["items"]] or ["none"]
+        for endpoint in ("depletion", "par-forecast"):
+            cold.append(client.get(endpoint_path(customer_id, endpoint, rfids))[3])
+    client.close()
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(int)
+    lock = threading.Lock()
+    remaining = [n_requests]
+    deadline = time.perf_counter() + duration if duration else None
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        client = Client(host, port)
+        etags = {}
+        try:
+            while True:
+                with lock:
+                    if remaining[0] is not None:
+                        if remaining[0] <= 0:
+                            return
+                        remaining[0] -= 1
+                if deadline and time.perf_counter() > deadline:
+                    return
+                customer_id, endpoint = rng.choice(customer_ids), rng.choice(endpoints)
+                path = endpoint_path(customer_id, endpoint, rfids, rng)
+                etag = etags.get(path) if rng.random() < conditional else None
+                status, response_etag, _, seconds = client.get(path, etag)
+                if response_etag:
+                    etags[path] = response_etag
+                with lock:
+                    latencies[endpoint].append(seconds)
+                    statuses[status] += 1
+        finally:
+            client.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    all_latencies = [seconds for values in latencies.values() for seconds in values]
+    return {
+        "clients": clients,
+        "customers": len(customer_ids),
+        "elapsed": elapsed,
+        "requests_per_second": len(all_latencies) / elapsed if elapsed > 0 else None,
+        "statuses": dict(statuses),
+        "cold": percentiles(cold),
+        "all": percentiles(all_latencies) if all_latencies else None,
+        "endpoints": {endpoint: percentiles(values) for endpoint, values in sorted(latencies.items())},
+    }
+
+
+def print_report(report):
+    print(f"{report['clients']} clients, {report['customers']} customers: {sum(report['statuses'].values()):,} requests in "
+          f"{report['elapsed']:.1f}s ({report['requests_per_second']:.0f}/s), statuses {report['statuses']}")
+    print(f"  {'':<14} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = [("cold", report["cold"]), ("all", report["all"])] + list(report["endpoints"].items())
+    for name, stats in rows:
+        if stats:
+            print(f"  {name:<14} {stats['count']:>7,} {stats['p50_ms']:>9.1f} {stats['p90_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the JSON API with concurrent keep-alive clients")
+    parser.add_argument("--url", help="base URL of a running API (default: start one in this process on a free port)")
+    parser.add_argument("--customers", type=int, nargs="+", help="customer ids to request (default: every customer of /customers)")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000, help="requests in total, after the cold ones")
+    parser.add_argument("--duration", type=float, help="run for this many seconds instead of a number of requests")
+    parser.add_argument("--conditional", type=float, default=0.5, help="fraction of requests sent with If-None-Match")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--p99-budget-ms", type=float, help="exit 1 when the p99 latency of the warm requests is higher")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        import api
+
+        server = api.start_server(port=0, host="127.0.0.1")
+        host, port = server.server_address
+
+    customer_ids = args.customers
+    if not customer_ids:
+        client = Client(host, port)
+        customer_ids = [customer["customer_id"] for customer in json.loads(client.get("/customers")[2])["customers"]]
+        client.close()
+
+    report = run(host, port, customer_ids, args.clients, None if args.duration else args.requests, args.duration,
+                 args.conditional, args.seed)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = report["statuses"].get(500, 0) > 0
+    if args.p99_budget_ms and report["all"] and report["all"]["p99_ms"] > args.p99_budget_ms:
+        print(f"p99 {report['all']['p99_ms']:.1f} ms is over the budget of {args.p99_budget_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
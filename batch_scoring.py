@@ -0,0 +1,157 @@
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import database as db
+import depletion_engine as engine
+import disk_cache
+import history_store
+import instrumentation
+import lifetime_store
+import prediction_model as ml
+import results_store
+
+
+# Scores every active customer ahead of time and writes the results to results_store:
+#   python batch_scoring.py --workers 4 --db-connections 8
+#   python batch_scoring.py --customers 45 52
+
+logger = logging.getLogger("batch_scoring")
+
+
+def init_worker(pool_size):
+    # Runs in each (spawned) worker before database is used, so its connection pool is created with this size
+    os.environ["LAUNDRIS_DB_POOL_MIN"] = "1"
+    os.environ["LAUNDRIS_DB_POOL_MAX"] = str(pool_size)
+    logging.basicConfig(level=logging.WARNING)
+    ml.get_registry()
+
+
+def score_customer(customer_id, run_date, months_back=None, months_forward=None, warm_cache=True):
+    # One trace (and JSON log line) per customer, like a dashboard rerun
+    with instrumentation.trace("batch_customer", customer_id=customer_id, run_date=run_date.isoformat()):
+        return score_customer_traced(customer_id, run_date, months_back, months_forward, warm_cache)
+
+
+def score_customer_traced(customer_id, run_date, months_back=None, months_forward=None, warm_cache=True):
+    timings = {}
+    start = time.perf_counter()
+    frames = db.load_customer_frames(customer_id)
+    timings["fetch_time"] = time.perf_counter() - start
+
+    # The dashboard's first view of the day then skips the database reads as well
+    if warm_cache and run_date == datetime.date.today():
+        disk_cache.store_frames(disk_cache.fetch_data_key(customer_id, run_date, source=db.backend_name), db.cached_frames(frames))
+
+    _, order_cycle_df, inactive_status_df = frames
+    start = time.perf_counter()
+    desired_quantity_df = db.get_desired_quantity(list(order_cycle_df.item_type_id.unique()), customer_id)
+    with instrumentation.span("engine.compute_depletion", rows_in=order_cycle_df.shape[0]):
+        result = engine.compute_depletion(customer_id, order_cycle_df, inactive_status_df, desired_quantity_df, run_date, months_back, months_forward)
+    timings["score_time"] = time.perf_counter() - start
+
+    meta = dict(timings,
+                items=result.total_items,
+                lost=result.n_lost,
+                ragout=result.n_ragout,
+                normal=result.n_normal,
+                months_back=engine.default_months_back if months_back is None else months_back,
+                months_forward=engine.default_months_forward if months_forward is None else months_forward,
+                data_version=engine.data_version(order_cycle_df, inactive_status_df, desired_quantity_df),
+                months=result.interval_names)
+    results_store.store_results(customer_id, result, meta, run_date)
+    # A run for an earlier date still sees today's data, so only today's run is a snapshot of the day
+    if run_date == datetime.date.today():
+        history_store.record_snapshot(customer_id, result)
+    return meta
+
+
+def pool_layout(workers, db_connections, n_customers):
+    # Each worker process gets its own pool; together they never hold more than db_connections connections, so
+    # there are never more workers than connections
+    if workers < 1 or db_connections < 1:
+        raise ValueError(f"need at least one worker and one connection (workers={workers}, db_connections={db_connections})")
+    workers = min(workers, db_connections, max(n_customers, 1))
+    return workers, db_connections // workers
+
+
+def map_customers(task, customer_ids, workers, pool_size, *args):
+    # Runs task(customer_id, *args) in `workers` spawned processes with `pool_size` connections each; yields
+    # (customer_id, result, error) in completion order. task must be a module-level function.
+    context = multiprocessing.get_context("spawn")
+    # The workers' pools use the whole connection budget, so this process gives back the connections it holds
+    db.close_pool()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(pool_size,)) as executor:
+        futures = {executor.submit(task, customer_id, *args): customer_id for customer_id in customer_ids}
+        for future in as_completed(futures):
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, e
+            yield futures[future], result, error
+
+
+def run(customer_ids, workers, db_connections, run_date, months_back=None, months_forward=None, warm_cache=True):
+    workers, pool_size = pool_layout(workers, db_connections, len(customer_ids))
+
+    summary = {"run_date": run_date.isoformat(), "workers": workers, "pool_size": pool_size, "customers": {}, "failed": {}}
+    start = time.perf_counter()
+    for customer_id, meta, error in map_customers(score_customer, customer_ids, workers, pool_size,
+                                                  run_date, months_back, months_forward, warm_cache):
+        if error is not None:
+            summary["failed"][customer_id] = repr(error)
+            logger.error("customer %s failed: %r", customer_id, error)
+            continue
+        summary["customers"][customer_id] = meta
+        logger.info("customer %s: %d items, fetch %.1fs, score %.1fs",
+                    customer_id, meta["items"], meta["fetch_time"], meta["score_time"])
+
+    elapsed = time.perf_counter() - start
+    summary["elapsed"] = elapsed
+    summary["customers_per_minute"] = len(summary["customers"]) / elapsed * 60 if elapsed > 0 else None
+    summary["items_per_second"] = sum(meta["items"] for meta in summary["customers"].values()) / elapsed if elapsed > 0 else None
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score every active customer and store the results for the dashboard")
+    parser.add_argument("--customers", type=int, nargs="+", help="customer ids to score (default: every customer of fetch_inventory_list)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="scoring processes")
+    parser.add_argument("--db-connections", type=int, default=None, help="database connections shared by all workers (default: one per worker)")
+    parser.add_argument("--date", type=datetime.date.fromisoformat, default=datetime.date.today(), help="reference date, YYYY-MM-DD")
+    parser.add_argument("--months-back", type=int)
+    parser.add_argument("--months-forward", type=int)
+    parser.add_argument("--no-warm-cache", action="store_true", help="do not write the fetched frames to the fetch_data disk cache")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    customer_ids = args.customers or db.fetch_inventory_list()[1]
+    db_connections = args.db_connections or args.workers
+
+    # The day's new ragout events go into the lifetime statistics the dashboard reads
+    lifetime_store.get_store().refresh(force=True)
+    summary = run(customer_ids, args.workers, db_connections, args.date, args.months_back, args.months_forward,
+                  warm_cache=not args.no_warm_cache and disk_cache.enabled())
+
+    os.makedirs(os.path.join(results_store.results_dir, args.date.isoformat()), exist_ok=True)
+    with open(os.path.join(results_store.results_dir, args.date.isoformat(), "run.json"), "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+
+    logger.info("scored %d customers (%d failed) in %.1fs: %.1f customers/min, %.0f items/s",
+                len(summary["customers"]), len(summary["failed"]), summary["elapsed"],
+                summary["customers_per_minute"] or 0, summary["items_per_second"] or 0)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tempfile
+import tracemalloc
+import warnings
+
+import pandas as pd
+
+import database as db
+import depletion_engine as engine
+import embedded_backend
+import portfolio
+import prediction_model as ml
+import synthetic_data
+
+
+# Times the depletion pipeline on synthetic data, stage by stage:
+#   python benchmark.py --tags 10000 100000 1000000            compare against benchmarks/baseline.json
+#   python benchmark.py --tags 10000 100000 --save-baseline    record a new baseline
+#   python benchmark.py --dsn "dbname=laundris_bench"          also load the data into a local Postgres and time the reads
+#   python benchmark.py --tags 1000000 --customers 200 --portfolio-budget 600   fail when the fleet portfolio takes longer
+
+default_baseline_path = os.path.join("benchmarks", "baseline.json")
+
+embedded_engines = ["sqlite"] + (["duckdb"] if embedded_backend.available_engine() == "duckdb" else [])
+
+
+def measure(stage, repeat):
+    # Best wall time of `repeat` untraced runs, then one run under tracemalloc for the peak
+    # (numpy and pandas buffers are traced too, so the peak covers the frames a stage builds)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = stage()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, {"wall_time": min(times), "peak_bytes": peak_bytes}
+
+
+def run_main(tables, customer_id, frames):
+    # Renders the dashboard headless for one customer, with the database readers answered from the synthetic tables
+    import main
+
+    names, ids = synthetic_data.inventory_list(tables)
+    customer_name = names[ids.index(customer_id)]
+
+    # The customer select box defaults to the first entry, so only offer the benchmarked customer
+    readers = {
+        "fetch_inventory_list": lambda: ([customer_name], [customer_id]),
+        "fetch_data": lambda selected_id: tuple(frame if frame is None else frame.copy() for frame in frames),
+        "fetch_item_type_names": lambda: synthetic_data.item_type_names(tables),
+        "get_desired_quantity": lambda item_type_ids, selected_id: synthetic_data.desired_quantity(tables, item_type_ids, selected_id),
+    }
+    originals = {name: getattr(db, name) for name in readers}
+    try:
+        for name, reader in readers.items():
+            setattr(db, name, reader)
+        # Outside `streamlit run` every element logs a bare-mode warning
+        logging.disable(logging.WARNING)
+        main.main()
+    finally:
+        logging.disable(logging.NOTSET)
+        for name, reader in originals.items():
+            setattr(db, name, reader)
+
+
+def run_portfolio(tables, snapshot_path, engine_name, workers):
+    # Every customer through the portfolio worker pool; the spawned workers read the snapshot named in the environment
+    names, ids = synthetic_data.inventory_list(tables)
+    env = {"LAUNDRIS_BACKEND": engine_name, "LAUNDRIS_SNAPSHOT_DIR": snapshot_path, "LAUNDRIS_DISK_CACHE": "0", "LAUNDRIS_TRACE_LOG": "0"}
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        fleet_df, _, failed = portfolio.compute_portfolio(ids, dict(zip(ids, names)), workers=workers, use_stored=False)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    if failed:
+        raise RuntimeError(f"{len(failed)} customers failed, e.g. {next(iter(failed.items()))}")
+    return fleet_df
+
+
+def run_scale(n_tags, n_customers, seed, repeat, dsn=None, portfolio_workers=0):
+    results = {}
+
+    def record(name, stage, rows=None, repeat=repeat):
+        try:
+            result, stats = measure(stage, repeat)
+        except Exception as e:
+            results[name] = {"error": repr(e)}
+            print(f"  {name:<32} failed: {e!r}", flush=True)
+            return None
+        if rows is not None:
+            stats["rows"] = rows
+            stats["rows_per_second"] = rows / stats["wall_time"] if stats["wall_time"] > 0 else None
+        results[name] = stats
+        print(f"  {name:<32} {stats['wall_time']:>9.3f}s {stats['peak_bytes'] / 2**20:>10.1f} MB" + (f" {rows:>12,} rows" if rows is not None else ""), flush=True)
+        return result
+
+    tables = record("generate", lambda: synthetic_data.generate(n_tags, n_customers, seed=seed), rows=n_tags, repeat=1)
+    customer_id = synthetic_data.largest_customer(tables)
+
+    tables_read = record("customer_tables", lambda: synthetic_data.customer_tables(tables, customer_id))
+    exploded_df = record("explode_order_cycles", lambda: db.explode_order_cycles(tables_read), rows=tables_read["rfid"].shape[0])
+    summary_df = record("summarize_order_cycles", lambda: db.summarize_order_cycles(exploded_df), rows=exploded_df.shape[0])
+    # LAUNDRIS_FETCH_MODE=streaming: the same summary folded from ordered row chunks, without the exploded frame
+    streamed_summary_df = record("summarize_order_cycles_streaming", lambda: db.complete_order_cycle_summary(
+        db.summarize_order_cycle_chunks(synthetic_data.order_cycle_event_chunks(tables, customer_id, db.stream_chunk_rows)), tables_read["rfid"]),
+        rows=exploded_df.shape[0])
+    if streamed_summary_df is not None and not streamed_summary_df.equals(summary_df):
+        results["summarize_order_cycles_streaming"] = {"error": "streamed summary differs from summarize_order_cycles"}
+        print("  streamed summary differs from summarize_order_cycles", flush=True)
+    frames = record("finalize_order_cycle_frames", lambda: db.finalize_order_cycle_frames(exploded_df, summary_df, tables_read, customer_id), rows=summary_df.shape[0])
+    # fetch_data returns the compact schema without the exploded frame, so the later stages run on that
+    frames = record("compact_frames", lambda: (None,) + db.compact_frames(frames[1:]), rows=summary_df.shape[0])
+    order_cycle_df = frames[1].copy()
+    order_cycle_df["customer_id"] = customer_id
+
+    inactive_df = order_cycle_df[order_cycle_df.inactive_time > 90]
+    active_df = order_cycle_df[order_cycle_df.inactive_time <= 90]
+    record("predict_ragout_group", lambda: ml.predict_ragout_group(inactive_df.copy()), rows=inactive_df.shape[0])
+    record("predict_ragout_time_group", lambda: ml.predict_ragout_time_group(active_df.copy(), 30), rows=active_df.shape[0])
+    record("score_items", lambda: ml.score_items(frames[1], customer_id), rows=frames[1].shape[0])
+
+    desired_quantity_df = synthetic_data.desired_quantity(tables, list(frames[1].item_type_id.unique()), customer_id)
+    record("compute_depletion", lambda: engine.compute_depletion(customer_id, frames[1], frames[2], desired_quantity_df, datetime.date.today()), rows=frames[1].shape[0])
+
+    record("main", lambda: run_main(tables, customer_id, frames), rows=frames[1].shape[0])
+
+    # The embedded backends over a snapshot of the same tables, with the joins and the summary run in the engine
+    with tempfile.TemporaryDirectory(prefix="laundris-snapshot-") as snapshot_path:
+        embedded_backend.write_snapshot(tables, snapshot_path)
+        for engine_name in embedded_engines:
+            backend = embedded_backend.EmbeddedBackend(engine_name, snapshot_path)
+            record(f"load_snapshot[{engine_name}]", backend.load, rows=n_tags, repeat=1)
+            engine_frames = record(f"customer_frames[{engine_name}]", lambda: backend.customer_frames(customer_id), rows=frames[1].shape[0])
+            if engine_frames is not None and not all(
+                    expected_df.reset_index(drop=True).equals(engine_df.reset_index(drop=True))
+                    for expected_df, engine_df in zip(frames[1:], db.compact_frames(engine_frames[1:]))):
+                results[f"customer_frames[{engine_name}]"] = {"error": "frames differ from the pandas pipeline"}
+                print(f"  {engine_name} frames differ from the pandas pipeline", flush=True)
+
+        # The fleet portfolio of every customer, including the worker start-up; tracemalloc only sees the merge
+        if portfolio_workers:
+            n_customers = len(synthetic_data.inventory_list(tables)[1])
+            record("portfolio", lambda: run_portfolio(tables, snapshot_path, embedded_engines[-1], portfolio_workers), rows=n_customers, repeat=1)
+
+    if dsn:
+        import psycopg2
+
+        conn = psycopg2.connect(dsn)
+        try:
+            synthetic_data.load_into_postgres(tables, conn)
+            postgres_tables = record("read_customer_tables", lambda: db.read_customer_tables(customer_id, conn), rows=tables_read["rfid"].shape[0])
+        finally:
+            conn.close()
+        record("read_customer_tables_concurrent", lambda: db.read_customer_tables_concurrent(customer_id), rows=tables_read["rfid"].shape[0])
+
+        streamed_frames = record("stream_customer_frames", lambda: db.stream_customer_frames(customer_id), rows=exploded_df.shape[0])
+        if streamed_frames is not None and postgres_tables is not None:
+            expected_df = db.build_order_cycle_frames(postgres_tables, customer_id, include_exploded=False)[1]
+            if not streamed_frames[1].reset_index(drop=True).equals(expected_df.reset_index(drop=True)):
+                results["stream_customer_frames"] = {"error": "streamed frames differ from the non-streaming read"}
+                print("  streamed frames differ from the non-streaming read", flush=True)
+
+    return {"customer_id": customer_id, "customer_tags": tables_read["rfid"].shape[0], "stages": results}
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    # A stage regresses when it is `tolerance` slower (and at least min_seconds slower) or uses `tolerance` more memory
+    regressions = []
+    for scale, scale_results in results.items():
+        baseline_stages = baseline.get(scale, {}).get("stages", {})
+        for name, stats in scale_results["stages"].items():
+            base = baseline_stages.get(name)
+            if not base or "error" in base:
+                continue
+            if "error" in stats:
+                regressions.append(f"{scale} tags / {name}: failed ({stats['error']})")
+                continue
+            if stats["wall_time"] > base["wall_time"] * (1 + tolerance) and stats["wall_time"] - base["wall_time"] > min_seconds:
+                regressions.append(f"{scale} tags / {name}: wall time {base['wall_time']:.3f}s -> {stats['wall_time']:.3f}s")
+            if stats["peak_bytes"] > base["peak_bytes"] * (1 + tolerance):
+                regressions.append(f"{scale} tags / {name}: peak memory {base['peak_bytes'] / 2**20:.1f} MB -> {stats['peak_bytes'] / 2**20:.1f} MB")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the depletion pipeline on seeded synthetic data")
+    parser.add_argument("--tags", type=int, nargs="+", default=[10_000, 100_000], help="number of RFID tags to generate, one run per value (10k to 5M)")
+    parser.add_argument("--customers", type=int, help="number of customers the tags are spread over (default: one per 5k tags, at most 200); "
+                                                       "the pipeline stages run for the largest one, so --customers 1 benchmarks every tag")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage; the best one is reported")
+    parser.add_argument("--baseline", default=default_baseline_path)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative slowdown / memory growth that counts as a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="ignore slowdowns smaller than this")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--dsn", help="libpq connection string of a throwaway Postgres database; its tables are replaced")
+    parser.add_argument("--portfolio-workers", type=int, default=os.cpu_count() or 1, help="workers of the fleet portfolio stage; 0 skips it")
+    parser.add_argument("--portfolio-budget", type=float, help="seconds the fleet portfolio of all customers may take; exits 1 when it takes longer")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # main() assigns into filtered frames and uses deprecated pandas/Streamlit calls; the warnings would drown the report
+    warnings.simplefilter("ignore", pd.errors.SettingWithCopyWarning)
+    warnings.simplefilter("ignore", FutureWarning)
+
+    # Load the model artifacts up front so the prediction stages time scoring only
+    ml.get_registry()
+
+    results = {}
+    for n_tags in args.tags:
+        print(f"{n_tags:,} tags (seed {args.seed})", flush=True)
+        results[str(n_tags)] = run_scale(n_tags, args.customers, args.seed, args.repeat, args.dsn, args.portfolio_workers)
+
+    over_budget = []
+    if args.portfolio_budget:
+        for scale, scale_results in results.items():
+            stats = scale_results["stages"].get("portfolio", {})
+            if "wall_time" in stats and stats["wall_time"] > args.portfolio_budget:
+                over_budget.append(f"{scale} tags / portfolio: {stats['wall_time']:.1f}s for {stats['rows']} customers, budget {args.portfolio_budget:.0f}s")
+            elif "error" in stats:
+                over_budget.append(f"{scale} tags / portfolio: failed ({stats['error']})")
+    for line in over_budget:
+        print(f"OVER BUDGET {line}")
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "seed": args.seed,
+        "customers": args.customers,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        if (baseline.get("seed", args.seed), baseline.get("customers", args.customers)) != (args.seed, args.customers):
+            baseline = {}
+        baseline.update({key: value for key, value in report.items() if key != "results"})
+        baseline.setdefault("results", {}).update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+        return 1 if over_budget else 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; run with --save-baseline to record one")
+        return 1 if over_budget else 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if (baseline.get("seed"), baseline.get("customers")) != (args.seed, args.customers):
+        print("baseline was recorded with a different --seed / --customers; skipping the comparison")
+        return 1 if over_budget else 0
+
+    regressions = compare(results, baseline["results"], args.tolerance, args.min_seconds)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print("no regressions against the baseline")
+    return 1 if regressions or over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # Thread-safe pool of DB-API connections. Connections are created lazily up to maxconn,
+    # checked out with `with pool.connection() as conn:` and returned (rolled back) on exit.
+    def __init__(self, connect_factory, minconn=1, maxconn=5, health_check_interval=30, timeout=30):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"invalid pool size: minconn={minconn}, maxconn={maxconn}")
+
+        self.connect_factory = connect_factory
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        self._idle = []          # (connection, last_used) pairs, most recently used last
+        self._size = 0           # idle + checked out connections
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+        self.stats = {"checkouts": 0, "wait_time": 0.0, "max_wait_time": 0.0, "created": 0, "reconnects": 0, "discarded": 0}
+
+        for _ in range(minconn):
+            self._idle.append((self._create(), time.monotonic()))
+            self._size += 1
+
+    def _create(self):
+        conn = self.connect_factory()
+        self._count("created")
+        return conn
+
+    def _count(self, name):
+        with self._cond:
+            self.stats[name] += 1
+
+    def _is_healthy(self, conn):
+        if getattr(conn, "closed", 0):
+            return False
+        try:
+            # Rolled back first: a connection left in a failed transaction would reject the SELECT
+            conn.rollback()
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        self._count("discarded")
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise PoolTimeout(f"no connection available within {self.timeout}s (maxconn={self.maxconn})")
+                self._cond.wait(remaining)
+
+            waited = time.monotonic() - start
+            self.stats["checkouts"] += 1
+            self.stats["wait_time"] += waited
+            self.stats["max_wait_time"] = max(self.stats["max_wait_time"], waited)
+
+        try:
+            if conn is None:
+                conn = self._create()
+            elif time.monotonic() - last_used > self.health_check_interval and not self._is_healthy(conn):
+                self._discard(conn)
+                conn = self._create()
+                self._count("reconnects")
+        except Exception:
+            self._release_slot()
+            raise
+
+        return conn
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _release(self, conn):
+        broken = False
+        if not getattr(conn, "closed", 0):
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+
+        if broken or getattr(conn, "closed", 0) or self._closed:
+            self._discard(conn)
+            self._release_slot()
+            self._refill()
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _refill(self):
+        # Replaces discarded connections until the pool holds minconn again; a failed connect leaves it for later
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._create()
+            except Exception:
+                self._release_slot()
+                return
+            with self._cond:
+                self._idle.insert(0, (conn, time.monotonic()))
+                self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            # An ordinary SQL error only aborts the transaction, which _release rolls back; the connection is
+            # discarded when the rollback fails or the connection was closed (server restart, network error)
+            self._release(conn)
+
+    def snapshot(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats.update({"size": self._size, "idle": len(self._idle), "in_use": self._size - len(self._idle)})
+        return stats
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for conn, _ in idle:
+            self._discard(conn)
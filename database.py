@@ -1,27 +1,121 @@
 import streamlit as st 
 import datetime
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd 
 import pandas.io.sql as psql 
+import pyarrow as pa 
 
 import psycopg2 
 
+import disk_cache
+import instrumentation
+from connection_pool import ConnectionPool
+
+
 def connect(): 
+    # Credentials come from the environment; an unset password falls back to PGPASSWORD / ~/.pgpass
     conn = psycopg2.connect(
-        host="laundris-db.postgres.database.azure.com",
-        database="laundris",
-        user="postgres",
-        password="Laundris123")
+        host=os.environ.get("LAUNDRIS_DB_HOST", "laundris-db.postgres.database.azure.com"),
+        port=os.environ.get("LAUNDRIS_DB_PORT", "5432"),
+        database=os.environ.get("LAUNDRIS_DB_NAME", "laundris"),
+        user=os.environ.get("LAUNDRIS_DB_USER", "postgres"),
+        password=os.environ.get("LAUNDRIS_DB_PASSWORD"),
+        connect_timeout=int(os.environ.get("LAUNDRIS_DB_CONNECT_TIMEOUT", "10")))
 
     return conn 
 
 
+_pool = None 
+_pool_lock = threading.Lock() 
+
+
+def get_pool(): 
+    # One pool per process, shared by every Streamlit session and worker thread
+    global _pool 
+    with _pool_lock: 
+        if _pool is None: 
+            _pool = ConnectionPool(connect, 
+                                   minconn=int(os.environ.get("LAUNDRIS_DB_POOL_MIN", "1")), 
+                                   maxconn=int(os.environ.get("LAUNDRIS_DB_POOL_MAX", "5")), 
+                                   health_check_interval=float(os.environ.get("LAUNDRIS_DB_POOL_HEALTH_CHECK", "30")), 
+                                   timeout=float(os.environ.get("LAUNDRIS_DB_POOL_TIMEOUT", "30"))) 
+    return _pool 
+
+
+def close_pool(): 
+    # Closes the process's pool; the next use creates a new one 
+    global _pool 
+    with _pool_lock: 
+        pool, _pool = _pool, None 
+    if pool is not None: 
+        pool.close() 
+
+
+def pool_metrics(): 
+    # Only reports a pool that exists; scraping /metrics never opens connections 
+    return instrumentation.stats_lines("laundris_db_pool", "Connection pool counters", _pool.snapshot()) if _pool is not None else [] 
+
+
+instrumentation.collectors.append(pool_metrics) 
+
+
+@contextmanager
+def connection(): 
+    with get_pool().connection() as conn: 
+        yield conn 
+
+
+class PostgresBackend: 
+    # The production database through the process-wide pool; joins and aggregations run in pandas (or, in 
+    # streaming mode, partly on the server), see read_customer_frames 
+    name = "postgres" 
+
+    def read_sql(self, sql, params=None, name="query"): 
+        with connection() as conn: 
+            return read_table(name, sql, conn, params) 
+
+    def customer_frames(self, customer_id, include_exploded=False): 
+        return read_customer_frames(customer_id, include_exploded) 
+
+    def desired_quantities(self, customer_ids): 
+        with connection() as conn: 
+            return fetch_desired_quantities(customer_ids, conn) 
+
+    def profile_version(self): 
+        with connection() as conn: 
+            return fetch_profile_version(conn) 
+
+
+# postgres (default), or duckdb / sqlite / embedded for an in-process engine over a local snapshot (embedded_backend.py)
+backend_name = os.environ.get("LAUNDRIS_BACKEND", "postgres") 
+
+_backend = None 
+_backend_lock = threading.Lock() 
+
+
+def get_backend(): 
+    global _backend 
+    with _backend_lock: 
+        if _backend is None: 
+            if backend_name == "postgres": 
+                _backend = PostgresBackend() 
+            else: 
+                import embedded_backend  # imported here because the embedded backend builds on this module 
+                _backend = embedded_backend.EmbeddedBackend(backend_name) 
+    return _backend 
+
 
 @st.cache_data
 def fetch_inventory_list(): 
-    conn = connect() 
     command = "select customer_id, customer_name from customer where status='active' and customer_type='internal' and entity_type='hotel'"  
     
-    df = pd.read_sql(command, conn) 
+    df = get_backend().read_sql(command, name="inventory_list") 
     inventory_list = df.customer_name.to_list()
     inventory_ids  = df.customer_id.to_list()
 
@@ -30,89 +124,245 @@ def fetch_inventory_list():
 
 @st.cache_data 
 def fetch_item_type_names(): 
-    conn = connect() 
     command = "select id as item_type_id, customer_item_type_name as item_type_name from customer_customerinventoryitemtype"
 
-    df = pd.read_sql(command, conn) 
+    df = get_backend().read_sql(command, name="item_type_names") 
     return df 
 
 
+def parse_customer_groups(value): 
+    # "45:37,38;50:51" -> {45: [37, 38], 50: [51]}: the room and hotel profiles of customer 45 are those of hotels 37 and 38
+    groups = {} 
+    for group in filter(None, (part.strip() for part in value.split(";"))): 
+        customer_id, members = group.split(":") 
+        groups[int(customer_id)] = [int(member) for member in members.split(",") if member.strip()] 
+    return groups 
+
+
+customer_groups = parse_customer_groups(os.environ.get("LAUNDRIS_CUSTOMER_GROUPS", "45:37,38")) 
+
+# Seconds between checks of whether the profile tables changed since the desired quantities were read
+desired_quantity_check_interval = float(os.environ.get("LAUNDRIS_DESIRED_QUANTITY_CHECK", "60")) 
+
+# Desired quantity per (customer, item type) for any number of customers in one round trip. A customer's
+# room types come from the hotels of its group (or its own hotel profile); the item type's ideal par level
+# falls back to the customer's par level.
+desired_quantities_sql = """
+    WITH members AS (SELECT * FROM unnest(%(customer_ids)s::int[], %(hotel_ids)s::int[]) AS m(customer_id, hotel_id))
+    SELECT m.customer_id, r.customer_item_type_id AS item_type_id, t.customer_item_type_name AS item_type_name,
+           r.item_quantity * h.quantity * COALESCE(t.ideal_par_level, c.par_level) AS desired_quantity
+    FROM members m
+    JOIN customer_hotelprofile h ON h.customer_id = m.hotel_id
+    JOIN customer_roomprofile r ON r.customer_room_type_id = h.customer_room_type_id
+    JOIN customer_customerinventoryitemtype t ON t.id = r.customer_item_type_id
+    JOIN customer c ON c.customer_id = m.customer_id
+"""
+
+# Row count and newest row version (xmin, the id of the transaction that wrote the row) of each table the desired
+# quantities are computed from: an insert or update raises the table's max(xmin), a delete lowers its count
+profile_tables = ['customer_roomprofile', 'customer_hotelprofile', 'customer_customerinventoryitemtype', 'customer'] 
+profile_version_sql = "SELECT " + " || ';' || ".join( 
+    f"(SELECT count(*) || ':' || COALESCE(max(xmin::text::bigint), 0) FROM {table})" for table in profile_tables) + " AS version" 
+
+
+def fetch_desired_quantities(customer_ids, conn): 
+    members = [(customer_id, hotel_id) for customer_id in customer_ids for hotel_id in customer_groups.get(customer_id, [customer_id])] 
+    params = {"customer_ids": [customer_id for customer_id, _ in members], "hotel_ids": [hotel_id for _, hotel_id in members]} 
+    return read_table("desired_quantities", desired_quantities_sql, conn, params) 
+
+
+def fetch_profile_version(conn): 
+    return read_table("profile_version", profile_version_sql, conn)["version"].iloc[0] 
+
+
+_desired_quantities = {}          # customer_id -> its rows of fetch_desired_quantities 
+_desired_quantities_state = {"version": None, "checked_at": 0.0, "generation": 0} 
+_desired_quantities_lock = threading.Lock() 
+
+
+def check_profile_version(backend): 
+    # At most one thread per interval asks the backend; the query runs outside the lock 
+    with _desired_quantities_lock: 
+        if time.monotonic() - _desired_quantities_state["checked_at"] < desired_quantity_check_interval: 
+            return 
+        _desired_quantities_state["checked_at"] = time.monotonic() 
+
+    try: 
+        version = backend.profile_version() 
+    except Exception: 
+        with _desired_quantities_lock: 
+            _desired_quantities_state["checked_at"] = 0.0 
+        raise 
+
+    with _desired_quantities_lock: 
+        if version != _desired_quantities_state["version"]: 
+            _desired_quantities.clear() 
+            _desired_quantities_state["version"] = version 
+            _desired_quantities_state["generation"] += 1 
+
+
+def get_desired_quantities(customer_ids): 
+    # Cached fetch_desired_quantities; the cache is dropped when the profile tables have been written to. The lock 
+    # only guards the dict, so one session's cache miss never waits for another session's query. 
+    customer_ids = list(dict.fromkeys(customer_ids)) 
+    backend = get_backend() 
+    check_profile_version(backend) 
+
+    with _desired_quantities_lock: 
+        frames = {customer_id: _desired_quantities[customer_id] for customer_id in customer_ids if customer_id in _desired_quantities} 
+        generation = _desired_quantities_state["generation"] 
+
+    missing = [customer_id for customer_id in customer_ids if customer_id not in frames] 
+    if missing: 
+        df = backend.desired_quantities(missing) 
+        fetched = {customer_id: df[df.customer_id == customer_id].reset_index(drop=True) for customer_id in missing} 
+        frames.update(fetched) 
+        with _desired_quantities_lock: 
+            # Rows read before an invalidation that happened meanwhile are returned but not cached 
+            if _desired_quantities_state["generation"] == generation: 
+                for customer_id, rows in fetched.items(): 
+                    _desired_quantities.setdefault(customer_id, rows) 
+
+    if not customer_ids: 
+        return pd.DataFrame(columns=["customer_id", "item_type_id", "item_type_name", "desired_quantity"]) 
+    return pd.concat([frames[customer_id] for customer_id in customer_ids], ignore_index=True) 
+
+
 def get_desired_quantity(item_type_ids, customer_id):
-    conn = connect()  
-    # Convert the list to a string of comma-separated values
-    item_type_ids_str = ', '.join(map(str, item_type_ids)) 
-
-    if customer_id == 45: 
-        room_profile_sql = """
-        select r.customer_room_type_id, r.customer_item_type_id as item_type_id, r.item_quantity, h.quantity
-            from customer_roomprofile r
-            join customer_hotelprofile h on r.customer_room_type_id = h.customer_room_type_id
-            where r.customer_item_type_id in ({})
-            and h.customer_id in (37, 38)
-        """.format(item_type_ids_str)
-    else: 
-        room_profile_sql = """
-        select r.customer_room_type_id, r.customer_item_type_id as item_type_id, r.item_quantity, h.quantity
-            from customer_roomprofile r
-            join customer_hotelprofile h on r.customer_room_type_id = h.customer_room_type_id
-            where r.customer_item_type_id in ({})
-            and h.customer_id = {}
-        """.format(item_type_ids_str, customer_id)
+    # Desired quantity per item type name for the customer's item types in use 
+    room_profile_df = get_desired_quantities([customer_id]) 
+    room_profile_df = room_profile_df[room_profile_df.item_type_id.isin(item_type_ids)] 
 
+    par_level_group = room_profile_df[['item_type_name', 'desired_quantity']].groupby("item_type_name").sum()
+    par_level_group = par_level_group.reset_index()  
+    par_level_group.columns = ['Item Type', 'Desired Quantity'] 
+    
+    return par_level_group
 
 
-    par_level_sql = """
-    select id as item_type_id, ideal_par_level, customer_item_type_name 
-        from customer_customerinventoryitemtype
-        where id in ({})
-    """.format(item_type_ids_str)
 
-    customer_par_level_sql = f"select par_level from customer where customer_id = {customer_id}"
+# Restricts a table to the rows that belong to the selected customer's RFIDs so the
+# bin/order/location joins are resolved on the server instead of shipping whole tables.
+customer_rfids_sql = "SELECT rfid_id FROM rfid WHERE customer_id = %(customer_id)s"
 
-    room_profile_df = pd.read_sql(room_profile_sql, conn) 
-    par_level_df    = pd.read_sql(par_level_sql, conn) 
-    customer_par_level = pd.read_sql(customer_par_level_sql, conn) 
-    customer_par_level = customer_par_level['par_level'].iloc[0] 
+customer_bins_sql = f"SELECT binrfids_id FROM order_binrfids_rfids WHERE rfid_id IN ({customer_rfids_sql})"
 
-    room_profile_df = pd.merge(room_profile_df, par_level_df, on='item_type_id') 
 
-    room_profile_df['ideal_par_level'].fillna(customer_par_level, inplace=True) 
+def customer_table_queries(): 
+    rfid_sql = """SELECT r.rfid_id, r.creation_date, r.last_updated_date, r.status, r.ragout_date, r.total_washes, r.last_scan_date, r.item_type_id, 
+                  r.last_seen_location_id, r.location_id, r.birthday FROM rfid r WHERE r.customer_id = %(customer_id)s;""" 
 
-    room_profile_df['Desired Quantity'] = room_profile_df['item_quantity'] * room_profile_df['quantity'] * room_profile_df['ideal_par_level']
+    order_binrfids_rfids_sql = f"SELECT binrfids_id, rfid_id FROM order_binrfids_rfids WHERE rfid_id IN ({customer_rfids_sql});" 
+    order_order_pickup_bins_sql = f"SELECT binrfids_id, order_id FROM order_order_pickup_bins WHERE binrfids_id IN ({customer_bins_sql});" 
+    order_order_dropoff_bins_sql = f"SELECT binrfids_id, order_id FROM order_order_dropoff_bins WHERE binrfids_id IN ({customer_bins_sql});"
 
-    par_level_group = room_profile_df[['customer_item_type_name', 'Desired Quantity']].groupby("customer_item_type_name").sum()
-    par_level_group = par_level_group.reset_index()  
-    par_level_group.columns = ['Item Type', 'Desired Quantity'] 
+    item_type_sql = """SELECT id AS item_type_id, customer_item_type_name AS item_type_name 
+                       FROM customer_customerinventoryitemtype
+                       WHERE id IN (SELECT item_type_id FROM rfid WHERE customer_id = %(customer_id)s);"""
     
-    return par_level_group
+    pickup_order_sql = f"""SELECT id AS order_id, actual_pickup_date, actual_dropoff_date, incoming_total_weight
+                   FROM order_order
+                   WHERE id IN (SELECT order_id FROM order_order_pickup_bins WHERE binrfids_id IN ({customer_bins_sql}))"""
 
+    dropoff_order_sql = f"""SELECT id AS order_id, actual_pickup_date, actual_dropoff_date, incoming_total_weight
+                   FROM order_order
+                   WHERE id IN (SELECT order_id FROM order_order_dropoff_bins WHERE binrfids_id IN ({customer_bins_sql}))"""
+    
+    location_sql = """SELECT id AS last_seen_location_id, name AS last_seen_location_name, location_type, customer_id as location_customer_id, side FROM inventory_location
+                      WHERE id IN (SELECT last_seen_location_id FROM rfid WHERE customer_id = %(customer_id)s
+                                   UNION SELECT location_id FROM rfid WHERE customer_id = %(customer_id)s)"""
+
+    queries = {
+        "rfid": rfid_sql,
+        "order_binrfids_rfids": order_binrfids_rfids_sql,
+        "order_order_pickup_bins": order_order_pickup_bins_sql,
+        "order_order_dropoff_bins": order_order_dropoff_bins_sql,
+        "item_type": item_type_sql,
+        "location": location_sql,
+        "pickup_order": pickup_order_sql,
+        "dropoff_order": dropoff_order_sql,
+    }
+
+    return queries 
+
+
+def read_table(name, sql, conn, params=None, trace=None): 
+    # pd.read_sql in a "sql.<name>" span; trace is passed in by worker threads (see read_tables_concurrent)
+    with instrumentation.span(f"sql.{name}", trace=trace) as span: 
+        df = pd.read_sql(sql, conn, params=params) 
+        span.rows_out = len(df) 
+    return df 
 
 
-@st.cache_data
-def fetch_data(customer_id):
-    rfid_sql = f"""SELECT r.rfid_id, r.creation_date, r.last_updated_date, r.status, r.ragout_date, r.total_washes, r.last_scan_date, r.item_type_id, 
-                  r.last_seen_location_id, r.location_id, r.birthday FROM rfid r WHERE r.customer_id = {customer_id};""" 
+def read_customer_tables(customer_id, conn):
+    params = {"customer_id": customer_id}
 
-    order_binrfids_rfids_sql = "SELECT binrfids_id, rfid_id FROM order_binrfids_rfids;" 
-    order_order_pickup_bins_sql = "SELECT binrfids_id, order_id FROM order_order_pickup_bins;" 
-    order_order_dropoff_bins_sql = "SELECT binrfids_id, order_id FROM order_order_dropoff_bins;"
+    tables = {name: read_table(name, sql, conn, params) for name, sql in customer_table_queries().items()}
+
+    return tables 
 
-    item_type_sql = """SELECT id AS item_type_id, customer_item_type_name AS item_type_name 
-                       FROM customer_customerinventoryitemtype;"""
-    
-    order_sql = """SELECT id AS order_id, actual_pickup_date, actual_dropoff_date, incoming_total_weight
-                   FROM order_order"""
-    
-    location_sql = "SELECT id AS last_seen_location_id, name AS last_seen_location_name, location_type, customer_id as location_customer_id, side FROM inventory_location"
-    
-    today = pd.Timestamp(datetime.date.today(), tz='UTC')
 
-    conn = connect()  
+def read_tables_concurrent(queries, params, max_workers=None):
+    # The reads are independent, so each one runs on its own pooled connection and the
+    # cold-load latency becomes the slowest query instead of the sum of all of them
+    max_workers = max_workers or min(len(queries), get_pool().maxconn) 
+    trace = instrumentation.current_trace() 
 
-    rfid_df = pd.read_sql(rfid_sql, conn) 
-    order_binrfids_rfids_df = pd.read_sql(order_binrfids_rfids_sql, conn) 
-    order_order_pickup_bins_df = pd.read_sql(order_order_pickup_bins_sql, conn) 
-    order_order_dropoff_bins_df = pd.read_sql(order_order_dropoff_bins_sql, conn)
+    def read_pooled(name, sql): 
+        with connection() as conn: 
+            return read_table(name, sql, conn, params, trace) 
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fetch_data") as executor: 
+        futures = {name: executor.submit(read_pooled, name, sql) for name, sql in queries.items()} 
+        tables = {name: future.result() for name, future in futures.items()} 
+
+    return tables 
+
+
+def read_customer_tables_concurrent(customer_id, max_workers=None):
+    return read_tables_concurrent(customer_table_queries(), {"customer_id": customer_id}, max_workers) 
+
+
+def summarize_order_cycles(df): 
+    # One row per rfid_id (sorted) with its order-cycle counts, the latest pickup (date and order),
+    # the latest dropoff date and the operation of its last bin row, computed without per-group Python calls.
+    grouped = df.groupby('rfid_id') 
+
+    summary_df = grouped['pickup_order_id'].count().reset_index(name='pickup_count') 
+    summary_df['dropoff_count'] = grouped['dropoff_order_id'].count().reset_index(drop=True) 
+
+    last_operation = np.where(df['pickup_order_id'].notnull(), 'pickup', 
+                              np.where(df['dropoff_order_id'].notnull(), 'dropoff', 'No order cycle'))
+    summary_df['last_operation'] = pd.Series(last_operation, index=df.index).groupby(df['rfid_id']).last().reset_index(drop=True) 
+
+    # Sort once so the first row of every rfid is its latest pickup; rows without a pickup date go last
+    latest_pickup_df = df[['rfid_id', 'last_pickup_date', 'pickup_order_id']].sort_values(['rfid_id', 'last_pickup_date'], 
+                                                                                            ascending=[True, False], kind='stable') 
+    latest_pickup_df = latest_pickup_df.drop_duplicates('rfid_id', keep='first').reset_index(drop=True) 
+    summary_df['last_pickup_date'] = latest_pickup_df['last_pickup_date'] 
+    summary_df['pickup_order_id'] = latest_pickup_df['pickup_order_id'] 
+
+    summary_df['last_dropoff_date'] = grouped['last_dropoff_date'].max().reset_index(drop=True) 
+
+    return summary_df 
+
+
+def sorted_by(df, columns): 
+    # Stable, and skipped when the rows already come in that order (the usual case for small reads) 
+    first = df[columns[0]] 
+    if first.is_monotonic_increasing and (len(columns) == 1 or first.is_unique): 
+        return df 
+    return df.sort_values(columns, kind='stable') 
+
+
+def explode_order_cycles(tables): 
+    # One row per rfid x bin x pickup/dropoff order, with the order dates attached. Within an RFID the rows are
+    # ordered by bin, then pickup and dropoff order id, as in order_cycle_events_sql: an RFID's last row (its
+    # last_operation) must not depend on the order the database happened to return the bin tables in.
+    rfid_df = tables["rfid"] 
+    order_binrfids_rfids_df = sorted_by(tables["order_binrfids_rfids"], ['binrfids_id']) 
+    order_order_pickup_bins_df = sorted_by(tables["order_order_pickup_bins"], ['binrfids_id', 'order_id']) 
+    order_order_dropoff_bins_df = sorted_by(tables["order_order_dropoff_bins"], ['binrfids_id', 'order_id'])
 
     df = pd.merge(rfid_df, order_binrfids_rfids_df, on='rfid_id', how='left') 
     df = pd.merge(df, order_order_pickup_bins_df, on='binrfids_id', how='left')
@@ -120,21 +370,25 @@ def fetch_data(customer_id):
     df = pd.merge(df, order_order_dropoff_bins_df, on='binrfids_id', how='left')
     df.rename(columns={"order_id": "dropoff_order_id"}, inplace=True)
 
-
-    item_type_df = pd.read_sql(item_type_sql, conn) 
-    location_df = pd.read_sql(location_sql, conn)
-    pickup_order_df = pd.read_sql(order_sql, conn) 
-    dropoff_order_df = pd.read_sql(order_sql, conn)
+    pickup_order_df = tables["pickup_order"].copy() 
+    dropoff_order_df = tables["dropoff_order"].copy()
     pickup_order_df.rename(columns = {"order_id":"pickup_order_id", "actual_pickup_date":"last_pickup_date", "incoming_total_weight":"pickup_weight"}, inplace=True) 
     dropoff_order_df.rename(columns = {"order_id":"dropoff_order_id", "actual_dropoff_date":"last_dropoff_date", "incoming_total_weight":"dropoff_weight"}, inplace=True)
 
     df = pd.merge(df, pickup_order_df, on='pickup_order_id', how='left')
     df = pd.merge(df, dropoff_order_df, on='dropoff_order_id', how='left') 
 
-    pickup_count_df = df.groupby('rfid_id')['pickup_order_id'].count().reset_index(name='pickup_count') 
-    dropoff_count_df = df.groupby('rfid_id')['dropoff_order_id'].count().reset_index(name='dropoff_count') 
+    return df 
 
-    pickup_dropoff_count_df = pd.merge(pickup_count_df, dropoff_count_df, on='rfid_id')
+
+def finalize_order_cycle_frames(df, order_cycle_summary_df, tables, customer_id, include_exploded=True): 
+    today = pd.Timestamp(datetime.date.today(), tz='UTC')
+
+    rfid_df = tables["rfid"] 
+    item_type_df = tables["item_type"] 
+    location_df = tables["location"]
+
+    pickup_dropoff_count_df = order_cycle_summary_df[['rfid_id', 'pickup_count', 'dropoff_count']]
     pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, rfid_df, on='rfid_id', how='left') 
 
     pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, item_type_df, on='item_type_id', how='left')
@@ -151,22 +405,14 @@ def fetch_data(customer_id):
     pickup_dropoff_count_df['last_seen_location_name'].fillna("Not specified", inplace=True) 
     pickup_dropoff_count_df['last_seen_location_name'].fillna("Not specified", inplace=True) 
     
-    df['last_operation'] = 'pickup'
-    df.loc[df['pickup_order_id'].isnull(), 'last_operation'] = 'dropoff'  
-    df.loc[df['pickup_order_id'].isnull() & df['dropoff_order_id'].isnull(), 'last_operation'] = 'No order cycle'
-
-    last_pickup_date = df[['rfid_id', 'last_pickup_date', 'pickup_order_id']].groupby('rfid_id').apply(lambda x: x.sort_values('last_pickup_date', ascending=False).iloc[0]).reset_index(drop=True)
-    last_dropoff_date = df[['rfid_id', 'last_dropoff_date']].groupby('rfid_id').apply(lambda x: x.sort_values('last_dropoff_date', ascending=False).iloc[0]).reset_index(drop=True)
-
-    last_operation_df = df.groupby('rfid_id')['last_operation'].last().reset_index()
-
-    df.drop('last_operation', axis=1, inplace=True) 
-
-    df = pd.merge(df, last_operation_df, on='rfid_id', how='left')
-    pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, last_operation_df, on='rfid_id', how='left')
-
-    pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, last_pickup_date, on='rfid_id', how='left')
-    pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, last_dropoff_date, on='rfid_id', how='left')
+    # The exploded frame is only returned on request; the dashboard never reads it
+    if include_exploded: 
+        df = pd.merge(df, order_cycle_summary_df[['rfid_id', 'last_operation']], on='rfid_id', how='left')
+    else: 
+        df = None 
+    pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, 
+                                       order_cycle_summary_df[['rfid_id', 'last_operation', 'last_pickup_date', 'pickup_order_id', 'last_dropoff_date']], 
+                                       on='rfid_id', how='left')
 
     pickup_dropoff_count_df['last_pickup_date'] = pickup_dropoff_count_df['last_pickup_date'].dt.date
     pickup_dropoff_count_df['last_dropoff_date'] = pickup_dropoff_count_df['last_dropoff_date'].dt.date
@@ -187,4 +433,242 @@ def fetch_data(customer_id):
     inactive_status_df = pickup_dropoff_count_df[pickup_dropoff_count_df.status == 'inactive']  
     pickup_dropoff_count_df.drop(['status'], axis=1, inplace=True)
     
-    return df, pickup_dropoff_count_df, inactive_status_df
\ No newline at end of file
+    return df, pickup_dropoff_count_df, inactive_status_df
+
+
+def build_order_cycle_frames(tables, customer_id, include_exploded=True): 
+    with instrumentation.span("pandas.explode_order_cycles", rows_in=len(tables["rfid"])) as span: 
+        df = explode_order_cycles(tables) 
+        span.rows_out = len(df) 
+    with instrumentation.span("pandas.summarize_order_cycles", rows_in=len(df)) as span: 
+        order_cycle_summary_df = summarize_order_cycles(df) 
+        span.rows_out = len(order_cycle_summary_df) 
+
+    return finalize_frames(df, order_cycle_summary_df, tables, customer_id, include_exploded)
+
+
+def finalize_frames(df, order_cycle_summary_df, tables, customer_id, include_exploded=True): 
+    with instrumentation.span("pandas.finalize_order_cycle_frames", rows_in=len(order_cycle_summary_df)) as span: 
+        frames = finalize_order_cycle_frames(df, order_cycle_summary_df, tables, customer_id, include_exploded) 
+        span.rows_out = len(frames[1]) 
+    return frames 
+
+
+# LAUNDRIS_FETCH_MODE=streaming reads the rfid table and the order-cycle rows through server-side (named) cursors,
+# stream_chunk_rows rows at a time, and folds the order-cycle rows into the per-RFID summary as they arrive,
+# so the exploded rfid x bin x order frame is never held in memory.
+stream_chunk_rows = int(os.environ.get("LAUNDRIS_STREAM_CHUNK_ROWS", "100000")) 
+
+# explode_order_cycles' rows for the customer's RFIDs that have bins, joined on the server. The order makes every
+# RFID's rows contiguous and puts its latest bin (highest binrfids_id, i.e. insertion order) last.
+order_cycle_events_sql = f"""SELECT b.rfid_id, b.binrfids_id, p.order_id AS pickup_order_id, po.actual_pickup_date AS last_pickup_date,
+                                    d.order_id AS dropoff_order_id, dor.actual_dropoff_date AS last_dropoff_date
+                             FROM order_binrfids_rfids b
+                             LEFT JOIN order_order_pickup_bins p ON p.binrfids_id = b.binrfids_id
+                             LEFT JOIN order_order po ON po.id = p.order_id
+                             LEFT JOIN order_order_dropoff_bins d ON d.binrfids_id = b.binrfids_id
+                             LEFT JOIN order_order dor ON dor.id = d.order_id
+                             WHERE b.rfid_id IN ({customer_rfids_sql})
+                             ORDER BY b.rfid_id, b.binrfids_id, p.order_id, d.order_id"""
+
+rfid_date_columns = ['creation_date', 'last_updated_date', 'ragout_date', 'last_scan_date', 'birthday'] 
+order_cycle_date_columns = ['last_pickup_date', 'last_dropoff_date'] 
+
+
+def stream_query(sql, conn, params=None, chunk_rows=None, parse_dates=None): 
+    # Yields the result as DataFrames of at most chunk_rows rows. The named cursor keeps the result set on the
+    # server, so neither libpq nor pandas holds more than one chunk of raw rows at a time.
+    chunk_rows = chunk_rows or stream_chunk_rows 
+    with conn.cursor(name=f"laundris_stream_{uuid.uuid4().hex}") as cursor: 
+        cursor.itersize = chunk_rows 
+        cursor.execute(sql.strip().rstrip(";"), params) 
+        while True: 
+            rows = cursor.fetchmany(chunk_rows) 
+            if not rows: 
+                break 
+            chunk = pd.DataFrame.from_records(rows, columns=[column[0] for column in cursor.description], coerce_float=True) 
+            # Same conversion pd.read_sql applies: timestamptz columns become UTC datetimes
+            for column in parse_dates or []: 
+                chunk[column] = pd.to_datetime(chunk[column], utc=True) 
+            yield chunk 
+
+
+def read_streamed(name, sql, conn, params=None, parse_dates=None): 
+    with instrumentation.span(f"sql.{name}") as span: 
+        chunks = list(stream_query(sql, conn, params, parse_dates=parse_dates)) 
+        df = pd.concat(chunks, ignore_index=True) if chunks else pd.read_sql(sql, conn, params=params) 
+        span.rows_out = len(df) 
+    return df 
+
+
+def summarize_order_cycle_chunks(chunks): 
+    # The chunks come ordered by rfid_id, so all RFIDs of a chunk but the last are complete and summarized right
+    # away; the last RFID's rows are carried over into the next chunk
+    summaries = [] 
+    carry_df = None 
+    for chunk in chunks: 
+        if carry_df is not None: 
+            chunk = pd.concat([carry_df, chunk], ignore_index=True) 
+        is_last_rfid = (chunk['rfid_id'] == chunk['rfid_id'].iloc[-1]).to_numpy() 
+        carry_df = chunk[is_last_rfid] 
+        if not is_last_rfid.all(): 
+            summaries.append(summarize_order_cycles(chunk[~is_last_rfid])) 
+
+    if carry_df is not None: 
+        summaries.append(summarize_order_cycles(carry_df)) 
+    if not summaries: 
+        return None 
+    return pd.concat(summaries, ignore_index=True) 
+
+
+def complete_order_cycle_summary(summary_df, rfid_df): 
+    # RFIDs without any bin are not in the streamed rows; explode_order_cycles gives each of them one row without orders
+    no_bins_df = rfid_df.loc[~rfid_df.rfid_id.isin([] if summary_df is None else summary_df.rfid_id), ['rfid_id']] 
+    no_bins_df = no_bins_df.assign(pickup_order_id=np.nan, dropoff_order_id=np.nan, 
+                                   last_pickup_date=pd.Series(pd.NaT, index=no_bins_df.index, dtype='datetime64[ns, UTC]'), 
+                                   last_dropoff_date=pd.Series(pd.NaT, index=no_bins_df.index, dtype='datetime64[ns, UTC]')) 
+
+    summaries = [df for df in [summary_df, summarize_order_cycles(no_bins_df)] if df is not None and not df.empty] 
+    if not summaries: 
+        return summarize_order_cycles(no_bins_df) 
+    # Sorted by rfid_id like summarize_order_cycles' output (the database may collate text differently)
+    return pd.concat(summaries, ignore_index=True).sort_values('rfid_id', kind='stable', ignore_index=True) 
+
+
+def stream_customer_frames(customer_id): 
+    params = {"customer_id": customer_id} 
+    queries = customer_table_queries() 
+
+    with connection() as conn: 
+        tables = { 
+            "rfid": read_streamed("rfid", queries["rfid"], conn, params, parse_dates=rfid_date_columns), 
+            "item_type": read_table("item_type", queries["item_type"], conn, params), 
+            "location": read_table("location", queries["location"], conn, params), 
+        } 
+        # The span covers the streamed query and the summary folded from its chunks
+        with instrumentation.span("sql.order_cycle_events+pandas.summarize_order_cycles") as span: 
+            order_cycle_summary_df = summarize_order_cycle_chunks( 
+                stream_query(order_cycle_events_sql, conn, params, parse_dates=order_cycle_date_columns)) 
+            span.rows_out = 0 if order_cycle_summary_df is None else len(order_cycle_summary_df) 
+
+    order_cycle_summary_df = complete_order_cycle_summary(order_cycle_summary_df, tables["rfid"]) 
+    return finalize_frames(None, order_cycle_summary_df, tables, customer_id, include_exploded=False) 
+
+
+# Compact schema for fetch_data's frames: repeated strings become categoricals, ids and counts 32-bit
+# integers (nullable Int32 where the column has gaps) and calendar dates Arrow date32. The values are
+# unchanged; only the storage shrinks, which also shrinks what st.cache_data pickles and copies on every access.
+compact_frames_enabled = os.environ.get("LAUNDRIS_COMPACT_FRAMES", "1") != "0" 
+
+category_columns = ['item_type_name', 'location_type', 'last_seen_location_name', 'last_operation', 'side', 'status'] 
+int32_columns = ['pickup_count', 'dropoff_count', 'total_washes', 'inactive_time', 'item_type_id', 'location_id', 
+                 'last_seen_location_id', 'location_customer_id', 'binrfids_id', 'pickup_order_id', 'dropoff_order_id'] 
+date_columns = ['last_scan_date', 'last_pickup_date', 'last_dropoff_date'] 
+
+
+def fits_int32(values): 
+    if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values): 
+        return False 
+    values = values.dropna() 
+    if values.empty: 
+        return True 
+    int32 = np.iinfo(np.int32) 
+    return bool((values % 1 == 0).all() and values.min() >= int32.min and values.max() <= int32.max) 
+
+
+def compact_frame(df): 
+    if df is None: 
+        return None 
+
+    columns = {} 
+    for column in df.columns: 
+        values = df[column] 
+        if column in category_columns and values.dtype == object: 
+            columns[column] = values.astype('category') 
+        elif column in int32_columns and fits_int32(values): 
+            columns[column] = values.astype('int32' if values.notna().all() else 'Int32') 
+        elif column in date_columns and values.dtype == object: 
+            columns[column] = values.astype(pd.ArrowDtype(pa.date32())) 
+
+    return df.assign(**columns) 
+
+
+def compact_frames(frames): 
+    return tuple(compact_frame(df) for df in frames) 
+
+
+# Seconds a fetch_data result stays cached; unset keeps it for the life of the process, except in incremental
+# mode, whose snapshot is only refreshed when the cached result expires
+fetch_data_ttl = os.environ.get("LAUNDRIS_FETCH_TTL") or ("300" if os.environ.get("LAUNDRIS_FETCH_MODE") == "incremental" else None) 
+fetch_data_ttl = float(fetch_data_ttl) if fetch_data_ttl else None 
+
+
+def load_customer_frames(customer_id, include_exploded=False): 
+    frames = get_backend().customer_frames(customer_id, include_exploded) 
+    if not compact_frames_enabled: 
+        return frames 
+    with instrumentation.span("pandas.compact_frames", rows_in=len(frames[1])) as span: 
+        frames = compact_frames(frames) 
+        span.rows_out = len(frames[1]) 
+    return frames 
+
+
+def read_customer_frames(customer_id, include_exploded=False): 
+    # The incremental snapshot and streaming never materialize the exploded frame, so a request for it takes the regular path
+    if os.environ.get("LAUNDRIS_FETCH_MODE") == "incremental" and not include_exploded: 
+        import incremental  # imported here because incremental builds on this module 
+        return incremental.refresh_customer(customer_id) 
+
+    if os.environ.get("LAUNDRIS_FETCH_MODE") == "streaming" and not include_exploded: 
+        return stream_customer_frames(customer_id) 
+
+    # LAUNDRIS_FETCH_WORKERS=1 keeps the original sequential reads on a single connection
+    fetch_workers = int(os.environ.get("LAUNDRIS_FETCH_WORKERS", "0")) 
+    if fetch_workers == 1: 
+        with connection() as conn: 
+            tables = read_customer_tables(customer_id, conn) 
+    else: 
+        tables = read_customer_tables_concurrent(customer_id, max_workers=fetch_workers or None) 
+
+    return build_order_cycle_frames(tables, customer_id, include_exploded)
+
+
+fetch_data_frame_names = ["df", "pickup_dropoff_count_df", "inactive_status_df"] 
+
+
+def cached_frames(frames): 
+    # The frames of a fetch_data result that go into the disk cache; the exploded one is None unless requested
+    return {name: df for name, df in zip(fetch_data_frame_names, frames) if df is not None} 
+
+
+@st.cache_data(ttl=fetch_data_ttl)
+def fetch_data(customer_id, include_exploded=False):
+    # In-process cache first (st.cache_data), then the on-disk cache every worker on the host reads (each into its
+    # own memory), then the database.
+    # The exploded rfid x bin x order frame (the first one) is None unless include_exploded is set.
+    return fetch_frames(customer_id, include_exploded) 
+
+
+def fetch_frames(customer_id, include_exploded=False):
+    # fetch_data without st.cache_data, for batch jobs: the on-disk cache, then the database. An incremental
+    # snapshot keeps its own disk copy and applies deltas on top of it; an entry here would hide them for cache_ttl.
+    incremental_read = os.environ.get("LAUNDRIS_FETCH_MODE") == "incremental" and not include_exploded 
+    use_disk_cache = disk_cache.enabled() and not incremental_read 
+    key = disk_cache.fetch_data_key(customer_id, source=backend_name) 
+    names = fetch_data_frame_names if include_exploded else fetch_data_frame_names[1:] 
+
+    if use_disk_cache: 
+        with instrumentation.span("cache.disk_load") as span: 
+            frames = disk_cache.load_frames(key, names) 
+            span.rows_out = None if frames is None or "pickup_dropoff_count_df" not in frames else len(frames["pickup_dropoff_count_df"]) 
+        if frames is not None and all(name in frames for name in names): 
+            return tuple(frames.get(name) for name in fetch_data_frame_names) 
+        # A frame the entry does not hold (the exploded one) is a miss: the read below stores the entry again with it 
+
+    result = load_customer_frames(customer_id, include_exploded) 
+
+    if use_disk_cache: 
+        with instrumentation.span("cache.disk_store", rows_in=len(result[1])): 
+            disk_cache.store_frames(key, cached_frames(result)) 
+
+    return result 
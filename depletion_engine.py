@@ -0,0 +1,369 @@
+import calendar
+import datetime
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import prediction_model as ml
+
+
+# Results kept per process; one entry per (customer_id, data version, date)
+max_cached_results = int(os.environ.get("LAUNDRIS_ENGINE_CACHE_SIZE", "32"))
+
+# Months before / after the current one in the par-level forecast
+default_months_back = int(os.environ.get("LAUNDRIS_PAR_MONTHS_BACK", "2"))
+default_months_forward = int(os.environ.get("LAUNDRIS_PAR_MONTHS_FORWARD", "2"))
+
+inactive_days = 90
+
+# A lost item is counted as lost in the 30-day window that starts this many days after it was last seen
+lost_after_days = 110
+
+
+def get_rounded_value(value):
+    return float('{:.2f}'.format(value))
+
+
+def month_horizon(today, back=2, forward=2):
+    # Year-month periods from `back` months before today's month to `forward` months after it
+    current_period = pd.Period(today, freq='M')
+    return [current_period + offset for offset in range(-back, forward + 1)]
+
+
+def month_labels(periods):
+    # Month names, with the year once the horizon is longer than 12 months
+    label_format = '%B' if len(periods) <= 12 else '%B %Y'
+    return [period.strftime(label_format) for period in periods]
+
+
+def ragout_periods(predicted_ragout_time, today):
+    # Year-month in which each item is predicted to ragout, counting the days from a single reference date
+    days = pd.to_timedelta(pd.Series(predicted_ragout_time, dtype='float64'), unit='D')
+    return (pd.Timestamp(today) + days).dt.to_period('M')
+
+
+month_name_lookup = np.array([''] + [calendar.month_name[month] for month in range(1, 13)], dtype=object)
+
+
+def month_names(periods):
+    return month_name_lookup[periods.dt.month.fillna(0).astype(int).to_numpy()]
+
+
+def count_by(df, column, names):
+    values = df[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Count the codes so unused categories are left out and ties keep their order of appearance, as for strings
+        codes = values.cat.codes
+        counts = codes[codes >= 0].value_counts()
+        counts.index = values.cat.categories[counts.index.to_numpy()]
+    else:
+        counts = values.value_counts()
+    group = counts.reset_index()
+    group.columns = names
+    return group
+
+
+@dataclass
+class DepletionResult:
+    # Every table the dashboard renders for one customer; frames are shared between reruns, copy before mutating
+    customer_id: int
+    today: datetime.date
+    total_items: int
+    inactive_items: pd.DataFrame          # inactive for more than 90 days, with prediction / predicted_ragout / Label
+    active_items: pd.DataFrame            # with predicted_ragout_time, ragout_period (year-month) and ragout_month (its name)
+    ragout_items: pd.DataFrame
+    normal_items: pd.DataFrame            # with predicted_ragout_time, ragout_period and ragout_month when there are any
+    lost_items: pd.DataFrame
+    label_heatmap: pd.DataFrame           # item type x Lost / Ragout / Normal counts
+    ragout_by_item_type: pd.DataFrame
+    ragout_by_last_operation: pd.DataFrame
+    normal_by_item_type: pd.DataFrame
+    normal_by_last_operation: pd.DataFrame
+    lost_by_item_type: pd.DataFrame
+    lost_by_last_operation: pd.DataFrame
+    lost_by_location: pd.DataFrame
+    active_by_last_operation: pd.DataFrame
+    par_forecast: pd.DataFrame            # one row per item type and month: lost, ragout, available, desired quantity, par level
+    item_heatmap: pd.DataFrame            # par_forecast pivoted to one row per item type, with "<month> Lost Items" style columns
+    par_heatmap: pd.DataFrame             # item type x month par level (%)
+    availability_heatmap: pd.DataFrame    # item type x month available items
+    interval_names: list                  # month labels, oldest first
+
+    @property
+    def n_inactive(self):
+        return self.inactive_items.shape[0]
+
+    @property
+    def n_ragout(self):
+        return self.ragout_items.shape[0]
+
+    @property
+    def n_normal(self):
+        return self.normal_items.shape[0]
+
+    @property
+    def n_lost(self):
+        return self.lost_items.shape[0]
+
+    @property
+    def p_inactive(self):
+        return self.n_inactive / self.total_items * 100
+
+    @property
+    def p_depletion(self):
+        return (self.n_ragout + self.n_lost) / self.total_items
+
+
+def par_level_forecast(order_cycle_df, ragout_df, lost_df, normal_items_df, inactive_status_df, desired_quantity_df,
+                       today, months_back=2, months_forward=2):
+    # Lost, ragout and available items and par level per item type for every month of the horizon. Each counted
+    # item becomes one (item type, kind, month offset) event; the events are counted in a single groupby and every
+    # month is then derived with array arithmetic, so the cost does not grow with the number of months.
+    #   past months:    available = total - lost up to that month
+    #   current month:  available = total - all lost - current ragout - predicted to ragout this month
+    #   future months:  available = current available - predicted ragouts up to that month
+    # Lost items of future months are projected as the average of the past and current months.
+    periods = month_horizon(today, months_back, months_forward)
+    offsets = np.arange(-months_back, months_forward + 1)
+    interval_names = month_labels(periods)
+    current = months_back
+    reference_date = pd.Timestamp(today, tz='UTC')
+
+    # Lost items by the 30-day window they went missing in; the oldest month collects everything before it
+    lost_age = lost_df['inactive_time'].to_numpy(dtype=float) - lost_after_days
+    lost_offset = -np.clip(np.ceil(lost_age / 30) - 1, 0, months_back)
+
+    # Items already in ragout status: the last 60 days count for the previous month, then 30 days per month
+    days_ago = ((reference_date - inactive_status_df['ragout_date']).dt.total_seconds() / 86400).to_numpy(dtype=float)
+    past_ragout_offset = -np.maximum(np.ceil(days_ago / 30) - 1, 1)
+    past_ragout = (days_ago > 0) & (past_ragout_offset >= -months_back)
+
+    predicted_offset = normal_items_df['ragout_period'].array.asi8 - periods[current].ordinal
+    predicted = normal_items_df['ragout_period'].notna().to_numpy() & (predicted_offset >= 0) & (predicted_offset <= months_forward)
+
+    events = pd.concat([
+        pd.DataFrame({'item_type_name': lost_df['item_type_name'].to_numpy(), 'kind': 'lost', 'offset': lost_offset}),
+        pd.DataFrame({'item_type_name': ragout_df['item_type_name'].to_numpy(), 'kind': 'ragout', 'offset': 0}),
+        pd.DataFrame({'item_type_name': inactive_status_df['item_type_name'].to_numpy()[past_ragout], 'kind': 'ragout', 'offset': past_ragout_offset[past_ragout]}),
+        pd.DataFrame({'item_type_name': normal_items_df['item_type_name'].to_numpy()[predicted], 'kind': 'predicted', 'offset': predicted_offset[predicted]}),
+        pd.DataFrame({'item_type_name': normal_items_df.loc[normal_items_df.side == 'facility', 'item_type_name'].to_numpy(), 'kind': 'facility', 'offset': 0}),
+    ], ignore_index=True)
+    events['offset'] = events['offset'].astype(int)
+    counts = events.groupby(['item_type_name', 'kind', 'offset']).size().unstack(['kind', 'offset'])
+
+    item_types_df = count_by(order_cycle_df, 'item_type_name', ['Item Type', 'Total Items Count'])
+    item_types_df = pd.merge(item_types_df, desired_quantity_df, on='Item Type')
+    counts = counts.reindex(index=item_types_df['Item Type'], columns=pd.MultiIndex.from_product([['lost', 'ragout', 'predicted', 'facility'], offsets]))
+    counts = counts.fillna(0).astype(int)
+
+    lost = counts['lost'].to_numpy()
+    ragout = counts['ragout'].to_numpy()
+    predicted = counts['predicted'].to_numpy()
+    total = item_types_df['Total Items Count'].to_numpy()[:, None]
+    desired = item_types_df['Desired Quantity'].to_numpy(dtype=float)[:, None]
+
+    available = np.empty_like(lost)
+    available[:, :current] = total - np.cumsum(lost, axis=1)[:, :current]
+    available[:, current] = total[:, 0] - lost.sum(axis=1) - ragout[:, current] - predicted[:, current]
+    available[:, current + 1:] = available[:, [current]] - np.cumsum(predicted[:, current + 1:], axis=1)
+
+    ragout[:, current + 1:] = predicted[:, current + 1:]
+    lost[:, current + 1:] = np.ceil(lost[:, :current + 1].sum(axis=1) / (current + 1)).astype(int)[:, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        par = np.vectorize(get_rounded_value, otypes=[float])(available / desired * 100)
+
+    n_item_types, n_months = lost.shape
+    par_forecast = pd.DataFrame({
+        'item_type_name': np.repeat(item_types_df['Item Type'].to_numpy(), n_months),
+        'period': np.tile(np.array(periods, dtype=object), n_item_types),
+        'month': np.tile(interval_names, n_item_types),
+        'lost': lost.ravel(),
+        'ragout': ragout.ravel(),
+        'available': available.ravel(),
+        'desired_quantity': np.repeat(desired[:, 0], n_months),
+        'par_level': par.ravel(),
+    })
+
+    item_heatmap_columns = {
+        'Item Type': item_types_df['Item Type'].to_numpy(),
+        'Total Items Count': item_types_df['Total Items Count'].to_numpy(),
+        'On Facility Items Count': counts[('facility', 0)].to_numpy(),
+        'Desired Quantity': desired[:, 0],
+    }
+    for i, name in enumerate(interval_names):
+        item_heatmap_columns[f'{name} Lost Items'] = lost[:, i]
+        item_heatmap_columns[f'{name} Ragout Items'] = ragout[:, i]
+        item_heatmap_columns[f'Available Items ({name})'] = available[:, i]
+        item_heatmap_columns[f'Par level ({name})'] = par[:, i]
+
+    return {
+        'par_forecast': par_forecast,
+        'item_heatmap': pd.DataFrame(item_heatmap_columns),
+        'par_heatmap': pd.DataFrame(par, index=item_types_df['Item Type'].rename('Item Type'), columns=interval_names),
+        'availability_heatmap': pd.DataFrame(available, index=item_types_df['Item Type'].rename('Item Type'),
+                                             columns=[f'Available Items ({name})' for name in interval_names]),
+        'interval_names': interval_names,
+    }
+
+
+def compute_depletion(customer_id, order_cycle_df, inactive_status_df, desired_quantity_df, today, months_back=None, months_forward=None):
+    # Labels every item, predicts ragout times and builds the par-level tables from fetch_data's
+    # pickup_dropoff_count_df / inactive_status_df and get_desired_quantity's output. No Streamlit calls.
+    months_back = default_months_back if months_back is None else months_back
+    months_forward = default_months_forward if months_forward is None else months_forward
+    reference_date = pd.Timestamp(today, tz='UTC')
+    total_items = order_cycle_df.shape[0]
+
+    active_items_df = order_cycle_df[order_cycle_df.inactive_time <= inactive_days].copy()
+    inactive_df = order_cycle_df[order_cycle_df.inactive_time > inactive_days].copy()
+    active_items_df['customer_id'] = customer_id
+    inactive_df['customer_id'] = customer_id
+
+    # Predict ragout [current state] and ragout time for every item in one pass
+    with instrumentation.span("engine.score_items", rows_in=total_items) as span:
+        scored_df = ml.score_items(order_cycle_df, customer_id, inactive_days)
+        span.rows_out = scored_df.shape[0]
+    inactive_df = pd.merge(inactive_df, scored_df[['rfid_id', 'prediction', 'predicted_ragout', 'Label']], on='rfid_id', how='inner')
+
+    active_items_df['usage_period'] = (reference_date - active_items_df['creation_date']).dt.days
+    inactive_df['usage_period'] = (reference_date - inactive_df['creation_date']).dt.days
+
+    inactive_df['creation_date'] = inactive_df['creation_date'].dt.date
+    inactive_df['last_updated_date'] = inactive_df['last_updated_date'].dt.date
+    inactive_df['birthday'] = inactive_df['birthday'].dt.date
+
+    ragout_df = inactive_df[inactive_df.Label == 'ragout']
+    normal_df = inactive_df[inactive_df.Label == 'normal']
+    lost_df = inactive_df[inactive_df.Label == 'lost']
+    n_ragout, n_normal, n_lost = ragout_df.shape[0], normal_df.shape[0], lost_df.shape[0]
+
+    # Item type x label counts
+    depletion_grouped_data = inactive_df.groupby(['item_type_name', 'Label'], observed=True).size().reset_index(name='count')
+    heatmap_pivot_table = depletion_grouped_data.pivot(index='item_type_name', columns='Label', values='count')
+    heatmap_pivot_table.fillna(0, inplace=True)
+    # A label no item got has no column; small customers can miss more than one
+    if n_ragout == 0:
+        heatmap_pivot_table['ragout'] = 0
+    if n_lost == 0:
+        heatmap_pivot_table['lost'] = 0
+    if n_normal == 0:
+        heatmap_pivot_table['normal'] = 0
+    heatmap_pivot_table.rename(columns={"lost": "Lost", "normal": "Normal", "ragout": "Ragout"}, inplace=True)
+    heatmap_pivot_table = heatmap_pivot_table[['Lost', 'Ragout', 'Normal']]
+
+    ragout_group = count_by(ragout_df, 'item_type_name', ['Item Type', 'Items Count'])
+    normal_group = count_by(normal_df, 'item_type_name', ['Item Type', 'Items Count'])
+    lost_group = count_by(lost_df, 'item_type_name', ['Item Type', 'Items Count'])
+
+    # Active items (inactive for less than 90 days) and normal items get a predicted ragout month
+    active_items_df = pd.merge(active_items_df, scored_df[['rfid_id', 'predicted_ragout_time']], on='rfid_id', how='inner')
+    if n_normal > 0:
+        normal_df = pd.merge(normal_df, scored_df[['rfid_id', 'predicted_ragout_time']], on='rfid_id', how='inner')
+        # .array keeps the period dtype, which to_numpy() loses on an empty frame
+        normal_df['ragout_period'] = ragout_periods(normal_df['predicted_ragout_time'], today).array
+        normal_df['ragout_month'] = month_names(normal_df['ragout_period'])
+    active_items_df['ragout_period'] = ragout_periods(active_items_df['predicted_ragout_time'], today).array
+    active_items_df['ragout_month'] = month_names(active_items_df['ragout_period'])
+
+    columns = ['rfid_id', 'item_type_name', 'side', 'last_operation', 'ragout_period', 'ragout_month', 'predicted_ragout_time']
+    if n_normal > 0:
+        normal_items_df = pd.concat([normal_df[columns], active_items_df[columns]])
+    else:
+        normal_items_df = active_items_df[columns]
+
+    with instrumentation.span("engine.par_level_forecast", rows_in=normal_items_df.shape[0]) as span:
+        forecast = par_level_forecast(order_cycle_df, ragout_df, lost_df, normal_items_df, inactive_status_df, desired_quantity_df,
+                                      today, months_back, months_forward)
+        span.rows_out = forecast['par_forecast'].shape[0]
+
+    return DepletionResult(
+        customer_id=customer_id,
+        today=today,
+        total_items=total_items,
+        inactive_items=inactive_df,
+        active_items=active_items_df,
+        ragout_items=ragout_df,
+        normal_items=normal_df,
+        lost_items=lost_df,
+        label_heatmap=heatmap_pivot_table,
+        ragout_by_item_type=ragout_group,
+        ragout_by_last_operation=count_by(ragout_df, 'last_operation', ['Last Operation', 'Items Count']),
+        normal_by_item_type=normal_group,
+        normal_by_last_operation=count_by(normal_df, 'last_operation', ['Last Operation', 'Items Count']),
+        lost_by_item_type=lost_group,
+        lost_by_last_operation=count_by(lost_df, 'last_operation', ['Last Operation', 'Items Count']),
+        lost_by_location=count_by(lost_df, 'location_type', ['Location', 'Count']),
+        active_by_last_operation=count_by(active_items_df, 'last_operation', ['Last Operation', 'Items Count']),
+        **forecast,
+    )
+
+
+def data_version(*frames):
+    # Content hash of the engine inputs; equal inputs give equal versions across reruns and processes
+    return tuple(int(pd.util.hash_pandas_object(df, index=False).sum()) if df.shape[0] else 0 for df in frames) + \
+        tuple(tuple(df.columns) for df in frames)
+
+
+class DepletionEngine:
+    # Memoizes compute_depletion on (customer_id, data version, date, horizon), so Streamlit reruns and
+    # batch jobs that see unchanged inputs reuse the result instead of re-scoring every item.
+    def __init__(self, max_entries=None):
+        self.max_entries = max_cached_results if max_entries is None else max_entries
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def run(self, customer_id, order_cycle_df, inactive_status_df, desired_quantity_df, today=None, version=None, months_back=None, months_forward=None):
+        today = today or datetime.date.today()
+        months_back = default_months_back if months_back is None else months_back
+        months_forward = default_months_forward if months_forward is None else months_forward
+        if version is None:
+            with instrumentation.span("engine.data_version", rows_in=order_cycle_df.shape[0]):
+                version = data_version(order_cycle_df, inactive_status_df, desired_quantity_df)
+        key = (customer_id, version, today, months_back, months_forward)
+
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.results[key]
+            self.stats["misses"] += 1
+
+        with instrumentation.span("engine.compute_depletion", rows_in=order_cycle_df.shape[0]) as span:
+            result = compute_depletion(customer_id, order_cycle_df, inactive_status_df, desired_quantity_df, today, months_back, months_forward)
+            span.rows_out = result.total_items
+
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+        return result
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def engine_metrics():
+    if _engine is None:
+        return []
+    with _engine.lock:
+        stats = dict(_engine.stats, entries=len(_engine.results))
+    return instrumentation.stats_lines("laundris_engine_cache", "Depletion result cache counters", stats)
+
+
+instrumentation.collectors.append(engine_metrics)
+
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = DepletionEngine()
+    return _engine
@@ -0,0 +1,95 @@
+import math
+import os
+
+import numpy as np
+import streamlit as st
+
+import instrumentation
+
+
+# Item detail tables that keep the frame on the server: search, filters and sort run in pandas and only the
+# visible page is sent to st.dataframe (and styled), instead of every row of a 100k-item customer.
+page_size = int(os.environ.get("LAUNDRIS_TABLE_PAGE_SIZE", "100"))
+
+# Columns offered as filters when the table has them
+filter_columns = ['Label', 'item_type_name', 'last_operation']
+
+
+def matching_rows(df, search=None, filters=None):
+    # Positions of the rows whose rfid_id contains `search` (case-insensitive) and that pass every filter (column -> values)
+    mask = np.ones(df.shape[0], dtype=bool)
+    if search:
+        mask &= df['rfid_id'].astype(str).str.contains(search.strip(), case=False, regex=False).to_numpy()
+    for column, values in (filters or {}).items():
+        if values:
+            mask &= df[column].isin(values).to_numpy()
+    return np.flatnonzero(mask)
+
+
+def sort_rows(df, positions, sort_by=None, descending=False):
+    # Sorts only the key column, stable, with missing values last
+    if sort_by is None:
+        return positions
+    order = df[sort_by].iloc[positions].reset_index(drop=True).sort_values(ascending=not descending, kind='stable', na_position='last').index
+    return positions[order.to_numpy()]
+
+
+def page_count(total, rows=None):
+    return max(1, math.ceil(total / (rows or page_size)))
+
+
+def query_page(df, search=None, filters=None, sort_by=None, descending=False, page=0, rows=None):
+    # Rows `page * rows` to `(page + 1) * rows` of the searched, filtered and sorted df, and the number of matching rows.
+    # A page past the last one (left over from a wider search or another customer) gives the last page
+    rows = rows or page_size
+    positions = matching_rows(df, search, filters)
+    page = min(max(page, 0), page_count(positions.shape[0], rows) - 1)
+    positions = sort_rows(df, positions, sort_by, descending)
+    return df.iloc[positions[page * rows:(page + 1) * rows]], positions.shape[0]
+
+
+def format_page(page_df, formats):
+    # formats: column -> format string applied to the displayed values, e.g. {'predicted_ragout_time': '{} days'};
+    # missing values are left as empty cells
+    for column, fmt in (formats or {}).items():
+        if column in page_df.columns:
+            prefix, suffix = fmt.split('{}')
+            values = page_df[column]
+            page_df[column] = (prefix + values.astype(str) + suffix).where(values.notna().to_numpy(), '')
+    return page_df
+
+
+def show(container, name, df, columns, cell_style=None, styled_columns=('Label',), formats=None):
+    # Renders df[columns] one page at a time under container; widget state is kept per table name
+    with instrumentation.span(f"table.{name}", rows_in=df.shape[0]) as span:
+        search_col, filter_col, sort_col, order_col, page_col = container.columns((3, 3, 2, 1, 1))
+        search = search_col.text_input("Search rfid_id", key=f"{name}_search")
+
+        available_filters = [column for column in filter_columns if column in columns]
+        filters = {}
+        for column in available_filters:
+            options = sorted(df[column].dropna().unique().tolist(), key=str)
+            filters[column] = filter_col.multiselect(f"Filter {column}", options, key=f"{name}_filter_{column}")
+
+        sort_by = sort_col.selectbox("Sort by", columns, index=None, placeholder="Original order", key=f"{name}_sort")
+        descending = order_col.checkbox("Descending", key=f"{name}_descending")
+
+        # Page numbers start at 1 in the widget; a stale page (after a new search or customer) is clamped
+        page_key = f"{name}_page"
+        page_df, total = query_page(df, search, filters, sort_by, descending, page=st.session_state.get(page_key, 1) - 1)
+        n_pages = page_count(total)
+        if st.session_state.get(page_key, 1) > n_pages:
+            st.session_state[page_key] = n_pages
+        page = page_col.number_input("Page", min_value=1, max_value=n_pages, step=1, key=page_key)
+
+        first = (page - 1) * page_size
+        page_df = format_page(page_df[columns].copy(), formats)
+        span.rows_out = page_df.shape[0]
+
+    container.caption(f"Rows {first + 1 if total else 0:,}–{first + page_df.shape[0]:,} of {total:,}"
+                      + (f" (of {df.shape[0]:,} items)" if total != df.shape[0] else ""))
+
+    # Only the visible rows are styled and serialized
+    table = page_df.style.applymap(cell_style, subset=[c for c in styled_columns if c in columns]) if cell_style else page_df
+    with instrumentation.span(f"render.{name}", rows_in=page_df.shape[0]):
+        container.dataframe(table, use_container_width=True, hide_index=True)
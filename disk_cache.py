@@ -0,0 +1,228 @@
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+import pyarrow as pa
+
+
+logger = logging.getLogger(__name__)
+
+# One directory for every Streamlit worker on the host, kept across restarts and redeploys; each reader loads its
+# own copy of the frames
+cache_dir = os.environ.get("LAUNDRIS_CACHE_DIR", os.path.join(".cache", "laundris"))
+cache_ttl = float(os.environ.get("LAUNDRIS_CACHE_TTL", str(6 * 3600)))
+cache_max_bytes = int(float(os.environ.get("LAUNDRIS_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+
+
+def enabled():
+    return os.environ.get("LAUNDRIS_DISK_CACHE", "1") != "0"
+
+
+# An entry is a directory holding immutable version directories and a `current` file naming the live one. A store
+# writes a new version and swaps the pointer with os.replace, so readers see either the old or the new entry.
+pointer_name = "current"
+stale_tmp_age = 3600
+# A replaced version is removed this many seconds after the version that replaced it was written, so a reader that
+# resolved the pointer just before a burst of stores still finds its version. A reader that loses it anyway (a
+# version older than the grace age) reads the pointer again
+superseded_grace = 60
+load_attempts = 3
+
+
+def entry_path(key):
+    return os.path.join(cache_dir, *[str(part) for part in key])
+
+
+def current_version(path):
+    try:
+        with open(os.path.join(path, pointer_name)) as pointer:
+            version = pointer.read().strip()
+    except OSError:
+        return None
+    return os.path.join(path, version) if version else None
+
+
+def version_age(version_path):
+    # Frame files are written once, so their mtime is the creation time of the version
+    try:
+        mtimes = [os.path.getmtime(os.path.join(version_path, name)) for name in os.listdir(version_path) if name.endswith(".arrow")]
+    except OSError:
+        return None
+    return time.time() - min(mtimes) if mtimes else None
+
+
+def entry_age(path):
+    version_path = current_version(path)
+    return None if version_path is None else version_age(version_path)
+
+
+def remove_entry(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def restore_missing_dates(df, schema):
+    # Arrow turns NaT in a column of datetime.date objects into null, which to_pandas returns as None
+    for field in schema:
+        if pa.types.is_date(field.type) and field.name in df.columns and df[field.name].dtype == object:
+            df[field.name] = df[field.name].where(df[field.name].notna(), pd.NaT)
+    return df
+
+
+def read_version(version_path, names):
+    # An entry may hold fewer frames than requested (fetch_data only stores the exploded frame when asked for it);
+    # the frames it does hold are returned, and the caller decides what a missing one means
+    frames = {}
+    for name in names:
+        if not os.path.exists(os.path.join(version_path, f"{name}.arrow")):
+            continue
+        # to_pandas copies the columns into this process; the memory map only saves a read into a buffer first
+        with pa.memory_map(os.path.join(version_path, f"{name}.arrow"), "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+            frames[name] = restore_missing_dates(table.to_pandas(), table.schema)
+    return frames
+
+
+def load_frames(key, names):
+    path = entry_path(key)
+    for _ in range(load_attempts):
+        version_path = current_version(path)
+        if version_path is None:
+            return None
+
+        # Expired entries are left to evict(), which runs after the store that replaces them
+        age = version_age(version_path)
+        if age is None and not os.path.isdir(version_path):
+            continue
+        if age is None or age > cache_ttl:
+            return None
+
+        try:
+            frames = read_version(version_path, names)
+        except pa.ArrowInvalid:
+            if current_version(path) != version_path:
+                continue
+            logger.warning("dropping unreadable cache entry %s", version_path, exc_info=True)
+            remove_entry(version_path)
+            return None
+        except OSError:
+            # The version was replaced and removed while it was being read: read the new one
+            continue
+        # A frame file that vanished mid-read looks like a frame the entry never had
+        if not os.path.isdir(version_path):
+            continue
+
+        # The directory mtime records the last access and drives LRU eviction
+        os.utime(path)
+        return frames
+    return None
+
+
+def version_time(name):
+    # Versions are named v-<time_ns>-<suffix>
+    try:
+        return int(name.split("-")[1]) / 1e9
+    except (IndexError, ValueError):
+        return 0.0
+
+
+def remove_old_versions(path, current):
+    # A version goes once the one after it is superseded_grace seconds old; the current one always stays
+    versions = sorted((name for name in os.listdir(path) if name.startswith("v-")), key=version_time)
+    replaced_at = {name: version_time(newer) for name, newer in zip(versions, versions[1:])}
+    for name in os.listdir(path):
+        version_path = os.path.join(path, name)
+        try:
+            if name.startswith("v-"):
+                stale = name != current and time.time() - replaced_at.get(name, time.time()) > superseded_grace
+            else:
+                # Temp files and directories are only old when a writer died mid-store
+                stale = name.startswith(".tmp-") and time.time() - os.path.getmtime(version_path) > stale_tmp_age
+            if stale:
+                if os.path.isdir(version_path):
+                    remove_entry(version_path)
+                else:
+                    os.remove(version_path)
+        except OSError:
+            # Another writer cleaned it up first
+            pass
+
+
+def store_frames(key, frames):
+    path = entry_path(key)
+    os.makedirs(path, exist_ok=True)
+
+    # Written into a temp directory, renamed to a new version and then made current, so readers never see a
+    # partial or missing entry
+    tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=path)
+    try:
+        for name, df in frames.items():
+            table = pa.Table.from_pandas(df)
+            with pa.OSFile(os.path.join(tmp_path, f"{name}.arrow"), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+        version = f"v-{time.time_ns()}-{os.path.basename(tmp_path)[len('.tmp-'):]}"
+        os.rename(tmp_path, os.path.join(path, version))
+
+        pointer_fd, pointer_tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=path)
+        with os.fdopen(pointer_fd, "w") as pointer:
+            pointer.write(version)
+        os.replace(pointer_tmp_path, os.path.join(path, pointer_name))
+    except (OSError, pa.ArrowException, TypeError, ValueError):
+        # A column could not be converted or the disk is full; skip caching
+        logger.warning("could not store cache entry %s", path, exc_info=True)
+        remove_entry(tmp_path)
+        return False
+
+    # The versions it replaced are kept for superseded_grace seconds, for readers that picked them up before the swap
+    remove_old_versions(path, current=version)
+    evict()
+    return True
+
+
+def entry_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def evict(max_bytes=None):
+    max_bytes = cache_max_bytes if max_bytes is None else max_bytes
+
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        if pointer_name in files:
+            entries.append((os.path.getmtime(root), entry_size(root), root))
+            dirs[:] = []
+            continue
+        # Entries written before entries were versioned are never read again
+        if any(name.endswith(".arrow") for name in files) and not os.path.basename(root).startswith(("v-", ".tmp-")):
+            remove_entry(root)
+            dirs[:] = []
+            continue
+        # Left behind by a writer that died mid-store
+        for name in [d for d in dirs if d.startswith(".tmp-")]:
+            if time.time() - os.path.getmtime(os.path.join(root, name)) > stale_tmp_age:
+                remove_entry(os.path.join(root, name))
+        dirs[:] = [d for d in dirs if not d.startswith(".tmp-")]
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for last_access, size, path in sorted(entries):
+        age = entry_age(path)
+        if total_bytes <= max_bytes and age is not None and age <= cache_ttl:
+            continue
+        remove_entry(path)
+        total_bytes -= size
+
+    return total_bytes
+
+
+def fetch_data_key(customer_id, data_date=None, source="postgres"):
+    # fetch_data's inactive_time is relative to today, so an entry is only valid for the day it was built.
+    # Frames read from a local snapshot (embedded backend) are kept apart from the database's.
+    data_date = data_date or datetime.date.today()
+    if source != "postgres":
+        return ("fetch_data", source, f"customer_{customer_id}", data_date.isoformat())
+    return ("fetch_data", f"customer_{customer_id}", data_date.isoformat())
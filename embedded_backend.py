@@ -0,0 +1,298 @@
+import argparse
+import datetime
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+import pandas as pd
+
+import database as db
+import instrumentation
+
+
+# Embedded analytical backend (LAUNDRIS_BACKEND=duckdb / sqlite / embedded): the production tables are loaded
+# from a local snapshot, one Parquet file per table, into DuckDB (or SQLite when DuckDB is not installed), and
+# fetch_data's joins and per-RFID aggregation run inside that engine. Snapshots come from the database or from
+# synthetic_data:
+#   python embedded_backend.py export --customers 45 52
+#   python embedded_backend.py synthetic --tags 100000
+
+snapshot_dir = os.environ.get("LAUNDRIS_SNAPSHOT_DIR", os.path.join(".cache", "snapshot"))
+
+# The columns the dashboard's queries read, per table
+snapshot_columns = {
+    "customer": ["customer_id", "customer_name", "status", "customer_type", "entity_type", "par_level"],
+    "customer_customerinventoryitemtype": ["id", "customer_id", "customer_item_type_name", "ideal_par_level"],
+    "customer_roomprofile": ["customer_room_type_id", "customer_item_type_id", "item_quantity"],
+    "customer_hotelprofile": ["customer_id", "customer_room_type_id", "quantity"],
+    "inventory_location": ["id", "name", "location_type", "customer_id", "side"],
+    "rfid": ["rfid_id", "customer_id", "creation_date", "last_updated_date", "status", "ragout_date", "total_washes",
+             "last_scan_date", "item_type_id", "last_seen_location_id", "location_id", "birthday"],
+    "order_order": ["id", "customer_id", "actual_pickup_date", "actual_dropoff_date", "incoming_total_weight"],
+    "order_binrfids_rfids": ["binrfids_id", "rfid_id"],
+    "order_order_pickup_bins": ["binrfids_id", "order_id"],
+    "order_order_dropoff_bins": ["binrfids_id", "order_id"],
+}
+
+snapshot_indexes = {
+    "rfid": ["customer_id", "rfid_id"],
+    "order_order": ["id"],
+    "order_binrfids_rfids": ["rfid_id", "binrfids_id"],
+    "order_order_pickup_bins": ["binrfids_id"],
+    "order_order_dropoff_bins": ["binrfids_id"],
+    "customer_hotelprofile": ["customer_id"],
+}
+
+# timestamptz columns; SQLite has no timestamp type, so it stores them as UTC microseconds since the epoch
+# (Postgres' resolution, and exact even when a column with NULLs comes back as float64)
+timestamp_columns = {"creation_date", "last_updated_date", "ragout_date", "last_scan_date", "birthday",
+                     "actual_pickup_date", "actual_dropoff_date", "last_pickup_date", "last_dropoff_date"}
+
+# summarize_order_cycles in SQL, over the same rfid x bin x pickup/dropoff order rows explode_order_cycles builds.
+# An RFID's last operation is that of its latest bin (highest binrfids_id, as in the streaming read), and its
+# latest pickup ties are broken in the same row order.
+order_cycle_summary_sql = """
+    WITH events AS (
+        SELECT r.rfid_id, b.binrfids_id, p.order_id AS pickup_order_id, po.actual_pickup_date AS last_pickup_date,
+               d.order_id AS dropoff_order_id, dor.actual_dropoff_date AS last_dropoff_date
+        FROM rfid r
+        LEFT JOIN order_binrfids_rfids b ON b.rfid_id = r.rfid_id
+        LEFT JOIN order_order_pickup_bins p ON p.binrfids_id = b.binrfids_id
+        LEFT JOIN order_order po ON po.id = p.order_id
+        LEFT JOIN order_order_dropoff_bins d ON d.binrfids_id = b.binrfids_id
+        LEFT JOIN order_order dor ON dor.id = d.order_id
+        WHERE r.customer_id = %(customer_id)s
+    ),
+    ranked AS (
+        SELECT *,
+               ROW_NUMBER() OVER (PARTITION BY rfid_id ORDER BY binrfids_id DESC NULLS LAST, pickup_order_id DESC NULLS LAST,
+                                                                dropoff_order_id DESC NULLS LAST) AS from_last,
+               ROW_NUMBER() OVER (PARTITION BY rfid_id ORDER BY last_pickup_date DESC NULLS LAST, binrfids_id NULLS LAST,
+                                                                pickup_order_id NULLS LAST, dropoff_order_id NULLS LAST) AS pickup_rank
+        FROM events
+    )
+    SELECT rfid_id,
+           COUNT(pickup_order_id) AS pickup_count,
+           COUNT(dropoff_order_id) AS dropoff_count,
+           MAX(CASE WHEN from_last = 1 THEN CASE WHEN pickup_order_id IS NOT NULL THEN 'pickup'
+                                                 WHEN dropoff_order_id IS NOT NULL THEN 'dropoff'
+                                                 ELSE 'No order cycle' END END) AS last_operation,
+           MAX(CASE WHEN pickup_rank = 1 THEN last_pickup_date END) AS last_pickup_date,
+           MAX(CASE WHEN pickup_rank = 1 THEN pickup_order_id END) AS pickup_order_id,
+           MAX(last_dropoff_date) AS last_dropoff_date
+    FROM ranked
+    GROUP BY rfid_id
+    ORDER BY rfid_id
+"""
+
+# database.desired_quantities_sql without Postgres arrays: the (customer, hotel) pairs are inlined as VALUES rows
+desired_quantities_sql = """
+    WITH members(customer_id, hotel_id) AS (VALUES {members})
+    SELECT m.customer_id, r.customer_item_type_id AS item_type_id, t.customer_item_type_name AS item_type_name,
+           r.item_quantity * h.quantity * COALESCE(t.ideal_par_level, c.par_level) AS desired_quantity
+    FROM members m
+    JOIN customer_hotelprofile h ON h.customer_id = m.hotel_id
+    JOIN customer_roomprofile r ON r.customer_room_type_id = h.customer_room_type_id
+    JOIN customer_customerinventoryitemtype t ON t.id = r.customer_item_type_id
+    JOIN customer c ON c.customer_id = m.customer_id
+"""
+
+
+def available_engine(engine=None):
+    # "duckdb", "sqlite", or None / "embedded" for DuckDB when it is installed and SQLite otherwise
+    if engine in (None, "embedded"):
+        try:
+            import duckdb  # noqa: F401
+            return "duckdb"
+        except ImportError:
+            return "sqlite"
+    if engine not in ("duckdb", "sqlite"):
+        raise ValueError(f"unknown embedded engine: {engine}")
+    return engine
+
+
+def snapshot_path(path, name):
+    return os.path.join(path, f"{name}.parquet")
+
+
+def snapshot_version(path):
+    # Changes whenever a snapshot file is rewritten
+    return tuple(os.path.getmtime(snapshot_path(path, name)) for name in snapshot_columns)
+
+
+def write_snapshot(tables, path=None):
+    path = path or snapshot_dir
+    os.makedirs(path, exist_ok=True)
+    for name, columns in snapshot_columns.items():
+        # Write then rename, so a backend reloading the snapshot never reads a partial file
+        tmp_file = snapshot_path(path, f".tmp-{name}")
+        tables[name][columns].to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, snapshot_path(path, name))
+    return path
+
+
+def export_snapshot(path=None, customer_ids=None):
+    # Copies the tables from the Postgres database, optionally only the rows of some customers
+    backend = db.PostgresBackend()
+    filters = {}
+    if customer_ids:
+        customers = "SELECT unnest(%(customer_ids)s::int[])"
+        hotels = "SELECT unnest(%(hotel_ids)s::int[])"
+        rfids = f"SELECT rfid_id FROM rfid WHERE customer_id IN ({customers})"
+        bins = f"SELECT binrfids_id FROM order_binrfids_rfids WHERE rfid_id IN ({rfids})"
+        filters = {
+            "customer": f"customer_id IN ({customers})",
+            # Grouped customers use the room types and item types of their group's hotels
+            "customer_customerinventoryitemtype": f"customer_id IN ({customers}) OR customer_id IN ({hotels})",
+            "customer_hotelprofile": f"customer_id IN ({customers}) OR customer_id IN ({hotels})",
+            "rfid": f"customer_id IN ({customers})",
+            "order_binrfids_rfids": f"rfid_id IN ({rfids})",
+            "order_order_pickup_bins": f"binrfids_id IN ({bins})",
+            "order_order_dropoff_bins": f"binrfids_id IN ({bins})",
+            "order_order": f"id IN (SELECT order_id FROM order_order_pickup_bins WHERE binrfids_id IN ({bins}) "
+                           f"UNION SELECT order_id FROM order_order_dropoff_bins WHERE binrfids_id IN ({bins}))",
+        }
+    hotel_ids = [hotel_id for customer_id in customer_ids or [] for hotel_id in db.customer_groups.get(customer_id, [])]
+    params = {"customer_ids": list(customer_ids or []), "hotel_ids": hotel_ids}
+
+    tables = {}
+    for name, columns in snapshot_columns.items():
+        sql = f"SELECT {', '.join(columns)} FROM {name}"
+        if name in filters:
+            sql += f" WHERE {filters[name]}"
+        tables[name] = backend.read_sql(sql, params)
+    return write_snapshot(tables, path)
+
+
+def to_sqlite(df):
+    columns = {}
+    for column in df.columns:
+        if column in timestamp_columns:
+            values = pd.to_datetime(df[column], utc=True)
+            microseconds = values.to_numpy(dtype="datetime64[us]").view("int64")
+            columns[column] = pd.Series(microseconds, index=df.index, dtype="Int64").mask(values.isna())
+    return df.assign(**columns)
+
+
+def from_engine(df, engine):
+    # Timestamps as pd.read_sql returns them from Postgres: datetime64[ns, UTC]
+    for column in df.columns:
+        if column in timestamp_columns:
+            if engine == "sqlite":
+                df[column] = pd.to_datetime(df[column], unit="us", utc=True)
+            df[column] = pd.to_datetime(df[column], utc=True).astype("datetime64[ns, UTC]")
+    return df
+
+
+class EmbeddedBackend:
+    # One in-process engine over a snapshot, shared by every session; queries are serialized on its connection
+    def __init__(self, engine=None, path=None):
+        self.engine = available_engine(engine)
+        self.name = self.engine
+        self.path = path or snapshot_dir
+        self.lock = threading.Lock()
+        self.conn = None
+        self.version = None
+        self.stats = {"loads": 0, "queries": 0}
+
+    def load(self):
+        version = snapshot_version(self.path)
+        if self.engine == "duckdb":
+            import duckdb
+            conn = duckdb.connect(":memory:")
+            conn.execute("SET TimeZone = 'UTC'")
+            for name in snapshot_columns:
+                conn.execute(f"CREATE TABLE {name} AS SELECT * FROM read_parquet(?)", [snapshot_path(self.path, name)])
+        else:
+            conn = sqlite3.connect(":memory:", check_same_thread=False)
+            for name in snapshot_columns:
+                to_sqlite(pd.read_parquet(snapshot_path(self.path, name))).to_sql(name, conn, index=False)
+            for name, columns in snapshot_indexes.items():
+                for column in columns:
+                    conn.execute(f"CREATE INDEX {name}_{column} ON {name} ({column})")
+            conn.execute("ANALYZE")
+
+        if self.conn is not None:
+            self.conn.close()
+        self.conn, self.version = conn, version
+        self.stats["loads"] += 1
+
+    def refresh(self):
+        # Reloads the snapshot when its files have changed since the last load
+        if self.conn is None or snapshot_version(self.path) != self.version:
+            self.load()
+
+    def read_sql(self, sql, params=None, name="query"):
+        # The queries are written for psycopg2 (%(name)s placeholders); both engines take named parameters
+        placeholder = "$" if self.engine == "duckdb" else ":"
+        sql = re.sub(r"%\((\w+)\)s", lambda match: placeholder + match.group(1), sql.strip().rstrip(";"))
+        params = {name: value for name, value in (params or {}).items() if (placeholder + name) in sql}
+        if self.engine == "sqlite":
+            # Timestamps are stored as microseconds since the epoch (to_sqlite)
+            params = {name: int(pd.Timestamp(value).tz_convert("UTC").value // 1000) if isinstance(value, datetime.datetime) else value
+                      for name, value in params.items()}
+
+        with self.lock:
+            self.refresh()
+            self.stats["queries"] += 1
+            with instrumentation.span(f"sql.{name}") as span:
+                if self.engine == "duckdb":
+                    df = self.conn.execute(sql, params).df()
+                else:
+                    df = pd.read_sql(sql, self.conn, params=params)
+                span.rows_out = len(df)
+        return from_engine(df, self.engine)
+
+    def customer_frames(self, customer_id, include_exploded=False):
+        queries = db.customer_table_queries()
+        params = {"customer_id": customer_id}
+
+        # The exploded frame is a pandas product, so asking for it reads the tables and runs the regular pipeline
+        if include_exploded:
+            tables = {name: self.read_sql(sql, params, name) for name, sql in queries.items()}
+            return db.build_order_cycle_frames(tables, customer_id, include_exploded=True)
+
+        tables = {name: self.read_sql(queries[name], params, name) for name in ["rfid", "item_type", "location"]}
+        order_cycle_summary_df = self.read_sql(order_cycle_summary_sql, params, "order_cycle_summary")
+        order_cycle_summary_df = order_cycle_summary_df.sort_values('rfid_id', kind='stable', ignore_index=True)
+        return db.finalize_frames(None, order_cycle_summary_df, tables, customer_id, include_exploded=False)
+
+    def desired_quantities(self, customer_ids):
+        members = [(int(customer_id), int(hotel_id)) for customer_id in customer_ids
+                   for hotel_id in db.customer_groups.get(customer_id, [customer_id])]
+        if not members:
+            return pd.DataFrame(columns=["customer_id", "item_type_id", "item_type_name", "desired_quantity"])
+        return self.read_sql(desired_quantities_sql.format(members=", ".join(f"({customer_id}, {hotel_id})" for customer_id, hotel_id in members)),
+                             name="desired_quantities")
+
+    def profile_version(self):
+        with self.lock:
+            self.refresh()
+            return hash(self.version)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Write a local snapshot for the embedded backend")
+    parser.add_argument("source", choices=["export", "synthetic"], help="copy the Postgres tables, or generate synthetic ones")
+    parser.add_argument("--path", default=snapshot_dir)
+    parser.add_argument("--customers", type=int, nargs="+", help="export: only these customers (default: every table in full)")
+    parser.add_argument("--tags", type=int, default=10_000, help="synthetic: number of RFID tags")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.source == "export":
+        path = export_snapshot(args.path, args.customers)
+    else:
+        import synthetic_data
+        path = write_snapshot(synthetic_data.generate(args.tags, seed=args.seed), args.path)
+    print(f"snapshot written to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
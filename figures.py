@@ -0,0 +1,159 @@
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objs as go
+import plotly.io as pio
+
+import instrumentation
+
+
+# The dashboard's Plotly figures, built from small aggregates and cached on a content hash of them. Distributions
+# are binned with numpy, so the browser gets one bar per bin instead of every item's value, and an unchanged view
+# reuses the figure it built before (the identical spec also lets Streamlit's message cache skip resending it).
+max_cached_figures = int(os.environ.get("LAUNDRIS_FIGURE_CACHE_SIZE", "256"))
+max_histogram_bins = int(os.environ.get("LAUNDRIS_HISTOGRAM_BINS", "60"))
+
+
+def content_hash(data):
+    # Hash of the values, labels and dtypes of a DataFrame / Series / ndarray (or a tuple of them)
+    digest = hashlib.blake2b(digest_size=16)
+    for part in data if isinstance(data, tuple) else (data,):
+        if isinstance(part, (pd.DataFrame, pd.Series)):
+            digest.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+            labels = (list(part.columns), part.columns.name, list(part.dtypes.astype(str))) if isinstance(part, pd.DataFrame) else (part.name, str(part.dtype))
+            digest.update(repr((labels, part.index.name, part.shape)).encode())
+        elif isinstance(part, np.ndarray):
+            # The bytes of an object array are pointers to its values, so those are hashed by value instead
+            values = pd.util.hash_array(part.ravel()) if part.dtype == object else np.ascontiguousarray(part)
+            digest.update(values.tobytes())
+            digest.update(repr((part.dtype.str, part.shape)).encode())
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+class FigureCache:
+    # LRU of built figures, as their JSON, keyed on (name, content hash of the figure's data). Every get returns a
+    # new figure, so a caller that changes its figure does not change the cached one or another session's
+    def __init__(self, max_entries=None):
+        self.max_entries = max_cached_figures if max_entries is None else max_entries
+        self.lock = threading.Lock()
+        self.figures = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, name, data, build):
+        key = (name, content_hash(data))
+        with self.lock:
+            if key in self.figures:
+                self.figures.move_to_end(key)
+                self.stats["hits"] += 1
+                return pio.from_json(self.figures[key])
+            self.stats["misses"] += 1
+
+        fig = build(data)
+        fig_json = fig.to_json()
+
+        with self.lock:
+            self.figures[key] = fig_json
+            while len(self.figures) > self.max_entries:
+                self.figures.popitem(last=False)
+        # The cache keeps the JSON taken above, so this one is the caller's
+        return fig
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FigureCache()
+    return _cache
+
+
+def cache_metrics():
+    if _cache is None:
+        return []
+    with _cache.lock:
+        stats = dict(_cache.stats, entries=len(_cache.figures))
+    return instrumentation.stats_lines("laundris_figure_cache", "Figure cache counters", stats)
+
+
+instrumentation.collectors.append(cache_metrics)
+
+
+def cached(name, data, build):
+    # build(data) -> figure, called only when no figure was cached for this name and content
+    return get_cache().get(name, data, build)
+
+
+def nice_width(width):
+    # Rounds a bin width up to 1, 2 or 5 times a power of ten
+    exponent = 10 ** math.floor(math.log10(width))
+    return next(step * exponent for step in (1, 2, 5, 10) if step * exponent >= width)
+
+
+def histogram_bins(values, max_bins=None):
+    # (edges, counts) of equal-width bins aligned to a multiple of the width; integer data gets integer widths
+    max_bins = max_bins or max_histogram_bins
+    values = pd.Series(values).dropna().to_numpy(dtype=float)
+    if values.size == 0:
+        return np.array([0.0, 1.0]), np.zeros(1, dtype=np.int64)
+
+    low, high = values.min(), values.max()
+    edges = np.histogram_bin_edges(values, bins='auto')
+    width = max((edges[-1] - edges[0]) / max(len(edges) - 1, 1), (high - low) / max_bins)
+    width = nice_width(width) if width > 0 else 1.0
+    if np.all(values % 1 == 0):
+        width = max(width, 1.0)
+
+    start = math.floor(low / width) * width
+    n_bins = int((high - start) // width) + 1
+    counts = np.bincount(((values - start) // width).astype(np.int64), minlength=n_bins)
+    return start + width * np.arange(n_bins + 1), counts
+
+
+def histogram(name, values, title, color='#3c8ff3', bargap=0.2):
+    # Bar chart of numpy-binned values; only the (edges, counts) aggregate is hashed and sent to the browser
+    edges, counts = histogram_bins(values)
+
+    def build(aggregate):
+        edges, counts = aggregate
+        width = edges[1] - edges[0]
+        fig = go.Figure(go.Bar(x=edges[:-1] + width / 2, y=counts, width=width * (1 - bargap),
+                               customdata=np.column_stack([edges[:-1], edges[1:]]), marker_color=color,
+                               hovertemplate=f"{title}=%{{customdata[0]:g}} to %{{customdata[1]:g}}<br>count=%{{y}}<extra></extra>"))
+        fig.update_layout(xaxis_title=title, yaxis_title="count", bargap=bargap)
+        return fig
+
+    return cached(name, (edges, counts), build)
+
+
+def heatmap(name, df, labels, color_scale, x=None):
+    # px.imshow of a pivot table with the counts written in the cells
+    x = list(df.columns if x is None else x)
+    return cached(name, (df, np.array(x, dtype=object), repr((labels, color_scale))),
+                  lambda data: px.imshow(df, labels=labels, x=x, text_auto=True, color_continuous_scale=color_scale, aspect="auto"))
+
+
+def bar(name, df, x, y, color='#3c8ff3', width=None):
+    def build(data):
+        fig = px.bar(df, x=x, y=y)
+        fig.update_traces(marker_color=color)
+        if width is not None:
+            fig.update_traces(width=width)
+        return fig
+
+    return cached(name, (df, repr((x, y, color, width))), build)
+
+
+def pie(name, df, values, names):
+    return cached(name, (df, repr((values, names))), lambda data: px.pie(df, values=values, names=names))
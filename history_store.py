@@ -0,0 +1,237 @@
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import database as db
+import depletion_engine as engine
+import instrumentation
+import results_store
+
+
+# Daily snapshots of every customer's numbers per item type, as the par-level heatmaps showed them for the current
+# month on that day: total, available, lost and ragout items, desired quantity and par level (%). Rows live in one
+# SQLite file keyed on (customer_id, snapshot_date, item_type_name), so batch workers can write at the same time,
+# and a customer's past months or a trend over any range is one indexed read. Only the batch jobs record snapshots;
+# the dashboard reads them.
+#   python history_store.py snapshot --customers 45 52     record today's snapshot (batch_scoring does this too)
+#   python history_store.py backfill                       record the snapshots of earlier batch runs in results_store
+
+logger = logging.getLogger(__name__)
+
+history_db = os.environ.get("LAUNDRIS_HISTORY_DB", os.path.join(".cache", "history.sqlite"))
+# Days of history in the dashboard's par level trend
+trend_days = int(os.environ.get("LAUNDRIS_HISTORY_TREND_DAYS", "180"))
+# Item type name of the per day totals in trend()
+all_item_types = "All item types"
+
+value_columns = ['total', 'available', 'lost', 'ragout', 'desired_quantity', 'par_level']
+history_columns = ['customer_id', 'snapshot_date', 'item_type_name'] + value_columns
+
+schema_sql = """CREATE TABLE IF NOT EXISTS depletion_history (
+                    customer_id INTEGER NOT NULL, snapshot_date TEXT NOT NULL, item_type_name TEXT NOT NULL,
+                    total INTEGER, available INTEGER, lost INTEGER, ragout INTEGER, desired_quantity REAL, par_level REAL,
+                    PRIMARY KEY (customer_id, snapshot_date, item_type_name)) WITHOUT ROWID"""
+
+insert_sql = f"INSERT OR REPLACE INTO depletion_history ({', '.join(history_columns)}) VALUES ({', '.join('?' * len(history_columns))})"
+
+range_sql = f"""SELECT {', '.join(history_columns)} FROM depletion_history
+                WHERE customer_id = ? AND snapshot_date BETWEEN ? AND ? ORDER BY snapshot_date, item_type_name"""
+
+# The last snapshot of every month in the range
+month_end_sql = f"""SELECT {', '.join(history_columns)} FROM depletion_history
+                    WHERE customer_id = ? AND snapshot_date IN (
+                        SELECT max(snapshot_date) FROM depletion_history WHERE customer_id = ? AND snapshot_date BETWEEN ? AND ?
+                        GROUP BY substr(snapshot_date, 1, 7))
+                    ORDER BY snapshot_date, item_type_name"""
+
+_conn = None
+_conn_key = None    # (path, pid) the connection was opened for
+_conn_lock = threading.RLock()
+
+
+@contextmanager
+def connection():
+    # One connection per process, shared by its threads under the lock and set up (WAL, schema) once; opened again
+    # in a forked child, which must not use its parent's, or when history_db changes. WAL lets readers in other
+    # processes go on while a batch worker writes
+    global _conn, _conn_key
+    with _conn_lock:
+        if _conn is None or _conn_key != (history_db, os.getpid()):
+            os.makedirs(os.path.dirname(history_db) or ".", exist_ok=True)
+            _conn = sqlite3.connect(history_db, timeout=30, check_same_thread=False)
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.execute(schema_sql)
+            _conn_key = (history_db, os.getpid())
+        yield _conn
+
+
+def snapshot_frame(par_df, totals, snapshot_date):
+    # The current month's rows of a par-level forecast (results_store.par_levels layout) with the items per item type
+    current = par_df[par_df['period'].astype(str) == str(pd.Period(snapshot_date, freq='M'))]
+    return pd.DataFrame({
+        'item_type_name': current['item_type_name'].astype(str).to_numpy(),
+        'total': current['item_type_name'].map(totals).fillna(0).astype(int).to_numpy(),
+        'available': current['available'].astype(int).to_numpy(),
+        'lost': current['lost'].astype(int).to_numpy(),
+        'ragout': current['ragout'].astype(int).to_numpy(),
+        'desired_quantity': current['desired_quantity'].astype(float).to_numpy(),
+        'par_level': current['par_level'].astype(float).to_numpy(),
+    })
+
+
+def result_snapshot(result):
+    totals = result.item_heatmap.set_index('Item Type')['Total Items Count']
+    return snapshot_frame(result.par_forecast, totals, result.today)
+
+
+def write_snapshot(customer_id, snapshot_date, snapshot_df):
+    rows = [(int(customer_id), snapshot_date.isoformat(), row.item_type_name, int(row.total), int(row.available), int(row.lost),
+             int(row.ragout), float(row.desired_quantity), None if np.isnan(row.par_level) else float(row.par_level))
+            for row in snapshot_df.itertuples(index=False)]
+    with connection() as conn, conn:
+        conn.execute("DELETE FROM depletion_history WHERE customer_id = ? AND snapshot_date = ?", (int(customer_id), snapshot_date.isoformat()))
+        conn.executemany(insert_sql, rows)
+    return len(rows)
+
+
+def record_snapshot(customer_id, result):
+    # Writes the day's snapshot of a DepletionResult; called by the batch jobs only, the dashboard just reads
+    with instrumentation.span("history.record", rows_in=result.par_forecast.shape[0]) as span:
+        span.rows_out = write_snapshot(customer_id, result.today, result_snapshot(result))
+    return span.rows_out
+
+
+def read_frame(sql, params):
+    with connection() as conn:
+        df = pd.read_sql_query(sql, conn, params=params)
+    df['snapshot_date'] = pd.to_datetime(df['snapshot_date'])
+    return df
+
+
+def load_history(customer_id, start=None, end=None):
+    # A customer's snapshots from start to end (dates, inclusive), one row per day and item type
+    start = (start or datetime.date.min).isoformat()
+    end = (end or datetime.date.max).isoformat()
+    with instrumentation.span("history.load") as span:
+        df = read_frame(range_sql, (int(customer_id), start, end))
+        span.rows_out = df.shape[0]
+    return df
+
+
+def month_end_snapshots(customer_id, start, end):
+    # The last snapshot of each month between start and end, with its year-month as `period`
+    with instrumentation.span("history.month_end") as span:
+        df = read_frame(month_end_sql, (int(customer_id), int(customer_id), start.isoformat(), end.isoformat()))
+        df['period'] = df['snapshot_date'].dt.to_period('M')
+        span.rows_out = df.shape[0]
+    return df
+
+
+def trend(customer_id, start=None, end=None):
+    # The customer's snapshots from start to end, followed by each day's totals over its item types as item type
+    # all_item_types; the totals' par level is total available over total desired quantity
+    df = load_history(customer_id, start, end)
+    daily = df.groupby('snapshot_date')[['total', 'available', 'lost', 'ragout', 'desired_quantity']].sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        daily['par_level'] = (daily['available'] / daily['desired_quantity'] * 100).round(2)
+    daily = daily.reset_index().assign(customer_id=int(customer_id), item_type_name=all_item_types)
+    return pd.concat([df, daily[history_columns]], ignore_index=True)
+
+
+def with_history(result):
+    # result's item_heatmap, par_heatmap and availability_heatmap with each past month's columns taken from that month's
+    # last snapshot, for the item types it recorded; months without a snapshot keep the reconstructed values
+    months = result.par_forecast[['period', 'month']].drop_duplicates()
+    current = pd.Period(result.today, freq='M')
+    past = months[months['period'] < current]
+    if past.empty:
+        return result.item_heatmap, result.par_heatmap, result.availability_heatmap
+
+    history_df = month_end_snapshots(result.customer_id, past['period'].iloc[0].start_time.date(), past['period'].iloc[-1].end_time.date())
+    if history_df.empty:
+        return result.item_heatmap, result.par_heatmap, result.availability_heatmap
+
+    item_heatmap, par_heatmap, availability_heatmap = result.item_heatmap.copy(), result.par_heatmap.copy(), result.availability_heatmap.copy()
+    item_types = item_heatmap['Item Type']
+    for period, name in past.itertuples(index=False):
+        month_df = history_df[history_df['period'] == period].set_index('item_type_name')
+        if month_df.empty:
+            continue
+        recorded = item_types.isin(month_df.index).to_numpy()
+        for column, field in [(f'{name} Lost Items', 'lost'), (f'{name} Ragout Items', 'ragout'),
+                              (f'Available Items ({name})', 'available'), (f'Par level ({name})', 'par_level')]:
+            values = np.where(recorded, item_types.map(month_df[field]).to_numpy(), item_heatmap[column].to_numpy())
+            item_heatmap[column] = values.astype(item_heatmap[column].dtype)
+        par_heatmap[name] = item_heatmap.set_index('Item Type')[f'Par level ({name})'].reindex(par_heatmap.index).to_numpy()
+        availability_heatmap[f'Available Items ({name})'] = item_heatmap.set_index('Item Type')[f'Available Items ({name})'].reindex(availability_heatmap.index).to_numpy()
+    return item_heatmap, par_heatmap, availability_heatmap
+
+
+def snapshot_customer(customer_id, snapshot_date):
+    # Runs in a batch_scoring worker: computes the customer's result for the day and records its snapshot
+    with instrumentation.trace("history_snapshot", customer_id=customer_id):
+        _, order_cycle_df, inactive_status_df = db.fetch_frames(customer_id)
+        desired_quantity_df = db.get_desired_quantity(list(order_cycle_df.item_type_id.unique()), customer_id)
+        result = engine.compute_depletion(customer_id, order_cycle_df, inactive_status_df, desired_quantity_df, snapshot_date)
+        return record_snapshot(customer_id, result)
+
+
+def backfill():
+    # Snapshots of the batch runs in results_store: the current month of each run's par levels, totals from its items
+    written = 0
+    for run_date in results_store.run_dates():
+        run_dir = os.path.join(results_store.results_dir, run_date.isoformat())
+        for name in sorted(os.listdir(run_dir)):
+            if not name.startswith("customer_"):
+                continue
+            customer_id = int(name[len("customer_"):])
+            items_df, par_df, _ = results_store.load_results(customer_id, run_date)
+            totals = items_df.groupby('item_type_name', observed=True).size()
+            written += write_snapshot(customer_id, run_date, snapshot_frame(par_df, totals, run_date))
+    return written
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Daily depletion snapshots per customer and item type")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    snapshot = subparsers.add_parser("snapshot", help="record today's snapshot of customers")
+    snapshot.add_argument("--customers", type=int, nargs="+", help="customer ids (default: every customer of fetch_inventory_list)")
+    snapshot.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    snapshot.add_argument("--db-connections", type=int, default=None, help="database connections shared by all workers (default: one per worker)")
+    subparsers.add_parser("backfill", help="record the snapshots of the batch runs in results_store")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "backfill":
+        logger.info("backfilled %d rows into %s", backfill(), history_db)
+        return 0
+
+    # batch_scoring records a snapshot with every run of the day, so it is only imported here
+    import batch_scoring
+
+    customer_ids = args.customers or db.fetch_inventory_list()[1]
+    workers, pool_size = batch_scoring.pool_layout(args.workers, args.db_connections or args.workers, len(customer_ids))
+    failed = 0
+    for customer_id, rows, error in batch_scoring.map_customers(snapshot_customer, customer_ids, workers, pool_size, datetime.date.today()):
+        if error is not None:
+            failed += 1
+            logger.error("customer %s failed: %r", customer_id, error)
+        else:
+            logger.info("customer %s: %d item types", customer_id, rows)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+import datetime
+import os
+import threading
+import time
+
+import pandas as pd
+
+import database as db
+import disk_cache
+
+
+# A delta refresh only reads and rebuilds the RFIDs that changed since the last read, so its cost follows the
+# day's changes rather than the customer's history. The periodic full reload still picks up what the watermarks
+# cannot see: deleted bins or orders, and late links between old bins and old orders.
+full_refresh_interval = float(os.environ.get("LAUNDRIS_SNAPSHOT_FULL_REFRESH_HOURS", "24")) * 3600
+
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+order_columns = ["order_id", "actual_pickup_date", "actual_dropoff_date", "incoming_total_weight"]
+
+
+def probe_queries():
+    # The customer's RFID ids (deleted and moved RFIDs are the ones missing from it), the RFIDs with rows past the
+    # watermarks (with the watermark columns, so the next watermarks come from the same read) and the current
+    # state of the orders the snapshot holds as open, whose dates may have been filled in since
+    changed_rfids_sql = f"""
+        SELECT rfid_id, last_updated_date, NULL::bigint AS binrfids_id, NULL::bigint AS order_id FROM rfid
+        WHERE customer_id = %(customer_id)s AND last_updated_date >= %(rfid_watermark)s
+        UNION ALL
+        SELECT rfid_id, NULL, binrfids_id, NULL FROM order_binrfids_rfids
+        WHERE binrfids_id > %(bin_watermark)s AND rfid_id IN ({db.customer_rfids_sql})
+        UNION ALL
+        SELECT b.rfid_id, NULL, NULL, p.order_id FROM order_order_pickup_bins p JOIN order_binrfids_rfids b ON b.binrfids_id = p.binrfids_id
+        WHERE p.order_id > %(order_watermark)s AND b.rfid_id IN ({db.customer_rfids_sql})
+        UNION ALL
+        SELECT b.rfid_id, NULL, NULL, d.order_id FROM order_order_dropoff_bins d JOIN order_binrfids_rfids b ON b.binrfids_id = d.binrfids_id
+        WHERE d.order_id > %(order_watermark)s AND b.rfid_id IN ({db.customer_rfids_sql})"""
+
+    open_orders_sql = """SELECT id AS order_id, actual_pickup_date, actual_dropoff_date, incoming_total_weight
+                         FROM order_order WHERE id = ANY(%(open_order_ids)s)"""
+
+    return {
+        "rfid_ids": db.customer_rfids_sql,
+        "changed_rfids": changed_rfids_sql,
+        "open_orders": open_orders_sql,
+    }
+
+
+order_rfids_sql = f"""
+    SELECT b.rfid_id FROM order_order_pickup_bins p JOIN order_binrfids_rfids b ON b.binrfids_id = p.binrfids_id
+    WHERE p.order_id = ANY(%(order_ids)s) AND b.rfid_id IN ({db.customer_rfids_sql})
+    UNION
+    SELECT b.rfid_id FROM order_order_dropoff_bins d JOIN order_binrfids_rfids b ON b.binrfids_id = d.binrfids_id
+    WHERE d.order_id = ANY(%(order_ids)s) AND b.rfid_id IN ({db.customer_rfids_sql})"""
+
+
+def slice_queries():
+    # customer_table_queries restricted to the given RFIDs of the customer
+    slice_rfids_sql = "SELECT rfid_id FROM rfid WHERE customer_id = %(customer_id)s AND rfid_id = ANY(%(rfid_ids)s)"
+    slice_bins_sql = f"SELECT binrfids_id FROM order_binrfids_rfids WHERE rfid_id IN ({slice_rfids_sql})"
+
+    rfid_sql = """SELECT r.rfid_id, r.creation_date, r.last_updated_date, r.status, r.ragout_date, r.total_washes, r.last_scan_date, r.item_type_id,
+                  r.last_seen_location_id, r.location_id, r.birthday FROM rfid r
+                  WHERE r.customer_id = %(customer_id)s AND r.rfid_id = ANY(%(rfid_ids)s);"""
+
+    order_sql = """SELECT id AS order_id, actual_pickup_date, actual_dropoff_date, incoming_total_weight
+                   FROM order_order
+                   WHERE id IN (SELECT order_id FROM {table} WHERE binrfids_id IN ({slice_bins_sql}))"""
+
+    return {
+        "rfid": rfid_sql,
+        "order_binrfids_rfids": f"SELECT binrfids_id, rfid_id FROM order_binrfids_rfids WHERE rfid_id IN ({slice_rfids_sql});",
+        "order_order_pickup_bins": f"SELECT binrfids_id, order_id FROM order_order_pickup_bins WHERE binrfids_id IN ({slice_bins_sql});",
+        "order_order_dropoff_bins": f"SELECT binrfids_id, order_id FROM order_order_dropoff_bins WHERE binrfids_id IN ({slice_bins_sql});",
+        "item_type": f"""SELECT id AS item_type_id, customer_item_type_name AS item_type_name FROM customer_customerinventoryitemtype
+                         WHERE id IN (SELECT item_type_id FROM rfid WHERE rfid_id IN ({slice_rfids_sql}));""",
+        "location": f"""SELECT id AS last_seen_location_id, name AS last_seen_location_name, location_type, customer_id as location_customer_id, side
+                        FROM inventory_location
+                        WHERE id IN (SELECT last_seen_location_id FROM rfid WHERE rfid_id IN ({slice_rfids_sql})
+                                     UNION SELECT location_id FROM rfid WHERE rfid_id IN ({slice_rfids_sql}))""",
+        "pickup_order": order_sql.format(table="order_order_pickup_bins", slice_bins_sql=slice_bins_sql),
+        "dropoff_order": order_sql.format(table="order_order_dropoff_bins", slice_bins_sql=slice_bins_sql),
+    }
+
+
+date_columns = {"rfid": db.rfid_date_columns, "pickup_order": order_columns[1:3], "dropoff_order": order_columns[1:3], "open_orders": order_columns[1:3]}
+
+
+def parse_dates(tables):
+    # A few rows whose date column is all NULL come back from read_sql as object dtype; the full read's are UTC datetimes
+    for name, columns in date_columns.items():
+        if name in tables:
+            tables[name] = tables[name].assign(**{column: pd.to_datetime(tables[name][column], utc=True) for column in columns})
+    return tables
+
+
+def changed_orders(open_orders_df, current_df):
+    # Ids of the open orders that were updated or deleted since they were read
+    merged_df = open_orders_df.merge(current_df[order_columns], on="order_id", how="left", suffixes=("", "_now"), indicator=True)
+    changed = merged_df["_merge"] == "left_only"
+    for column in order_columns[1:]:
+        before, now = merged_df[column], merged_df[f"{column}_now"]
+        changed |= ~((before == now) | (before.isnull() & now.isnull()))
+    return merged_df.loc[changed, "order_id"].unique()
+
+
+def open_orders(tables):
+    orders_df = pd.concat([tables["pickup_order"], tables["dropoff_order"]], ignore_index=True)[order_columns]
+    orders_df = orders_df[orders_df.actual_pickup_date.isnull() | orders_df.actual_dropoff_date.isnull()]
+    return orders_df.drop_duplicates("order_id", keep="last").reset_index(drop=True)
+
+
+def table_watermarks(tables):
+    order_ids = pd.concat([tables["order_order_pickup_bins"]["order_id"], tables["order_order_dropoff_bins"]["order_id"]])
+    return {
+        "rfid_watermark": tables["rfid"]["last_updated_date"].max(),
+        "bin_watermark": tables["order_binrfids_rfids"]["binrfids_id"].max(),
+        "order_watermark": order_ids.max(),
+    }
+
+
+def merge_watermarks(watermarks, new_watermarks):
+    merged = dict(watermarks)
+    for name, value in new_watermarks.items():
+        if not pd.isnull(value) and (pd.isnull(merged.get(name)) or value > merged[name]):
+            merged[name] = value
+    return merged
+
+
+def replace_rfids(df, new_df, rfid_ids):
+    # df with the rows of rfid_ids replaced by new_df's, in rfid_id order like finalize_order_cycle_frames' output
+    kept_df = df[~df.rfid_id.isin(rfid_ids)]
+    if new_df is None or new_df.empty:
+        return kept_df.reset_index(drop=True)
+    return pd.concat([kept_df, new_df], ignore_index=True).sort_values('rfid_id', kind='stable', ignore_index=True)
+
+
+def inactive_days(last_updated_date, today):
+    # finalize_order_cycle_frames' inactive_time for a new day
+    return (today - pd.to_datetime(last_updated_date)).dt.days.clip(lower=0)
+
+
+def snapshot_key(customer_id):
+    return ("incremental", f"customer_{customer_id}")
+
+
+snapshot_frame_names = ["pickup_dropoff_count_df", "inactive_status_df", "rfid_ids", "open_orders", "state"]
+
+
+class CustomerSnapshot:
+    # Materialized fetch_data state for one customer: the finalized frames, the customer's RFID ids, the open
+    # orders and the watermarks of the last read. The raw tables are not kept; a delta refresh re-reads the
+    # changed RFIDs' rows and rebuilds their frame rows only.
+    def __init__(self, customer_id):
+        self.customer_id = customer_id
+        self.lock = threading.Lock()
+        self.frames = None
+        self.rfid_ids = None
+        self.open_orders_df = None
+        self.watermarks = None
+        self.finalized_on = None
+        self.full_refreshed_at = None
+        self.stats = {"full_refreshes": 0, "delta_refreshes": 0, "disk_loads": 0, "last_delta_rows": 0, "last_affected_rfids": 0,
+                      "last_removed_rfids": 0, "last_refresh_time": 0.0}
+
+    def full_refresh(self):
+        tables = db.read_customer_tables_concurrent(self.customer_id)
+        self.frames = db.build_order_cycle_frames(tables, self.customer_id, include_exploded=False)[1:]
+        self.rfid_ids = tables["rfid"]["rfid_id"]
+        self.open_orders_df = open_orders(tables)
+        self.watermarks = table_watermarks(tables)
+        self.finalized_on = datetime.date.today()
+        self.full_refreshed_at = time.time()
+        self.stats["full_refreshes"] += 1
+
+    def store(self):
+        # Only the state of a full refresh goes to disk; processes that load it apply their own deltas on top
+        state_df = pd.DataFrame({name: [value] for name, value in self.watermarks.items()})
+        state_df["full_refreshed_at"] = self.full_refreshed_at
+        state_df["finalized_on"] = self.finalized_on.isoformat()
+        frames = dict(zip(snapshot_frame_names, list(self.frames) + [self.rfid_ids.to_frame("rfid_id"), self.open_orders_df, state_df]))
+        disk_cache.store_frames(snapshot_key(self.customer_id), frames)
+
+    def load(self):
+        frames = disk_cache.load_frames(snapshot_key(self.customer_id), snapshot_frame_names)
+        if frames is None or len(frames) < len(snapshot_frame_names):
+            return False
+        state = frames["state"].iloc[0]
+        if time.time() - state["full_refreshed_at"] > full_refresh_interval:
+            return False
+
+        self.frames = (frames["pickup_dropoff_count_df"], frames["inactive_status_df"])
+        self.rfid_ids = frames["rfid_ids"]["rfid_id"]
+        self.open_orders_df = frames["open_orders"]
+        self.watermarks = {name: state[name] for name in ["rfid_watermark", "bin_watermark", "order_watermark"]}
+        self.finalized_on = datetime.date.fromisoformat(state["finalized_on"])
+        self.full_refreshed_at = float(state["full_refreshed_at"])
+        self.stats["disk_loads"] += 1
+        return True
+
+    def query_watermarks(self):
+        rfid_watermark, bin_watermark, order_watermark = (self.watermarks[name] for name in ["rfid_watermark", "bin_watermark", "order_watermark"])
+        return {
+            "rfid_watermark": epoch if pd.isnull(rfid_watermark) else pd.Timestamp(rfid_watermark).to_pydatetime(),
+            "bin_watermark": -1 if pd.isnull(bin_watermark) else int(bin_watermark),
+            "order_watermark": -1 if pd.isnull(order_watermark) else int(order_watermark),
+            "open_order_ids": [int(order_id) for order_id in self.open_orders_df.order_id],
+        }
+
+    def delta_refresh(self):
+        params = {"customer_id": self.customer_id}
+        params.update(self.query_watermarks())
+        probe = parse_dates(db.read_tables_concurrent(probe_queries(), params))
+
+        rfid_ids = probe["rfid_ids"]["rfid_id"]
+        removed_rfids = self.rfid_ids[~self.rfid_ids.isin(rfid_ids)]
+        # RFIDs moved in from another customer keep their old dates, so only the key-set diff finds them
+        added_rfids = rfid_ids[~rfid_ids.isin(self.rfid_ids)]
+
+        changed_rfids_df = probe["changed_rfids"]
+        affected_rfids = [changed_rfids_df.rfid_id, added_rfids]
+
+        order_ids = changed_orders(self.open_orders_df, probe["open_orders"])
+        if len(order_ids) > 0:
+            with db.connection() as conn:
+                order_rfids_df = db.read_table("order_rfids", order_rfids_sql, conn,
+                                               {"customer_id": self.customer_id, "order_ids": [int(order_id) for order_id in order_ids]})
+            affected_rfids.append(order_rfids_df.rfid_id)
+        affected_rfids = pd.concat(affected_rfids).unique()
+
+        slice_tables = None
+        new_frames = (None, None)
+        if len(affected_rfids) > 0:
+            slice_tables = parse_dates(db.read_tables_concurrent(slice_queries(), {"customer_id": self.customer_id, "rfid_ids": list(affected_rfids)}))
+            new_frames = db.build_order_cycle_frames(slice_tables, self.customer_id, include_exploded=False)[1:]
+
+        replaced_rfids = pd.concat([pd.Series(affected_rfids, dtype=object), removed_rfids]).unique()
+        if len(replaced_rfids) > 0:
+            self.frames = tuple(replace_rfids(df, new_df, replaced_rfids) for df, new_df in zip(self.frames, new_frames))
+        self.rfid_ids = rfid_ids
+
+        # Orders that were updated or deleted leave the open set; the affected RFIDs' orders that are still open join it
+        open_orders_df = self.open_orders_df[~self.open_orders_df.order_id.isin(order_ids)]
+        slice_open_orders_df = None if slice_tables is None else open_orders(slice_tables)
+        if slice_open_orders_df is not None and not slice_open_orders_df.empty:
+            open_orders_df = pd.concat([open_orders_df, slice_open_orders_df], ignore_index=True)
+            open_orders_df = open_orders_df.drop_duplicates("order_id", keep="last")
+        self.open_orders_df = open_orders_df.reset_index(drop=True)
+
+        # The next watermarks come from the probe, so rows written after it are picked up by the next refresh
+        self.watermarks = merge_watermarks(self.watermarks, {
+            "rfid_watermark": changed_rfids_df["last_updated_date"].max(),
+            "bin_watermark": changed_rfids_df["binrfids_id"].max(),
+            "order_watermark": changed_rfids_df["order_id"].max(),
+        })
+
+        self.stats["delta_refreshes"] += 1
+        self.stats["last_delta_rows"] = len(changed_rfids_df) + (0 if slice_tables is None else sum(len(df) for df in slice_tables.values()))
+        self.stats["last_affected_rfids"] = len(affected_rfids)
+        self.stats["last_removed_rfids"] = len(removed_rfids)
+
+    def roll_over_day(self):
+        # inactive_time counts days up to today, so unchanged rows age once a day
+        today = datetime.date.today()
+        if today == self.finalized_on:
+            return
+        today_timestamp = pd.Timestamp(today, tz='UTC')
+        self.frames = tuple(df.assign(inactive_time=inactive_days(df['last_updated_date'], today_timestamp)) for df in self.frames)
+        self.finalized_on = today
+
+    def refresh(self):
+        with self.lock:
+            start = time.perf_counter()
+            # A new process starts from the last full refresh on disk, if there is a recent one
+            if self.frames is None and disk_cache.enabled():
+                self.load()
+            if self.frames is None or time.time() - self.full_refreshed_at > full_refresh_interval:
+                self.full_refresh()
+                if disk_cache.enabled():
+                    self.store()
+            else:
+                self.delta_refresh()
+                self.roll_over_day()
+            self.stats["last_refresh_time"] = time.perf_counter() - start
+
+            # Copies, so callers cannot modify the snapshot
+            return (None,) + tuple(df.copy() for df in self.frames)
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(customer_id):
+    with _snapshots_lock:
+        if customer_id not in _snapshots:
+            _snapshots[customer_id] = CustomerSnapshot(customer_id)
+        return _snapshots[customer_id]
+
+
+def refresh_customer(customer_id):
+    return get_snapshot(customer_id).refresh()
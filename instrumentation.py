@@ -0,0 +1,329 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Named spans around the stages of a page render (SQL reads, pandas stages, model calls, figures and tables).
+# Spans are grouped into a trace per rerun (or per batch job customer); a finished trace is logged as one JSON
+# line, every span is added to process-wide metrics served as Prometheus text, and main() can show the spans
+# of the current rerun in a debug panel.
+#
+#   with instrumentation.span("pandas.explode_order_cycles", rows_in=len(rfid_df)) as span:
+#       df = ...
+#       span.rows_out = len(df)
+
+logger = logging.getLogger("laundris.trace")
+
+# tracemalloc makes allocations several times slower, so per-span peak memory is opt-in. Its peak is process-wide:
+# a span that overlaps a span on another thread records no peak (see span()), so complete numbers need one
+# thread at a time (LAUNDRIS_FETCH_WORKERS=1, one session)
+trace_memory = os.environ.get("LAUNDRIS_TRACE_MEMORY", "0") == "1"
+trace_log = os.environ.get("LAUNDRIS_TRACE_LOG", "1") != "0"
+metrics_port = int(os.environ["LAUNDRIS_METRICS_PORT"]) if os.environ.get("LAUNDRIS_METRICS_PORT") else None
+metrics_host = os.environ.get("LAUNDRIS_METRICS_HOST", "127.0.0.1")
+debug_panel = os.environ.get("LAUNDRIS_DEBUG_PANEL", "0") == "1"
+
+if trace_log and not logger.handlers:
+    # One bare JSON object per line, whatever the host application does with the root logger
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def current_rss():
+    # Resident set size of the process in bytes (Linux /proc; the peak RSS elsewhere)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# tracemalloc is process-wide, so measurements taken with it are serialized on this lock, and tracing is only
+# stopped by the measurement that started it
+tracemalloc_lock = threading.RLock()
+
+# Spans open under LAUNDRIS_TRACE_MEMORY, in every thread. A span whose lifetime overlaps a span (or a
+# measure_peak) on another thread is marked shared: the other thread resets and raises the same peak
+_memory_spans = set()
+_memory_spans_lock = threading.Lock()
+
+
+def share_memory_spans(current=None):
+    # Marks the open spans of other threads as shared (and current too, if any were open), then registers current
+    thread_id = threading.get_ident()
+    with _memory_spans_lock:
+        for other in _memory_spans:
+            if other.thread_id != thread_id:
+                other.shared = True
+                if current is not None:
+                    current.shared = True
+        if current is not None:
+            _memory_spans.add(current)
+
+
+@contextmanager
+def measure_peak():
+    # Peak bytes traced above the starting level while the block runs; allocations of other threads count too
+    measured = {"peak_bytes": None}
+    with tracemalloc_lock:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        start_traced, peak = tracemalloc.get_traced_memory()
+        share_memory_spans()
+        stack = span_stack()
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        tracemalloc.reset_peak()
+        try:
+            yield measured
+        finally:
+            measured["peak_bytes"] = max(tracemalloc.get_traced_memory()[1] - start_traced, 0)
+            if not tracing:
+                tracemalloc.stop()
+
+
+class Span:
+    __slots__ = ("name", "rows_in", "rows_out", "seconds", "peak_bytes", "rss_bytes", "error", "thread", "thread_id", "started", "child_peak",
+                 "start_traced", "shared")
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.seconds = None
+        self.peak_bytes = None
+        self.rss_bytes = None
+        self.error = None
+        self.thread = threading.current_thread().name
+        self.thread_id = threading.get_ident()
+        self.started = None
+        self.child_peak = 0
+        self.start_traced = 0
+        self.shared = False
+
+    def to_dict(self):
+        return {"span": self.name, "seconds": self.seconds, "rows_in": self.rows_in, "rows_out": self.rows_out,
+                "peak_bytes": self.peak_bytes, "rss_bytes": self.rss_bytes, "error": self.error, "thread": self.thread}
+
+
+class Trace:
+    # The spans of one rerun; spans from worker threads are added under the lock
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.spans = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        with self.lock:
+            spans = [span.to_dict() for span in self.spans]
+        return dict(self.attributes, trace=self.name, seconds=self.seconds, rss_bytes=current_rss(), spans=spans)
+
+    def frame(self):
+        import pandas as pd
+        with self.lock:
+            return pd.DataFrame([span.to_dict() for span in self.spans],
+                                columns=["span", "seconds", "rows_in", "rows_out", "peak_bytes", "rss_bytes", "error", "thread"])
+
+
+class Metrics:
+    # Process-wide totals per span name, rendered in the Prometheus text format
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.traces = {}
+
+    def observe_span(self, span):
+        with self.lock:
+            stats = self.spans.setdefault(span.name, {"count": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0, "errors": 0, "peak_bytes": 0})
+            stats["count"] += 1
+            stats["seconds"] += span.seconds
+            stats["rows_in"] += span.rows_in or 0
+            stats["rows_out"] += span.rows_out or 0
+            stats["errors"] += span.error is not None
+            stats["peak_bytes"] = max(stats["peak_bytes"], span.peak_bytes or 0)
+
+    def observe_trace(self, trace):
+        with self.lock:
+            stats = self.traces.setdefault(trace.name, {"count": 0, "seconds": 0.0})
+            stats["count"] += 1
+            stats["seconds"] += trace.seconds
+
+    def render(self):
+        with self.lock:
+            spans = {name: dict(stats) for name, stats in self.spans.items()}
+            traces = {name: dict(stats) for name, stats in self.traces.items()}
+
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        def label(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"')
+
+        family("laundris_span_seconds", "summary", "Wall time of instrumented stages",
+               [f'laundris_span_seconds_sum{{span="{label(name)}"}} {stats["seconds"]:.6f}' for name, stats in spans.items()]
+               + [f'laundris_span_seconds_count{{span="{label(name)}"}} {stats["count"]}' for name, stats in spans.items()])
+        family("laundris_span_rows_in_total", "counter", "Rows passed into instrumented stages",
+               [f'laundris_span_rows_in_total{{span="{label(name)}"}} {stats["rows_in"]}' for name, stats in spans.items()])
+        family("laundris_span_rows_out_total", "counter", "Rows produced by instrumented stages",
+               [f'laundris_span_rows_out_total{{span="{label(name)}"}} {stats["rows_out"]}' for name, stats in spans.items()])
+        family("laundris_span_errors_total", "counter", "Instrumented stages that raised",
+               [f'laundris_span_errors_total{{span="{label(name)}"}} {stats["errors"]}' for name, stats in spans.items()])
+        if trace_memory:
+            family("laundris_span_peak_bytes", "gauge", "Largest traced allocation peak of a stage (LAUNDRIS_TRACE_MEMORY=1)",
+                   [f'laundris_span_peak_bytes{{span="{label(name)}"}} {stats["peak_bytes"]}' for name, stats in spans.items()])
+        family("laundris_trace_seconds", "summary", "Wall time of whole reruns / jobs",
+               [f'laundris_trace_seconds_sum{{trace="{label(name)}"}} {stats["seconds"]:.6f}' for name, stats in traces.items()]
+               + [f'laundris_trace_seconds_count{{trace="{label(name)}"}} {stats["count"]}' for name, stats in traces.items()])
+        family("laundris_process_resident_bytes", "gauge", "Resident set size of the process", [f"laundris_process_resident_bytes {current_rss()}"])
+
+        for collect in list(collectors):
+            try:
+                lines.extend(collect())
+            except Exception:
+                logger.debug("metrics collector %r failed", collect, exc_info=True)
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+# Callables returning extra Prometheus lines (connection pool, caches); registered by the modules that own them
+collectors = []
+
+
+def stats_lines(name, help_text, stats):
+    # A stats dict (e.g. ConnectionPool.snapshot()) as one gauge family with a "stat" label
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"] + \
+        [f'{name}{{stat="{stat}"}} {float(value):g}' for stat, value in stats.items() if isinstance(value, (int, float))]
+
+_local = threading.local()
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+def span_stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def trace(name, **attributes):
+    previous = current_trace()
+    current = Trace(name, **attributes)
+    _local.trace = current
+    try:
+        yield current
+    finally:
+        _local.trace = previous
+        current.seconds = time.perf_counter() - current.started
+        metrics.observe_trace(current)
+        if trace_log:
+            logger.info(json.dumps(current.to_dict(), default=str))
+
+
+@contextmanager
+def span(name, rows_in=None, trace=None):
+    # trace: the trace to record into when the span runs on another thread than the one that started the trace
+    current = Span(name, rows_in)
+    stack = span_stack()
+
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        traced, peak = tracemalloc.get_traced_memory()
+        # Resetting the peak would hide the enclosing span's peak so far, so hand it up first
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        tracemalloc.reset_peak()
+        current.start_traced = traced
+        share_memory_spans(current)
+
+    stack.append(current)
+    current.started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.seconds = time.perf_counter() - current.started
+        stack.pop()
+        if trace_memory:
+            with _memory_spans_lock:
+                _memory_spans.discard(current)
+        if trace_memory and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], current.child_peak)
+            # A shared span's peak may belong to another thread, or have been reset by it: left unset
+            current.peak_bytes = None if current.shared else max(peak - current.start_traced, 0)
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        current.rss_bytes = current_rss()
+
+        target = trace or current_trace()
+        if target is not None:
+            target.add(current)
+        metrics.observe_span(current)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=None, host=None):
+    # Serves /metrics from a daemon thread; one server per process, started on the first call. Bound to
+    # localhost unless LAUNDRIS_METRICS_HOST says otherwise
+    global _server
+    port = metrics_port if port is None else port
+    host = metrics_host if host is None else host
+    if port is None:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            except OSError as e:
+                logger.warning("metrics server not started on %s:%s: %r", host, port, e)
+                return None
+            threading.Thread(target=_server.serve_forever, name="laundris-metrics", daemon=True).start()
+    return _server
@@ -0,0 +1,360 @@
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import database as db
+import instrumentation
+from model_registry import models_dir
+
+
+# Lifetime of ragouted items (days from birthday to ragout_date, as prediction_model.calculate_lifetime) summarized
+# per (customer_id, item_type_id): running count, sum and sum of squared deviations, min / max, and a sparse
+# histogram of bin_days wide bins the quantiles are read from. New ragout events are folded in as they appear, and
+# a customer's lookup returns its item types' rows without touching the history. The rows live in one SQLite file
+# keyed on (customer_id, item_type_id), next to the RFIDs already counted, so the batch job and every dashboard
+# process fold events into the same store and a fold only writes the rows it changes.
+#   python lifetime_store.py seed --csv models/lifetime_items.csv --as-of 2024-03-01   start over from the static export
+#   python lifetime_store.py refresh                                  read the ragout events since the last refresh
+
+logger = logging.getLogger(__name__)
+
+lifetime_db = os.environ.get("LAUNDRIS_LIFETIME_DB", os.path.join(".cache", "lifetime.sqlite"))
+seed_csv = os.path.join(models_dir, "lifetime_items.csv")
+# Date of the export, for seeding it on first use when it has no last_updated_date column
+seed_as_of = os.environ.get("LAUNDRIS_LIFETIME_SEED_AS_OF")
+bin_days = float(os.environ.get("LAUNDRIS_LIFETIME_BIN_DAYS", "1"))
+# Seconds between reads of new ragout events from the backend
+refresh_interval = float(os.environ.get("LAUNDRIS_LIFETIME_REFRESH", "3600"))
+# Seconds before a process tries again after a failed read
+refresh_retry = float(os.environ.get("LAUNDRIS_LIFETIME_RETRY", "60"))
+
+quantiles = {"p25": 0.25, "p50": 0.5, "p75": 0.75, "p90": 0.9}
+key_columns = ["customer_id", "item_type_id"]
+stats_dtypes = dict({"customer_id": "int64", "item_type_id": "int64", "count": "int64", "total": "float64", "m2": "float64",
+                     "min": "float64", "max": "float64"}, **{name: "float64" for name in quantiles})
+lookup_columns = key_columns + ["count", "total", "mean", "std", "min", "max"] + list(quantiles)
+stats_columns = key_columns + ["count", "total", "m2", "min", "max"]
+bins_dtypes = {"customer_id": "int64", "item_type_id": "int64", "bin": "int64", "count": "int64"}
+
+schema_sql = f"""CREATE TABLE IF NOT EXISTS lifetime_stats (
+                     customer_id INTEGER NOT NULL, item_type_id INTEGER NOT NULL, count INTEGER NOT NULL, total REAL, m2 REAL,
+                     min REAL, max REAL, {', '.join(f'{name} REAL' for name in quantiles)},
+                     PRIMARY KEY (customer_id, item_type_id)) WITHOUT ROWID;
+                 CREATE TABLE IF NOT EXISTS lifetime_bins (
+                     customer_id INTEGER NOT NULL, item_type_id INTEGER NOT NULL, bin INTEGER NOT NULL, count INTEGER NOT NULL,
+                     PRIMARY KEY (customer_id, item_type_id, bin)) WITHOUT ROWID;
+                 CREATE TABLE IF NOT EXISTS lifetime_seen (
+                     customer_id INTEGER NOT NULL, rfid_id TEXT NOT NULL, PRIMARY KEY (customer_id, rfid_id)) WITHOUT ROWID;
+                 CREATE TABLE IF NOT EXISTS lifetime_state (name TEXT PRIMARY KEY, value TEXT);
+                 CREATE TEMP TABLE IF NOT EXISTS lifetime_batch (customer_id INTEGER, rfid_id TEXT);"""
+
+# The RFIDs of a batch (in temp.lifetime_batch) that were counted before
+seen_sql = """SELECT b.customer_id, b.rfid_id FROM temp.lifetime_batch b
+              JOIN lifetime_seen s ON s.customer_id = b.customer_id AND s.rfid_id = b.rfid_id"""
+
+# Every RFID with a ragout date whose row changed since the watermark; RFIDs already counted are skipped
+ragout_events_sql = """SELECT r.customer_id, r.rfid_id, r.item_type_id, r.birthday, r.ragout_date, r.last_updated_date FROM rfid r
+                       WHERE r.ragout_date IS NOT NULL AND r.last_updated_date >= %(watermark)s"""
+
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def read_state(conn):
+    return dict(conn.execute("SELECT name, value FROM lifetime_state").fetchall())
+
+
+def write_state(conn, **values):
+    conn.executemany("INSERT OR REPLACE INTO lifetime_state (name, value) VALUES (?, ?)", [(name, str(value)) for name, value in values.items()])
+
+
+def insert_sql(table, dtypes):
+    return f"INSERT OR REPLACE INTO {table} ({', '.join(dtypes)}) VALUES ({', '.join('?' * len(dtypes))})"
+
+
+def lifetime_events(df, customer_id=None):
+    # customer_id, rfid_id, item_type_id, lifetime for the rows of df (rfid columns) with a ragout date
+    df = df[df['ragout_date'].notna() & df['birthday'].notna() & df['item_type_id'].notna()]
+    lifetime = ((pd.to_datetime(df['ragout_date'], utc=True) - pd.to_datetime(df['birthday'], utc=True)).dt.total_seconds() / 3600 / 24).round(3)
+    events = pd.DataFrame({
+        'customer_id': df['customer_id'].to_numpy(dtype=np.int64) if customer_id is None else np.int64(customer_id),
+        'rfid_id': df['rfid_id'].astype(str).to_numpy(),
+        'item_type_id': df['item_type_id'].to_numpy(dtype=np.int64),
+        'lifetime': lifetime.to_numpy(dtype=float),
+    }, index=df.index)
+    return events[events['lifetime'] >= 0].reset_index(drop=True)
+
+
+def batch_stats(events):
+    # count / total / m2 / min / max per key of a batch of events
+    grouped = events.groupby(key_columns, sort=False)['lifetime']
+    stats = grouped.agg(count='count', total='sum', min='min', max='max').reset_index()
+    deviation = events['lifetime'] - grouped.transform('mean')
+    stats['m2'] = (deviation ** 2).groupby([events[column] for column in key_columns], sort=False).sum().to_numpy()
+    return stats
+
+
+def merge_stats(old, new):
+    # Combines two summaries of disjoint event sets (Chan et al.'s pairwise update for the squared deviations)
+    merged = pd.merge(old, new, on=key_columns, how='outer', suffixes=('_old', '_new'))
+    for column in ['count', 'total', 'm2']:
+        merged[[f'{column}_old', f'{column}_new']] = merged[[f'{column}_old', f'{column}_new']].fillna(0)
+    count = merged['count_old'] + merged['count_new']
+    delta = merged['total_new'] / merged['count_new'].where(merged['count_new'] > 0) - \
+        merged['total_old'] / merged['count_old'].where(merged['count_old'] > 0)
+    merged['count'] = count.astype(np.int64)
+    merged['total'] = merged['total_old'] + merged['total_new']
+    merged['m2'] = merged['m2_old'] + merged['m2_new'] + (delta ** 2 * merged['count_old'] * merged['count_new'] / count).fillna(0)
+    merged['min'] = merged[['min_old', 'min_new']].min(axis=1)
+    merged['max'] = merged[['max_old', 'max_new']].max(axis=1)
+    return merged[key_columns + ['count', 'total', 'm2', 'min', 'max']]
+
+
+def bin_quantiles(bins):
+    # Quantiles per key from its histogram, with pandas' (linear) definition: the k-th smallest value is placed
+    # inside its bin as if the bin's values were spread evenly, so a quantile is off by at most one bin
+    bins = bins.sort_values(key_columns + ['bin'], kind='stable')
+    rows = []
+    for key, key_bins in bins.groupby(key_columns, sort=False):
+        counts = key_bins['count'].to_numpy(dtype=float)
+        cumulative = np.cumsum(counts)
+        lower_edges = key_bins['bin'].to_numpy(dtype=float) * bin_days
+
+        def order_statistic(k):
+            i = int(np.searchsorted(cumulative, k, side='right'))
+            before = cumulative[i - 1] if i > 0 else 0.0
+            return lower_edges[i] + (k - before + 0.5) / counts[i] * bin_days
+
+        row = dict(zip(key_columns, key))
+        for name, q in quantiles.items():
+            position = (cumulative[-1] - 1) * q
+            k = int(position)
+            row[name] = order_statistic(k)
+            if k + 1 < cumulative[-1]:
+                row[name] += (position - k) * (order_statistic(k + 1) - row[name])
+        rows.append(row)
+    return pd.DataFrame(rows, columns=key_columns + list(quantiles)).astype({column: "int64" for column in key_columns})
+
+
+class LifetimeStore:
+    # One connection per process, shared by its threads under the lock; every fold is one write transaction
+    def __init__(self, path=None):
+        self.path = path or lifetime_db
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        self.loaded = False
+        self.retry_at = 0.0
+        self.refresh_thread = None
+        self.refresh_lock = threading.Lock()
+
+    def connection(self):
+        # Opened again in a forked child: an SQLite connection must not be used across fork
+        if self.conn is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(schema_sql)
+            self.conn, self.pid = conn, os.getpid()
+        return self.conn
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock before the affected rows are read, so a fold's read-merge-write is
+        # never interleaved with another process's
+        with self.lock:
+            conn = self.connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def read(self, sql, params=()):
+        with self.lock:
+            return pd.read_sql_query(sql, self.connection(), params=params)
+
+    def load(self):
+        # Seeds an empty store from the export on first use; in one transaction, so processes starting together seed it once.
+        # An export of unknown date is not seeded: the store starts at the epoch and the first refresh reads every ragout event
+        with self.transaction() as conn:
+            if "watermark" not in read_state(conn):
+                try:
+                    if not os.path.exists(seed_csv):
+                        raise ValueError(f"{seed_csv} not found")
+                    self.seed_rows(conn, seed_csv, seed_as_of)
+                except ValueError as e:
+                    logger.warning("not seeding the lifetime store: %s; reading the whole ragout history instead", e)
+                    write_state(conn, watermark=pd.Timestamp(epoch).isoformat(), refreshed_at=0.0)
+        self.loaded = True
+
+    def seed(self, path, as_of=None):
+        with self.transaction() as conn:
+            self.seed_rows(conn, path, as_of)
+        self.loaded = True
+
+    def seed_rows(self, conn, path, as_of=None):
+        # The export has no rfid_ids, so events it already holds are told apart by time: the watermark starts at
+        # as_of (the date of the export; its latest last_updated_date by default) and only RFIDs updated after it
+        # are read from the backend
+        events = pd.read_csv(path)
+        if as_of:
+            as_of = pd.Timestamp(as_of)
+            as_of = as_of.tz_localize('UTC') if as_of.tz is None else as_of.tz_convert('UTC')
+        elif 'last_updated_date' in events and events['last_updated_date'].notna().any():
+            as_of = pd.to_datetime(events['last_updated_date'], utc=True).max()
+        else:
+            raise ValueError(f"{path} has no last_updated_date column, so the date of the export must be given (--as-of)")
+        events = events[['customer_id', 'item_type_id', 'lifetime']].assign(rfid_id=None, lifetime=events['lifetime'].astype(float))
+        for table in ["lifetime_stats", "lifetime_bins", "lifetime_seen", "lifetime_state"]:
+            conn.execute(f"DELETE FROM {table}")
+        self.add_rows(conn, events)
+        write_state(conn, watermark=as_of.isoformat(), seeded_from=path, refreshed_at=0.0)
+
+    def add_rows(self, conn, events):
+        # Folds events (customer_id, rfid_id, item_type_id, lifetime) into the rows of their keys; returns how many were new.
+        # Reads and writes only the affected keys' rows and the events' RFIDs, whatever the size of the history
+        events = events[~(events['rfid_id'].notna() & events.duplicated(['customer_id', 'rfid_id']))].reset_index(drop=True)
+        rfid_events = events[events['rfid_id'].notna()]
+        if not rfid_events.empty:
+            # Seed rows have no rfid_id and are all counted; RFIDs already in lifetime_seen are skipped
+            conn.execute("DELETE FROM temp.lifetime_batch")
+            conn.executemany("INSERT INTO temp.lifetime_batch VALUES (?, ?)",
+                             zip(rfid_events['customer_id'].astype(int).tolist(), rfid_events['rfid_id'].tolist()))
+            seen = conn.execute(seen_sql).fetchall()
+            if seen:
+                seen_index = pd.MultiIndex.from_tuples(seen, names=['customer_id', 'rfid_id'])
+                events = events[~pd.MultiIndex.from_frame(events[['customer_id', 'rfid_id']]).isin(seen_index)].reset_index(drop=True)
+            conn.execute("INSERT OR IGNORE INTO lifetime_seen SELECT customer_id, rfid_id FROM temp.lifetime_batch")
+        if events.empty:
+            return 0
+
+        keys = events[key_columns].drop_duplicates()
+        customer_ids = keys['customer_id'].astype(int).unique().tolist()
+        placeholders = ', '.join('?' * len(customer_ids))
+        old_stats = pd.read_sql_query(f"SELECT {', '.join(stats_columns)} FROM lifetime_stats WHERE customer_id IN ({placeholders})", conn, params=customer_ids)
+        old_bins = pd.read_sql_query(f"SELECT {', '.join(bins_dtypes)} FROM lifetime_bins WHERE customer_id IN ({placeholders})", conn, params=customer_ids)
+        old_stats = old_stats.astype({column: stats_dtypes[column] for column in stats_columns}).merge(keys, on=key_columns)
+        old_bins = old_bins.astype(bins_dtypes).merge(keys, on=key_columns)
+
+        stats = merge_stats(old_stats, batch_stats(events))
+        bins = events.assign(bin=np.floor(events['lifetime'] / bin_days).astype(np.int64)).groupby(key_columns + ['bin']).size().reset_index(name='count')
+        bins = pd.concat([df for df in [old_bins, bins] if not df.empty], ignore_index=True).groupby(key_columns + ['bin'], as_index=False)['count'].sum()
+        stats = pd.merge(stats, bin_quantiles(bins), on=key_columns, how='left').astype(stats_dtypes)
+
+        conn.executemany(insert_sql("lifetime_stats", stats_dtypes), stats[list(stats_dtypes)].astype(object).itertuples(index=False))
+        conn.executemany(insert_sql("lifetime_bins", bins_dtypes), bins[list(bins_dtypes)].astype(object).itertuples(index=False))
+        return events.shape[0]
+
+    def due(self):
+        return time.time() >= self.retry_at and time.time() - float(self.state().get("refreshed_at", 0)) >= refresh_interval
+
+    def refresh(self, force=False):
+        # Reads the ragout events whose RFID rows changed since the watermark; a failed read keeps the current stats and
+        # is tried again after refresh_retry seconds. refreshed_at is committed with the rows, so it only moves on a
+        # successful read; processes that read the same events meanwhile count them once (lifetime_seen)
+        if not self.loaded:
+            self.load()
+        if not force and not self.due():
+            return 0
+
+        watermark = pd.Timestamp(self.state().get("watermark") or epoch)
+        with instrumentation.span("lifetime.refresh") as span:
+            try:
+                df = db.get_backend().read_sql(ragout_events_sql, {"watermark": watermark.to_pydatetime()}, name="ragout_events")
+            except Exception as e:
+                logger.warning("could not read ragout events: %r", e)
+                self.retry_at = time.time() + refresh_retry
+                return 0
+            with self.transaction() as conn:
+                added = self.add_rows(conn, lifetime_events(df))
+                state = {"refreshed_at": time.time()}
+                if not df.empty:
+                    # Another process may have moved the watermark further meanwhile
+                    latest = pd.to_datetime(df['last_updated_date'], utc=True).max()
+                    current = read_state(conn).get("watermark")
+                    if current is None or latest > pd.Timestamp(current):
+                        state["watermark"] = latest.isoformat()
+                write_state(conn, **state)
+            span.rows_in, span.rows_out = df.shape[0], added
+        return added
+
+    def refresh_in_background(self):
+        # Starts refresh() on a daemon thread when one is due and none is running, and returns at once
+        with self.refresh_lock:
+            if self.refresh_thread is not None and self.refresh_thread.is_alive():
+                return None
+            if not self.loaded:
+                self.load()
+            if not self.due():
+                return None
+            self.refresh_thread = threading.Thread(target=self.refresh, name="lifetime-refresh", daemon=True)
+            self.refresh_thread.start()
+            return self.refresh_thread
+
+    def state(self):
+        with self.lock:
+            return read_state(self.connection())
+
+    def size(self):
+        with self.lock:
+            return self.connection().execute("SELECT count(*) FROM lifetime_stats").fetchone()[0]
+
+    def lookup(self, customer_id):
+        # The customer's rows: one per item type with count, total (sum of lifetimes), mean, std, min, max and the quantiles.
+        # Returns the rows as they are; a due refresh runs in the background and shows up on a later lookup
+        self.refresh_in_background()
+        rows = self.read(f"SELECT {', '.join(stats_dtypes)} FROM lifetime_stats WHERE customer_id = ?", (int(customer_id),)).astype(stats_dtypes)
+        rows = rows.assign(mean=rows['total'] / rows['count'],
+                           std=np.sqrt(rows['m2'] / (rows['count'] - 1).where(rows['count'] > 1)))
+        return rows[lookup_columns]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = LifetimeStore()
+    return _store
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the per customer and item type lifetime statistics")
+    parser.add_argument("command", choices=["seed", "refresh"], help="start over from a CSV export, or add the ragout events since the last refresh")
+    parser.add_argument("--csv", default=seed_csv, help="seed: export with item_type_id, customer_id, lifetime columns")
+    parser.add_argument("--as-of", type=datetime.date.fromisoformat, help="seed: date of the export (default: its latest last_updated_date; required when it has none)")
+    parser.add_argument("--path", default=lifetime_db, help="SQLite file of the store")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    store = LifetimeStore(args.path)
+    if args.command == "seed":
+        try:
+            store.seed(args.csv, args.as_of)
+        except ValueError as e:
+            sys.exit(f"error: {e}")
+        print(f"seeded {store.size()} customer / item type rows from {args.csv}")
+    else:
+        print(f"added {store.refresh(force=True)} ragout events; watermark {store.state().get('watermark')}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
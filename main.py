@@ -1,12 +1,19 @@
 import streamlit as st
-import pandas as pd 
-import datetime
-import numpy as np
-import plotly.graph_objs as go
 import plotly.express as px
 import database as db
 import prediction_model as ml 
+import depletion_engine as engine 
+import instrumentation 
+import detail_table 
+import lifetime_store 
+import history_store 
+import figures 
+import portfolio 
+import results_store 
+import api 
+import datetime 
 import math 
+import time 
 
 st.set_page_config(page_title='Laundris Depletion Rate', layout='wide') 
 
@@ -22,347 +29,157 @@ def color_depletion_table(val):
     return f'background-color: {color}'  
 
 
-def get_rounded_value(value): 
-    return float('{:.2f}'.format(value)) 
+def show_chart(container, name, fig): 
+    with instrumentation.span(f"render.{name}"): 
+        container.plotly_chart(fig, use_container_width=True) 
 
 
-def get_next_month(current_month):
-    # Convert the month name to a datetime object
-    current_date = datetime.datetime.strptime(current_month, '%B')
+def show_table(container, name, table): 
+    # table is a DataFrame or a Styler over one 
+    rows = table.data.shape[0] if hasattr(table, 'data') else table.shape[0] 
+    with instrumentation.span(f"render.{name}", rows_in=rows): 
+        container.dataframe(table, use_container_width=True, hide_index=True) 
 
-    # Calculate the first day of the next month
-    first_day_of_next_month = current_date.replace(day=1) + datetime.timedelta(days=32)
 
-    # Get the name of the next month
-    next_month_name = first_day_of_next_month.strftime('%B')
+def debug_panel_enabled(): 
+    return instrumentation.debug_panel or st.query_params.get("debug") == "1" 
 
-    return next_month_name
 
-
-def get_previous_month(current_month):
-    # Convert the current month name to a datetime object
-    current_date = datetime.datetime.strptime(current_month, '%B')
-
-    # Calculate the first day of the current month
-    first_day_of_current_month = current_date.replace(day=1)
-
-    # Calculate the last day of the previous month
-    last_day_of_previous_month = first_day_of_current_month - datetime.timedelta(days=1)
-
-    # Get the name of the previous month
-    previous_month_name = last_day_of_previous_month.strftime('%B')
-
-    return previous_month_name
-
-
-def get_ragout_month(days): 
-    current_date = datetime.datetime.now()  
-
-    # Calculate the new date by adding the specified number of days
-    new_date = current_date + datetime.timedelta(days=days)
-
-    # Get the resulting month in words
-    resulting_month = new_date.strftime("%B")
-
-    return resulting_month
+def show_debug_panel(rerun): 
+    # The spans of this rerun so far (everything but the panel itself) 
+    spans_df = rerun.frame() 
+    spans_df['peak_mb'] = spans_df.pop('peak_bytes') / 2**20 
+    spans_df['rss_mb'] = spans_df.pop('rss_bytes') / 2**20 
+    expander = st.expander("🛠 Stage timings (this rerun)") 
+    expander.caption("{} spans, {:.2f}s into the rerun".format(spans_df.shape[0], time.perf_counter() - rerun.started)) 
+    expander.dataframe(spans_df, use_container_width=True, hide_index=True) 
 
 
 def main(): 
+    # One trace per rerun: logged as a JSON line when the rerun ends and added to the /metrics totals 
+    instrumentation.start_metrics_server() 
+    api.start_server() # the JSON API on localhost, when LAUNDRIS_API_PORT is set 
+    with instrumentation.trace("rerun") as rerun: 
+        if st.sidebar.toggle("Fleet portfolio", key="portfolio_mode"): 
+            portfolio_view(rerun) 
+        else: 
+            dashboard(rerun) 
+        if debug_panel_enabled(): 
+            show_debug_panel(rerun) 
+
+
+def portfolio_view(rerun): 
+    # Every (or the selected) customer in one sortable table, read from a batch run's results; scoring the fleet is 
+    # batch_scoring's work, so nothing is computed here 
+    st.markdown('<h1 style="color:#4B7CA7;font-size:32px;">Laundris Fleet Portfolio</h1>', unsafe_allow_html=True)  
+
+    run_dates = results_store.run_dates() 
+    if not run_dates: 
+        st.info("No batch results yet: the portfolio is read from `python batch_scoring.py` runs.", icon='📊') 
+        return 
+
+    inventory_name_list, inventory_id_list = db.fetch_inventory_list() 
+    col1, col2 = st.columns((6, 2)) 
+    selected_names = col1.multiselect('Customers (all when empty)', inventory_name_list) 
+    run_date = col2.selectbox('Batch run', list(reversed(run_dates))) 
+    customer_ids = [inventory_id_list[inventory_name_list.index(name)] for name in selected_names] or inventory_id_list 
+
+    rerun.attributes['customers'] = len(customer_ids) 
+    with instrumentation.span("portfolio", rows_in=len(customer_ids)) as span: 
+        fleet_df, par_df, missing, _ = portfolio.fetch_stored_portfolio(tuple(customer_ids), tuple(zip(inventory_id_list, inventory_name_list)), run_date) 
+        span.rows_out = fleet_df.shape[0] 
+
+    if missing: 
+        st.warning("The batch run of {} did not score {:,} customers: {}".format(run_date, len(missing), ", ".join(str(customer_id) for customer_id in missing)), icon='⚠️') 
+    if fleet_df.empty: 
+        return 
+
+    totals = fleet_df[portfolio.count_columns].sum() 
+    st.info("Fleet depletion rate: **{:,} of {:,} items ({:.2f}%)** across {:,} customers".format( 
+        totals['Lost'] + totals['Ragout'], totals['Items'], (totals['Lost'] + totals['Ragout']) / totals['Items'] * 100 if totals['Items'] else 0, 
+        fleet_df.shape[0]), icon='🛑') 
+
+    # Click a column header to sort 
+    show_table(st, "portfolio", fleet_df.style.format({'Depletion Rate (%)': '{:.2f}'})) 
+
+
+def dashboard(rerun): 
     st.markdown('<h1 style="color:#4B7CA7;font-size:32px;">Laundris Depletion Rate Analysis</h1>', unsafe_allow_html=True)  
 
+    ml.get_registry() # load and validate the model artifacts once per process 
+
     inventory_name_list, inventory_id_list = db.fetch_inventory_list() # fetch customer list 
 
     col1, col2, col3, col4 = st.columns((4, 5, 5, 3))
     selected_customer_name = col1.selectbox('Select Customer', inventory_name_list) 
     selected_inventory_id = inventory_id_list[inventory_name_list.index(selected_customer_name)] 
+    rerun.attributes['customer_id'] = selected_inventory_id 
 
-    df, order_cycle_df, inactive_status_items_df = db.fetch_data(selected_inventory_id) # fetch main data 
-    total_number = order_cycle_df.shape[0]
-
-    active_items_df = order_cycle_df[order_cycle_df.inactive_time <= 90]
-
-    inactive_90_days_df = order_cycle_df[order_cycle_df.inactive_time > 90] 
-    n_inactive_90_days = inactive_90_days_df.shape[0] 
-    p_inactive_90_days = (n_inactive_90_days/total_number)*100 
-
-    # Predict ragout [current state]
-    active_items_df['customer_id'] = selected_inventory_id
-    inactive_90_days_df['customer_id'] = selected_inventory_id
-
-    features = ['rfid_id', 'customer_id', 'item_type_id', 'total_washes', 'pickup_count', 'dropoff_count', 'creation_date', 'birthday', 'last_updated_date']
-    labeled_data = ml.predict_ragout_group(inactive_90_days_df[features]) 
-    inactive_90_days_df = pd.merge(inactive_90_days_df, labeled_data, on='rfid_id', how='inner') 
-    
-    inactive_90_days_df['Label'] = 'normal'
-    inactive_90_days_df.loc[inactive_90_days_df['prediction'] == 1, 'Label'] =  'ragout'
-
-    # Label items as loss 
-    inactive_90_days_df.loc[(inactive_90_days_df['pickup_count'] <= 1) & (inactive_90_days_df['dropoff_count'] <= 1) 
-                            & (inactive_90_days_df['prediction'] == 0), 'Label'] =  'lost'
-    
-
-
-    # Prepare to show 
-    today = pd.Timestamp(datetime.date.today(), tz='UTC')  
-    active_items_df['usage_period'] = today - active_items_df['creation_date']
-    active_items_df['usage_period'] = active_items_df['usage_period'].dt.days 
-
-    inactive_90_days_df['usage_period'] = today - inactive_90_days_df['creation_date']
-    inactive_90_days_df['usage_period'] = inactive_90_days_df['usage_period'].dt.days  
+    # The stages inside fetch_data (queries, merges) only show up when it is not served from st.cache_data 
+    with instrumentation.span("fetch_data") as span: 
+        df, order_cycle_df, inactive_status_items_df = db.fetch_data(selected_inventory_id) # fetch main data 
+        span.rows_out = order_cycle_df.shape[0] 
 
-    inactive_90_days_df['creation_date'] = inactive_90_days_df['creation_date'].dt.date
-    inactive_90_days_df['last_updated_date'] = inactive_90_days_df['last_updated_date'].dt.date 
-    inactive_90_days_df['birthday'] = inactive_90_days_df['birthday'].dt.date  
+    item_type_ids =  list(order_cycle_df.item_type_id.unique()) 
+    with instrumentation.span("get_desired_quantity", rows_in=len(item_type_ids)) as span: 
+        room_profile_df = db.get_desired_quantity(item_type_ids, selected_inventory_id)
+        span.rows_out = room_profile_df.shape[0] 
 
-    ragout_df = inactive_90_days_df[inactive_90_days_df.Label == 'ragout']
-    normal_df = inactive_90_days_df[inactive_90_days_df.Label == 'normal']
-    lost_df   = inactive_90_days_df[inactive_90_days_df.Label == 'lost']
+    # Labels, ragout predictions and par-level tables; reused across reruns while the data and the date are unchanged 
+    with instrumentation.span("engine.run", rows_in=order_cycle_df.shape[0]): 
+        depletion = engine.get_engine().run(selected_inventory_id, order_cycle_df, inactive_status_items_df, room_profile_df) 
 
-    n_ragout = ragout_df.shape[0] 
-    n_normal = normal_df.shape[0] 
-    n_lost   = lost_df.shape[0]
+    inactive_90_days_df = depletion.inactive_items 
+    n_inactive_90_days, p_inactive_90_days = depletion.n_inactive, depletion.p_inactive 
 
-    p_depletion = (n_ragout + n_lost)/total_number
+    ragout_df = depletion.ragout_items 
+    normal_df = depletion.normal_items 
+    lost_df   = depletion.lost_items 
+    active_items_df = depletion.active_items 
 
+    n_ragout, n_normal, n_lost = depletion.n_ragout, depletion.n_normal, depletion.n_lost 
+    p_depletion = depletion.p_depletion 
 
     # Heatmap 
-    depletion_grouped_data = inactive_90_days_df.groupby(['item_type_name', 'Label']).size().reset_index(name='count') 
-    heatmap_pivot_table = depletion_grouped_data.pivot(index='item_type_name', columns='Label', values='count')
-    heatmap_pivot_table.fillna(0, inplace=True)
-    if n_ragout == 0: 
-        heatmap_pivot_table['ragout'] = 0 
-    elif n_lost == 0: 
-        heatmap_pivot_table['lost'] = 0 
-    elif n_normal == 0: 
-        heatmap_pivot_table['normal'] = 0 
-    else: 
-        pass  
-
-    heatmap_pivot_table.rename(columns={"lost":"Lost", "normal":"Normal","ragout":"Ragout"}, inplace=True)
-    cols = ['Lost', 'Ragout', 'Normal'] 
-    heatmap_pivot_table = heatmap_pivot_table[cols] 
-
+    heatmap_pivot_table = depletion.label_heatmap 
     custom_color_scale = ['#FFFFFF', '#eb827f'] 
-    delation_heatmap_fig = px.imshow(heatmap_pivot_table,  
-                                labels=dict(x="Category", y="Item Type"), 
-                                x=heatmap_pivot_table.columns, text_auto=True, color_continuous_scale=custom_color_scale, aspect="auto")  
-
-
-    ragout_group = ragout_df.item_type_name.value_counts()
-    ragout_group = ragout_group.reset_index()  
-    ragout_group.columns = ['Item Type', 'Items Count']
-    ragout_last_operation_group = ragout_df.last_operation.value_counts()
-    ragout_last_operation_group = ragout_last_operation_group.reset_index()  
-    ragout_last_operation_group.columns = ['Last Operation', 'Items Count'] 
-
-
-    normal_group = normal_df.item_type_name.value_counts()
-    normal_group = normal_group.reset_index()  
-    normal_group.columns = ['Item Type', 'Items Count']
-    normal_last_operation_group = normal_df.last_operation.value_counts()
-    normal_last_operation_group = normal_last_operation_group.reset_index()  
-    normal_last_operation_group.columns = ['Last Operation', 'Items Count']
-
-    lost_group = lost_df.item_type_name.value_counts()
-    lost_group = lost_group.reset_index()  
-    lost_group.columns = ['Item Type', 'Items Count']
-    lost_last_operation_group = lost_df.last_operation.value_counts()
-    lost_last_operation_group = lost_last_operation_group.reset_index()  
-    lost_last_operation_group.columns = ['Last Operation', 'Items Count']
-
-    lost_location_group = lost_df.location_type.value_counts().reset_index() 
-    lost_location_group.columns = ['Location', 'Count'] 
-
-    active_last_operation_group = active_items_df.last_operation.value_counts()
-    active_last_operation_group = active_last_operation_group.reset_index()  
-    active_last_operation_group.columns = ['Last Operation', 'Items Count']
+    with instrumentation.span("figure.label_heatmap", rows_in=heatmap_pivot_table.shape[0]): 
+        delation_heatmap_fig = figures.heatmap("label_heatmap", heatmap_pivot_table, dict(x="Category", y="Item Type"), custom_color_scale) 
 
+    ragout_group, ragout_last_operation_group = depletion.ragout_by_item_type, depletion.ragout_by_last_operation 
+    normal_group, normal_last_operation_group = depletion.normal_by_item_type, depletion.normal_by_last_operation 
+    lost_group, lost_last_operation_group = depletion.lost_by_item_type, depletion.lost_by_last_operation 
+    lost_location_group = depletion.lost_by_location 
+    active_last_operation_group = depletion.active_by_last_operation 
 
-    ### active items that are inactive for less than 90 days 
-    features = ['rfid_id', 'customer_id', 'item_type_id', 'total_washes', 'pickup_count', 'dropoff_count', 'creation_date', 'birthday', 'last_updated_date']
-    labeled_data = ml.predict_ragout_time_group(active_items_df[features], 30) 
-    active_items_df = pd.merge(active_items_df, labeled_data, on='rfid_id', how='inner')  
-
-    active_items_df.loc[(active_items_df['inactive_time'] < 30) & (active_items_df['last_operation'] == 'No order cycle'), 'predicted_ragout_time'] = 250 
-    active_items_df.loc[active_items_df['inactive_time'] < 5, 'predicted_ragout_time'] = active_items_df['predicted_ragout_time']  + 45  
-
-    if n_normal > 0: 
-        features = ['rfid_id', 'customer_id', 'item_type_id', 'total_washes', 'pickup_count', 'dropoff_count', 'creation_date', 'birthday', 'last_updated_date']
-        labeled_data = ml.predict_ragout_time_group(normal_df[features], 0) 
-        normal_df = pd.merge(normal_df, labeled_data, on='rfid_id', how='inner')  
-        normal_df['ragout_month'] = normal_df.apply(lambda x: get_ragout_month (x['predicted_ragout_time']), axis=1)  
-
-
-    active_items_df['ragout_month'] = active_items_df.apply(lambda x: get_ragout_month (x['predicted_ragout_time']), axis=1)  
-
-    ## create par level heatmap s
-    columns = ['rfid_id', 'item_type_name', 'side', 'last_operation', 'ragout_month', 'predicted_ragout_time']
-     
-    item_heatmap = order_cycle_df.item_type_name.value_counts()
-    item_heatmap = item_heatmap.reset_index()  
-    item_heatmap.columns = ['Item Type', 'Total Items Count']
-
-    item_heatmap = item_heatmap.merge(ragout_group, on='Item Type', how='left') 
-    item_heatmap.rename(columns={"Items Count": "Current Ragout Items"}, inplace=True)
-
-    item_heatmap = item_heatmap.merge(lost_group, on='Item Type', how='left') 
-    item_heatmap.rename(columns={"Items Count": "Current Lost Items"}, inplace=True)
-
-    if n_normal > 0: 
-        normal_items_df = pd.concat([normal_df[columns], active_items_df[columns]])
-    else: 
-        normal_items_df = active_items_df[columns]
-
-    pickedup_items_df = normal_items_df[normal_items_df.side == 'facility']
-    pickedup_items_group = pickedup_items_df.item_type_name.value_counts()
-    pickedup_items_group = pickedup_items_group.reset_index()  
-    pickedup_items_group.columns = ['Item Type', 'On Facility Items Count']
-
-    item_heatmap = item_heatmap.merge(pickedup_items_group, on='Item Type', how='left') 
-    
-    # Get the current date and time
-    current_date = datetime.datetime.now()
-    # Get the current month in words
-    current_month = current_date.strftime("%B")
-    next_first_month = get_next_month(current_month)
-    next_second_month =  get_next_month(next_first_month)
-    last_first_month = get_previous_month(current_month)
-    last_second_month = get_previous_month(last_first_month)
-
-
-    current_month_df = normal_items_df[normal_items_df.ragout_month == current_month] 
-    current_month_group = current_month_df.item_type_name.value_counts()
-    current_month_group = current_month_group.reset_index()  
-    current_month_group.columns = ['Item Type', f'Ragout on {current_month}']
-
-    item_heatmap = item_heatmap.merge(current_month_group, on='Item Type', how='left')  
-
-    item_type_ids =  list(order_cycle_df.item_type_id.unique()) 
-
-    room_profile_df = db.get_desired_quantity(item_type_ids, selected_inventory_id)
-    item_heatmap = pd.merge(item_heatmap, room_profile_df, on='Item Type') 
-
-    # previous months data 
-    current_date = pd.Timestamp(current_date, tz='UTC')
-    last_first_month_start =  current_date - pd.Timedelta(days=60) 
-    last_second_month_start =  current_date - pd.Timedelta(days=90)
-
-    last_first_month_df = inactive_status_items_df[(inactive_status_items_df.ragout_date < current_date) & (inactive_status_items_df.ragout_date>last_first_month_start)]
-    last_second_month_df = inactive_status_items_df[(inactive_status_items_df.ragout_date < last_first_month_start) & (inactive_status_items_df.ragout_date>last_second_month_start)] 
-
-    last_first_month_group = last_first_month_df.item_type_name.value_counts()
-    last_first_month_group = last_first_month_group.reset_index()  
-    last_first_month_group.columns = ['Item Type', f'{last_first_month} Ragout Items']  
-
-    last_second_month_group = last_second_month_df.item_type_name.value_counts()
-    last_second_month_group = last_second_month_group.reset_index()  
-    last_second_month_group.columns = ['Item Type', f'{last_second_month} Ragout Items']  
-
-    item_heatmap = pd.merge(item_heatmap, last_first_month_group, on='Item Type', how='left')
-    item_heatmap = pd.merge(item_heatmap, last_second_month_group, on='Item Type', how='left')
-
-    ### previous lost 
-    last_second_month_lost_df = lost_df[(lost_df.inactive_time - 60) > 110]
-    last_first_month_lost_df = lost_df[(lost_df.inactive_time - 30) > 110]
-
-    last_second_month_lost_group = last_second_month_lost_df.item_type_name.value_counts()
-    last_second_month_lost_group = last_second_month_lost_group.reset_index()  
-    last_second_month_lost_group.columns = ['Item Type', f'{last_second_month} Lost Items']
-
-    last_first_month_lost_group = last_first_month_lost_df.item_type_name.value_counts()
-    last_first_month_lost_group = last_first_month_lost_group.reset_index()  
-    last_first_month_lost_group.columns = ['Item Type', f'{last_first_month} Lost Items']
-
-    item_heatmap = pd.merge(item_heatmap, last_first_month_lost_group, on='Item Type', how='left')
-    item_heatmap = pd.merge(item_heatmap, last_second_month_lost_group, on='Item Type', how='left')
-
-    item_heatmap.fillna(0, inplace=True) 
-
-    item_heatmap['Current Available Items'] = item_heatmap['Total Items Count'] - item_heatmap['Current Lost Items'] - item_heatmap['Current Ragout Items'] - item_heatmap[f'Ragout on {current_month}']
-    item_heatmap[f'{last_first_month} Lost Items'] = item_heatmap[f'{last_first_month} Lost Items'] - item_heatmap[f'{last_second_month} Lost Items']
-    item_heatmap['Current Lost Items'] = item_heatmap['Current Lost Items'] - item_heatmap[f'{last_first_month} Lost Items'] - item_heatmap[f'{last_second_month} Lost Items']
-
-    item_heatmap[f'Available Items ({last_second_month})'] = item_heatmap['Total Items Count'] - item_heatmap[f'{last_second_month} Lost Items']
-    item_heatmap[f'Available Items ({last_first_month})'] = item_heatmap['Total Items Count'] - item_heatmap[f'{last_second_month} Lost Items'] - item_heatmap[f'{last_first_month} Lost Items']
-
-    item_heatmap[f'{last_second_month}'] = item_heatmap[f'Available Items ({last_second_month})']/item_heatmap['Desired Quantity'] * 100
-    item_heatmap[f'{last_first_month}'] = item_heatmap[f'Available Items ({last_first_month})']/item_heatmap['Desired Quantity'] * 100
-    item_heatmap[f'{last_second_month}'] = item_heatmap[f'{last_second_month}'].apply(get_rounded_value)
-    item_heatmap[f'{last_first_month}'] = item_heatmap[f'{last_first_month}'].apply(get_rounded_value)
-
-    next_first_month_df = normal_items_df[normal_items_df.ragout_month == next_first_month] 
-    next_second_month_df = normal_items_df[normal_items_df.ragout_month == next_second_month]
-
-    next_first_month_group = next_first_month_df.item_type_name.value_counts()
-    next_first_month_group = next_first_month_group.reset_index()  
-    next_first_month_group.columns = ['Item Type', f'Ragout on {next_first_month}'] 
-
-    next_second_month_group = next_second_month_df.item_type_name.value_counts()
-    next_second_month_group = next_second_month_group.reset_index()  
-    next_second_month_group.columns = ['Item Type', f'Ragout on {next_second_month}']   
-    
-    item_heatmap = item_heatmap.merge(next_first_month_group, on='Item Type', how='left')  
-    item_heatmap.fillna(0, inplace=True)
-
-    item_heatmap[f'Available on {next_first_month}'] = item_heatmap['Current Available Items'] - item_heatmap[f'Ragout on {next_first_month}']
-
-    item_heatmap = item_heatmap.merge(next_second_month_group, on='Item Type', how='left')  
-    item_heatmap.fillna(0, inplace=True)
-
-    item_heatmap[f'Available on {next_second_month}'] = item_heatmap['Current Available Items'] - item_heatmap[f'Ragout on {next_first_month}'] - item_heatmap[f'Ragout on {next_second_month}']
-
-    item_heatmap[f'{current_month}'] = item_heatmap['Current Available Items']/item_heatmap['Desired Quantity'] * 100
-    item_heatmap[f'{next_first_month}'] = item_heatmap[f'Available on {next_first_month}']/item_heatmap['Desired Quantity'] * 100
-    item_heatmap[f'{next_second_month}'] = item_heatmap[f'Available on {next_second_month}']/item_heatmap['Desired Quantity'] * 100 
-
-    item_heatmap[f'{current_month}'] = item_heatmap[f'{current_month}'].apply(get_rounded_value)
-    item_heatmap[f'{next_first_month}'] = item_heatmap[f'{next_first_month}'].apply(get_rounded_value)
-    item_heatmap[f'{next_second_month}'] = item_heatmap[f'{next_second_month}'].apply(get_rounded_value)
-
-    par_heatmap_data = item_heatmap[['Item Type', f'{last_second_month}', f'{last_first_month}', f'{current_month}', f'{next_first_month}', f'{next_second_month}']]
-    
-    item_heatmap.rename(columns={"Current Available Items":f"Available Items ({current_month})", 
-                                 f"{current_month}":f"Par level ({current_month})", 
-                                 "Current Lost Items": f"{current_month} Lost Items", 
-                                 "Current Ragout Items": f"{current_month} Ragout Items", 
-                                 f"Ragout on {next_first_month}":f"{next_first_month} Ragout Items", 
-                                 f"Ragout on {next_second_month}":f"{next_second_month} Ragout Items", 
-                                 f"Available on {next_first_month}": f"Available Items ({next_first_month})", 
-                                 f"Available on {next_second_month}": f"Available Items ({next_second_month})",  
-                                 f"{next_first_month}": f"Par level ({next_first_month})",  
-                                 f"{next_second_month}": f"Par level ({next_second_month})", 
-                                 f"{last_first_month}": f"Par level ({last_first_month})",  
-                                 f"{last_second_month}": f"Par level ({last_second_month})"
-                                 }, inplace=True)
-    
-    available_heatmap_data = item_heatmap[['Item Type', f"Available Items ({last_second_month})",f"Available Items ({last_first_month})", 
-                                           f"Available Items ({current_month})", f"Available Items ({next_first_month})", f"Available Items ({next_second_month})"]]
-    
-    item_heatmap[f'{next_first_month} Lost Items'] = (item_heatmap[f'{current_month} Lost Items'] + item_heatmap[f'{last_first_month} Lost Items'] + item_heatmap[f'{last_second_month} Lost Items']) / 3 
-    item_heatmap[f'{next_second_month} Lost Items'] = (item_heatmap[f'{current_month} Lost Items'] + item_heatmap[f'{last_first_month} Lost Items'] + item_heatmap[f'{last_second_month} Lost Items']) / 3  
-    item_heatmap[f'{next_first_month} Lost Items'] = item_heatmap[f'{next_first_month} Lost Items'].apply(math.ceil)
-    item_heatmap[f'{next_second_month} Lost Items'] = item_heatmap[f'{next_second_month} Lost Items'].apply(math.ceil)
-
-    # st.dataframe(item_heatmap)
-
-    par_heatmap_data.set_index("Item Type", inplace=True)
-    available_heatmap_data.set_index("Item Type", inplace=True)
+    ## par level heatmaps 
+    # Past months show their last snapshot recorded by the batch jobs, where there is one 
+    item_heatmap, par_heatmap_data, available_heatmap_data = history_store.with_history(depletion) 
 
     custom_color_scale = ['#eb827f', '#FFFFFF', '#FFFFFF', '#FFFFFF', '#FFFFFF', '#FFFFFF', '#FFFFFF', '#FFFFFF', '#FFFFFF']
 
-    par_heatmap_fig = px.imshow(par_heatmap_data,  
-                                labels=dict(x="Month", y="Item Type"), 
-                                x=par_heatmap_data.columns, text_auto=True, color_continuous_scale=custom_color_scale, aspect="auto")   
+    with instrumentation.span("figure.par_heatmap", rows_in=par_heatmap_data.shape[0]): 
+        par_heatmap_fig = figures.heatmap("par_heatmap", par_heatmap_data, dict(x="Month", y="Item Type"), custom_color_scale) 
     
-    availability_heatmap_fig = px.imshow(available_heatmap_data,  
-                                labels=dict(x="Month", y="Item Type"), 
-                                x=par_heatmap_data.columns, text_auto=True, color_continuous_scale=custom_color_scale, aspect="auto") 
+    with instrumentation.span("figure.availability_heatmap", rows_in=available_heatmap_data.shape[0]): 
+        availability_heatmap_fig = figures.heatmap("availability_heatmap", available_heatmap_data, dict(x="Month", y="Item Type"), 
+                                                   custom_color_scale, x=par_heatmap_data.columns) 
     
-    tab1, tab2 = st.tabs(['By Availability', 'By Par Level'])
-    tab1.plotly_chart(availability_heatmap_fig, use_container_width=True)  
-    tab2.plotly_chart(par_heatmap_fig, use_container_width=True) 
+    trend_start = depletion.today - datetime.timedelta(days=history_store.trend_days) 
+    history_df = history_store.trend(selected_inventory_id, trend_start, depletion.today) 
+
+    tab1, tab2, tab3 = st.tabs(['By Availability', 'By Par Level', 'Par Level Trend'])
+    show_chart(tab1, "availability_heatmap", availability_heatmap_fig) 
+    show_chart(tab2, "par_heatmap", par_heatmap_fig) 
+    if history_df.empty: 
+        tab3.caption("No daily snapshots recorded for this customer yet.") 
+    else: 
+        with instrumentation.span("figure.par_trend", rows_in=history_df.shape[0]): 
+            par_trend_fig = figures.cached("par_trend", history_df, lambda data: px.line(data, x='snapshot_date', y='par_level', color='item_type_name', 
+                                                                                       labels={'snapshot_date': 'Date', 'par_level': 'Par level (%)', 'item_type_name': 'Item Type'})) 
+        show_chart(tab3, "par_trend", par_trend_fig) 
 
-    interval_names = [last_second_month, last_first_month, current_month, next_first_month, next_second_month]   
+    interval_names = depletion.interval_names   
     interval_detail_tab_names = ["📁 " + x for x in interval_names] 
     interval_detail_tabs = st.tabs(interval_detail_tab_names) 
     
@@ -373,79 +190,71 @@ def main():
                    f"Par level ({interval_names[idt]})"] 
         
         expander = interval_detail_tabs[idt].expander(f"📁 Detailed Table for {interval_names[idt]}") 
-        expander.dataframe(item_heatmap[columns], use_container_width=True, hide_index=True) 
+        show_table(expander, f"par_detail[{idt}]", item_heatmap[columns]) 
 
     st.info("Number of items that are inactive for more than 90 days: **{:,} ({:.2f}%)**".format(n_inactive_90_days, p_inactive_90_days), icon='🛑') 
     st.info("Current depletion rate: **{:,} ({:.2f}%)**".format(n_ragout+n_lost, p_depletion*100), icon='🛑') 
 
 
-    if n_normal > 0: 
-        normal_df['predicted_ragout_time'] = normal_df['predicted_ragout_time'].astype(str) + ' days' 
-
-    active_items_df['predicted_ragout_time'] = active_items_df['predicted_ragout_time'].astype(str) + ' days'  
+    # Ragout times are shown as "<n> days"; the detail tables format only the rows on the visible page 
+    ragout_time_format = {'predicted_ragout_time': '{} days'} 
 
     ### Heatmap -------------------------------------------------------------------
-    st.plotly_chart(delation_heatmap_fig, use_container_width=True)  
+    show_chart(st, "label_heatmap", delation_heatmap_fig)  
     # Show main table 
     show_columns = ['Label', 'rfid_id', 'creation_date', 'birthday', 'last_scan_date', 'item_type_name',
                     'total_washes', 'pickup_count', 'dropoff_count', 'usage_period', 'last_operation', 'inactive_time', 'predicted_ragout'] 
     
-    st.dataframe(inactive_90_days_df[show_columns].style.applymap(color_depletion_table, subset=['Label']), 
-                   use_container_width=True, hide_index=True) 
+    detail_table.show(st, "inactive_items", inactive_90_days_df, show_columns, color_depletion_table) 
 
 
     st.info("Number of lost items: **{:,}**".format(n_lost), icon='🔎')  
     expander = st.expander("📁 Detailed Analysis") 
-    expander.dataframe(lost_df[show_columns].style.applymap(color_depletion_table, subset=['Label']), 
-                   use_container_width=True, hide_index=True) 
+    detail_table.show(expander, "lost_items", lost_df, show_columns, color_depletion_table) 
     # plotly 
-    location_pie_fig = px.pie(lost_location_group, values='Count', names='Location')
-    lost_group_bar = px.bar(lost_group, y='Items Count', x='Item Type')  
-    lost_group_bar.update_traces(marker_color='#3c8ff3') 
+    with instrumentation.span("figure.lost_by_location", rows_in=lost_location_group.shape[0]): 
+        location_pie_fig = figures.pie("lost_by_location", lost_location_group, values='Count', names='Location')
+    with instrumentation.span("figure.lost_by_item_type", rows_in=lost_group.shape[0]): 
+        lost_group_bar = figures.bar("lost_by_item_type", lost_group, x='Item Type', y='Items Count') 
     # Display the chart in Streamlit
     col1, col2 = expander.columns((6, 4))  
     col1.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Number of Items by Item Type</h4>', unsafe_allow_html=True) 
-    col1.plotly_chart(lost_group_bar, use_container_width=True) 
+    show_chart(col1, "lost_by_item_type", lost_group_bar) 
     col2.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Last Seen Location</h4>', unsafe_allow_html=True)
-    col2.plotly_chart(location_pie_fig, use_container_width=True) 
+    show_chart(col2, "lost_by_location", location_pie_fig) 
 
     col1, col2, col3 = expander.columns((4,1,5)) 
     col1.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Last Operation</h4>', unsafe_allow_html=True)
-    lost_last_operation_fig = px.bar(lost_last_operation_group, x='Items Count', y='Last Operation')  
-    lost_last_operation_fig.update_traces(marker_color='#3c8ff3')
-    lost_last_operation_fig.update_traces(width=0.5)
-    col1.plotly_chart(lost_last_operation_fig, use_container_width=True) 
+    with instrumentation.span("figure.lost_by_last_operation", rows_in=lost_last_operation_group.shape[0]): 
+        lost_last_operation_fig = figures.bar("lost_by_last_operation", lost_last_operation_group, x='Items Count', y='Last Operation', width=0.5) 
+    show_chart(col1, "lost_by_last_operation", lost_last_operation_fig) 
 
     col3.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Inactive Time Distribution</h4>', unsafe_allow_html=True)  
-    lost_inactive_distribution_fig = px.histogram(lost_df, x="inactive_time")
-    lost_inactive_distribution_fig.update_layout(bargap=0.2)
-    lost_inactive_distribution_fig.update_traces(marker_color='#3c8ff3')
-    col3.plotly_chart(lost_inactive_distribution_fig, use_container_width=True)
+    with instrumentation.span("figure.lost_inactive_time", rows_in=lost_df.shape[0]): 
+        lost_inactive_distribution_fig = figures.histogram("lost_inactive_time", lost_df['inactive_time'], "inactive_time") 
+    show_chart(col3, "lost_inactive_time", lost_inactive_distribution_fig)
 
 
     
     st.info("Number of ragout items: **{:,}**".format(n_ragout), icon='📦') 
     expander = st.expander("📁 Detailed Analysis") 
-    expander.dataframe(ragout_df[show_columns].style.applymap(color_depletion_table, subset=['Label']), 
-                   use_container_width=True, hide_index=True) 
+    detail_table.show(expander, "ragout_items", ragout_df, show_columns, color_depletion_table) 
     # plotly 
-    ragout_group_bar = px.bar(ragout_group, y='Items Count', x='Item Type')  
-    ragout_group_bar.update_traces(marker_color='#3c8ff3') 
+    with instrumentation.span("figure.ragout_by_item_type", rows_in=ragout_group.shape[0]): 
+        ragout_group_bar = figures.bar("ragout_by_item_type", ragout_group, x='Item Type', y='Items Count') 
     # Display the chart in Streamlit
-    expander.plotly_chart(ragout_group_bar, use_container_width=True) 
+    show_chart(expander, "ragout_by_item_type", ragout_group_bar) 
 
     col1, col2, col3 = expander.columns((4,1,5)) 
     col1.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Last Operation</h4>', unsafe_allow_html=True)
-    ragout_last_operation_fig = px.bar(ragout_last_operation_group, x='Items Count', y='Last Operation')  
-    ragout_last_operation_fig.update_traces(marker_color='#3c8ff3')
-    ragout_last_operation_fig.update_traces(width=0.5)
-    col1.plotly_chart(ragout_last_operation_fig, use_container_width=True) 
+    with instrumentation.span("figure.ragout_by_last_operation", rows_in=ragout_last_operation_group.shape[0]): 
+        ragout_last_operation_fig = figures.bar("ragout_by_last_operation", ragout_last_operation_group, x='Items Count', y='Last Operation', width=0.5) 
+    show_chart(col1, "ragout_by_last_operation", ragout_last_operation_fig) 
 
     col3.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Inactive Time Distribution</h4>', unsafe_allow_html=True)  
-    ragout_inactive_distribution_fig = px.histogram(ragout_df, x="inactive_time")
-    ragout_inactive_distribution_fig.update_layout(bargap=0.2)
-    ragout_inactive_distribution_fig.update_traces(marker_color='#3c8ff3')
-    col3.plotly_chart(ragout_inactive_distribution_fig, use_container_width=True)
+    with instrumentation.span("figure.ragout_inactive_time", rows_in=ragout_df.shape[0]): 
+        ragout_inactive_distribution_fig = figures.histogram("ragout_inactive_time", ragout_df['inactive_time'], "inactive_time") 
+    show_chart(col3, "ragout_inactive_time", ragout_inactive_distribution_fig)
 
 
 
@@ -458,47 +267,48 @@ def main():
                         'total_washes', 'pickup_count', 'dropoff_count', 'usage_period', 'last_operation', 'inactive_time', 'predicted_ragout', 'predicted_ragout_time', 'ragout_month']  
     
     expander = st.expander("📁 Detailed Analysis") 
-    expander.dataframe(normal_df[show_columns].style.applymap(color_depletion_table, subset=['Label']), 
-                   use_container_width=True, hide_index=True) 
+    detail_table.show(expander, "normal_items", normal_df, show_columns, color_depletion_table, formats=ragout_time_format) 
     # plotly 
-    normal_group_bar = px.bar(normal_group, y='Items Count', x='Item Type')
-    normal_group_bar.update_traces(marker_color='#3c8ff3')  
+    with instrumentation.span("figure.normal_by_item_type", rows_in=normal_group.shape[0]): 
+        normal_group_bar = figures.bar("normal_by_item_type", normal_group, x='Item Type', y='Items Count') 
     # Display the chart in Streamlit
-    expander.plotly_chart(normal_group_bar, use_container_width=True)
+    show_chart(expander, "normal_by_item_type", normal_group_bar)
 
     col1, col2, col3 = expander.columns((4,1,5)) 
     col1.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Last Operation</h4>', unsafe_allow_html=True)
-    normal_last_operation_fig = px.bar(normal_last_operation_group, x='Items Count', y='Last Operation')  
-    normal_last_operation_fig.update_traces(marker_color='#3c8ff3')
-    normal_last_operation_fig.update_traces(width=0.5)
-    col1.plotly_chart(normal_last_operation_fig, use_container_width=True) 
+    with instrumentation.span("figure.normal_by_last_operation", rows_in=normal_last_operation_group.shape[0]): 
+        normal_last_operation_fig = figures.bar("normal_by_last_operation", normal_last_operation_group, x='Items Count', y='Last Operation', width=0.5) 
+    show_chart(col1, "normal_by_last_operation", normal_last_operation_fig) 
 
     col3.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Inactive Time Distribution</h4>', unsafe_allow_html=True)  
-    normal_inactive_distribution_fig = px.histogram(normal_df, x="inactive_time")
-    normal_inactive_distribution_fig.update_layout(bargap=0.2)
-    normal_inactive_distribution_fig.update_traces(marker_color='#3c8ff3')
-    col3.plotly_chart(normal_inactive_distribution_fig, use_container_width=True)
+    with instrumentation.span("figure.normal_inactive_time", rows_in=normal_df.shape[0]): 
+        normal_inactive_distribution_fig = figures.histogram("normal_inactive_time", normal_df['inactive_time'], "inactive_time") 
+    show_chart(col3, "normal_inactive_time", normal_inactive_distribution_fig)
 
 
     # average lifetime of items 
     col1, col2 = expander.columns((4, 2))  
 
     col1.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Average Lifetime of Items based on Ragout Items</h4>', unsafe_allow_html=True)
-    lifetime_data = pd.read_csv("models/lifetime_items.csv")
-    lifetime_data = lifetime_data[lifetime_data.customer_id == selected_inventory_id]
+    # Per item type lifetime statistics, kept up to date with new ragout events (lifetime_store.py) 
+    with instrumentation.span("lifetime.lookup") as span: 
+        lifetime_data = lifetime_store.get_store().lookup(selected_inventory_id) 
+        span.rows_in = lifetime_data.shape[0] 
     
-    df_item_type = db.fetch_item_type_names() 
-    lifetime_data = lifetime_data.merge(df_item_type, on='item_type_id') 
+        df_item_type = db.fetch_item_type_names() 
+        lifetime_data = lifetime_data.merge(df_item_type, on='item_type_id') 
 
-    lifetime_group = lifetime_data[['item_type_name', 'lifetime']].groupby('item_type_name').mean()
-    lifetime_group = lifetime_group.reset_index()  
-    lifetime_group.columns = ['Item Type', 'Average Lifetime'] 
-    lifetime_group['Average Lifetime'] = lifetime_group['Average Lifetime'].apply(math.ceil) 
+        # Item types sharing a name are averaged over all their items 
+        lifetime_group = lifetime_data[['item_type_name', 'total', 'count']].groupby('item_type_name').sum()
+        lifetime_group = (lifetime_group['total'] / lifetime_group['count']).reset_index()  
+        lifetime_group.columns = ['Item Type', 'Average Lifetime'] 
+        lifetime_group['Average Lifetime'] = lifetime_group['Average Lifetime'].apply(math.ceil) 
+        span.rows_out = lifetime_group.shape[0] 
 
-    lifetime_group_fig = px.histogram(lifetime_group, y = 'Item Type', x="Average Lifetime")
-    lifetime_group_fig.update_layout(bargap=0.2)
-    lifetime_group_fig.update_traces(marker_color='#3c8ff3')
-    col1.plotly_chart(lifetime_group_fig, use_container_width=True)
+    with instrumentation.span("figure.lifetime_by_item_type", rows_in=lifetime_group.shape[0]): 
+        lifetime_group_fig = figures.cached("lifetime_by_item_type", lifetime_group, 
+                                            lambda data: px.histogram(data, y='Item Type', x="Average Lifetime").update_layout(bargap=0.2).update_traces(marker_color='#3c8ff3')) 
+    show_chart(col1, "lifetime_by_item_type", lifetime_group_fig)
 
 
 
@@ -512,27 +322,24 @@ def main():
                         'total_washes', 'pickup_count', 'dropoff_count', 'usage_period', 'last_operation', 'inactive_time', 'predicted_ragout_time']   
 
     expander = st.expander("📁 Detailed Analysis") 
-    expander.dataframe(active_items_df[show_columns], use_container_width=True, hide_index=True)  
+    detail_table.show(expander, "active_items", active_items_df, show_columns, formats=ragout_time_format)  
 
     col1, col2, col3 = expander.columns((5,1,5)) 
     col1.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Last Operation</h4>', unsafe_allow_html=True)
-    active_last_operation_fig = px.bar(active_last_operation_group, x='Items Count', y='Last Operation')  
-    active_last_operation_fig.update_traces(marker_color='#3c8ff3')
-    active_last_operation_fig.update_traces(width=0.5)
-    col1.plotly_chart(active_last_operation_fig, use_container_width=True) 
+    with instrumentation.span("figure.active_by_last_operation", rows_in=active_last_operation_group.shape[0]): 
+        active_last_operation_fig = figures.bar("active_by_last_operation", active_last_operation_group, x='Items Count', y='Last Operation', width=0.5) 
+    show_chart(col1, "active_by_last_operation", active_last_operation_fig) 
 
     col3.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Inactive Time Distribution</h4>', unsafe_allow_html=True)  
-    active_inactive_distribution_fig = px.histogram(active_items_df, x="inactive_time")
-    active_inactive_distribution_fig.update_layout(bargap=0.2)
-    active_inactive_distribution_fig.update_traces(marker_color='#3c8ff3')
-    col3.plotly_chart(active_inactive_distribution_fig, use_container_width=True)
+    with instrumentation.span("figure.active_inactive_time", rows_in=active_items_df.shape[0]): 
+        active_inactive_distribution_fig = figures.histogram("active_inactive_time", active_items_df['inactive_time'], "inactive_time") 
+    show_chart(col3, "active_inactive_time", active_inactive_distribution_fig)
 
 
     col1.markdown('<h4 style="color:#4B7CA7;font-size:16px;">Usage Period Distribution</h4>', unsafe_allow_html=True)  
-    active_usage_period_distribution_fig = px.histogram(active_items_df, x="usage_period")
-    active_usage_period_distribution_fig.update_layout(bargap=0.2)
-    active_usage_period_distribution_fig.update_traces(marker_color='#3c8ff3')
-    col1.plotly_chart(active_usage_period_distribution_fig, use_container_width=True)
+    with instrumentation.span("figure.active_usage_period", rows_in=active_items_df.shape[0]): 
+        active_usage_period_distribution_fig = figures.histogram("active_usage_period", active_items_df['usage_period'], "usage_period") 
+    show_chart(col1, "active_usage_period", active_usage_period_distribution_fig)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+import argparse
+import json
+import pickle
+import sys
+
+import database as db
+import synthetic_data
+
+
+# Memory held by fetch_data's frames per customer, in the original schema (with the exploded frame)
+# and in the compact one fetch_data returns now:
+#   python memory_report.py --customers 45 52        read the customers from the database
+#   python memory_report.py --tags 100000            every customer of a synthetic data set
+
+def frame_sizes(df):
+    # In-memory size (strings included) and the pickled size st.cache_data stores and unpickles on every access
+    if df is None:
+        return {"rows": 0, "memory_bytes": 0, "pickled_bytes": 0}
+    return {
+        "rows": df.shape[0],
+        "memory_bytes": int(df.memory_usage(deep=True).sum()),
+        "pickled_bytes": len(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)),
+    }
+
+
+def customer_report(tables, customer_id):
+    original = db.build_order_cycle_frames(tables, customer_id, include_exploded=True)
+    compact = (None,) + db.compact_frames(original[1:])
+
+    frames = {}
+    for name, original_df, compact_df in zip(db.fetch_data_frame_names, original, compact):
+        frames[name] = {"original": frame_sizes(original_df), "compact": frame_sizes(compact_df)}
+
+    totals = {version: {key: sum(sizes[version][key] for sizes in frames.values()) for key in ["memory_bytes", "pickled_bytes"]}
+              for version in ["original", "compact"]}
+    return {"customer_id": customer_id, "frames": frames, "totals": totals}
+
+
+def print_report(report):
+    print(f"customer {report['customer_id']}")
+    print(f"  {'frame':<26} {'rows':>10} {'original MB':>12} {'compact MB':>11} {'pickled MB':>19}")
+    rows = list(report["frames"].items()) + [("total", {version: dict(sizes, rows=None) for version, sizes in report["totals"].items()})]
+    for name, sizes in rows:
+        original, compact = sizes["original"], sizes["compact"]
+        row_count = original["rows"] if original["rows"] is not None else ""
+        print(f"  {name:<26} {row_count:>10} {original['memory_bytes'] / 2**20:>12.1f} {compact['memory_bytes'] / 2**20:>11.1f}"
+              f" {original['pickled_bytes'] / 2**20:>9.1f} -> {compact['pickled_bytes'] / 2**20:>6.1f}")
+
+    original, compact = report["totals"]["original"], report["totals"]["compact"]
+    if original["memory_bytes"]:
+        print(f"  memory reduced by {1 - compact['memory_bytes'] / original['memory_bytes']:.0%}, "
+              f"pickled size by {1 - compact['pickled_bytes'] / original['pickled_bytes']:.0%}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Report the memory of fetch_data's frames per customer, before and after the compact schema")
+    parser.add_argument("--customers", type=int, nargs="+", help="customer ids to read from the database")
+    parser.add_argument("--tags", type=int, help="report on synthetic data with this many RFID tags instead of the database")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the reports to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    reports = []
+    if args.tags:
+        tables = synthetic_data.generate(args.tags, seed=args.seed)
+        customer_ids = args.customers or list(tables["customer"].customer_id)
+        for customer_id in customer_ids:
+            reports.append(customer_report(synthetic_data.customer_tables(tables, customer_id), customer_id))
+            print_report(reports[-1])
+    else:
+        customer_ids = args.customers or db.fetch_inventory_list()[1]
+        for customer_id in customer_ids:
+            reports.append(customer_report(db.read_customer_tables_concurrent(customer_id), customer_id))
+            print_report(reports[-1])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
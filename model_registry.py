@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+
+import instrumentation
+
+
+logger = logging.getLogger(__name__)
+
+models_dir = os.environ.get("LAUNDRIS_MODELS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models"))
+
+# Seconds between mtime checks of an already loaded artifact
+reload_check_interval = float(os.environ.get("LAUNDRIS_MODEL_RELOAD_CHECK", "30"))
+
+ragout_features = ['item_type_id', 'customer_id', 'total_washes', 'pickup_count', 'dropoff_count', 'usage_period', 'usage_period_laundris']
+
+
+def expect_features(n_features):
+    def check(artifact):
+        if getattr(artifact, "n_features_in_", n_features) != n_features:
+            raise ValueError(f"expected {n_features} input features, artifact has {artifact.n_features_in_}")
+    return check
+
+
+def expect_method(*methods):
+    def check(artifact):
+        missing = [method for method in methods if not callable(getattr(artifact, method, None))]
+        if missing:
+            raise ValueError(f"artifact has no {', '.join(missing)}")
+    return check
+
+
+# name -> (file, required, validators). Optional artifacts may fail to load (e.g. shap is not installed)
+# without blocking startup; they raise when actually requested.
+artifact_specs = {
+    "classification_scaler": ("ragout_classification_scaler.pkl", True, [expect_method("transform"), expect_features(len(ragout_features))]),
+    "classification_model": ("ragout_classification_model_v1.pkl", True, [expect_method("predict", "predict_proba"), expect_features(len(ragout_features))]),
+    "regression_scaler": ("ragout_regression_scaler.pkl", True, [expect_method("transform"), expect_features(len(ragout_features))]),
+    "regression_model": ("ragout_regression_model_v1.pkl", True, [expect_method("predict"), expect_features(len(ragout_features))]),
+    "washing_time_model": ("washing_time_model_v1.pkl", False, [expect_method("predict")]),
+    "washing_time_explainer": ("washing_time_explainer_v1.pkl", False, []),
+}
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    # Loads every model artifact once per process and hands out the cached objects. An artifact is
+    # reloaded when its file's mtime changes and the content hash differs from the loaded one.
+    def __init__(self, specs=None, directory=None):
+        self.specs = specs or artifact_specs
+        self.directory = directory or models_dir
+        self.lock = threading.RLock()
+        self.artifacts = {}
+        self.info = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, self.specs[name][0])
+
+    def load(self, name):
+        path = self.path(name)
+        _, _, validators = self.specs[name]
+
+        # Loads of every registry in the process (dashboard sessions, the API) take turns under the tracemalloc lock
+        start = time.perf_counter()
+        with instrumentation.measure_peak() as measured:
+            with instrumentation.span(f"model.load.{name}"):
+                with open(path, "rb") as f:
+                    artifact = pickle.load(f)
+                for validate in validators:
+                    validate(artifact)
+        load_time = time.perf_counter() - start
+        peak_bytes = measured["peak_bytes"]
+
+        self.artifacts[name] = artifact
+        self.info[name] = {
+            "path": path,
+            "sha256": file_digest(path),
+            "mtime": os.path.getmtime(path),
+            "checked_at": time.monotonic(),
+            "file_bytes": os.path.getsize(path),
+            "load_peak_bytes": peak_bytes,
+            "load_time": load_time,
+            "loads": self.info.get(name, {}).get("loads", 0) + 1,
+            "error": None,
+        }
+        logger.info("loaded %s from %s in %.3fs (%d bytes peak)", name, path, load_time, peak_bytes)
+        return artifact
+
+    def is_stale(self, name):
+        info = self.info[name]
+        if time.monotonic() - info["checked_at"] < reload_check_interval:
+            return False
+        info["checked_at"] = time.monotonic()
+
+        path = self.path(name)
+        if os.path.getmtime(path) == info["mtime"]:
+            return False
+        if file_digest(path) == info["sha256"]:
+            info["mtime"] = os.path.getmtime(path)
+            return False
+        return True
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.artifacts or self.is_stale(name):
+                self.load(name)
+            return self.artifacts[name]
+
+    def validate(self):
+        # Load and check every artifact up front; required ones must load, optional failures are recorded
+        with self.lock:
+            for name, (_, required, _) in self.specs.items():
+                try:
+                    self.load(name)
+                except Exception as e:
+                    self.info[name] = {"path": self.path(name), "error": repr(e)}
+                    if required:
+                        raise
+                    logger.warning("optional model artifact %s is unavailable: %r", name, e)
+        return self.report()
+
+    def report(self):
+        with self.lock:
+            return {name: dict(info) for name, info in self.info.items()}
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            registry = ModelRegistry()
+            registry.validate()
+            _registry = registry
+    return _registry
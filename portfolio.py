@@ -0,0 +1,216 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import batch_scoring
+import database as db
+import depletion_engine as engine
+import instrumentation
+import results_store
+
+
+# Fleet view: depletion rate, lost / ragout counts and the par-level forecast of many customers in one table.
+# Customers run in batch_scoring's worker pool (model artifacts loaded once per worker, at most db_connections
+# connections between all workers); customers that a batch run already scored for the date are read from results_store.
+# The dashboard only reads results_store (stored_portfolio): scoring the fleet is the batch job's work.
+#   python portfolio.py --workers 4 --db-connections 8 --months-forward 3 --output fleet.csv
+#   python portfolio.py --customers 45 52 --sort "Lost"
+
+logger = logging.getLogger("portfolio")
+
+default_workers = int(os.environ.get("LAUNDRIS_PORTFOLIO_WORKERS", "0")) or os.cpu_count() or 1
+# 0: one connection per worker
+default_db_connections = int(os.environ.get("LAUNDRIS_PORTFOLIO_DB_CONNECTIONS", "0"))
+
+count_columns = ['Items', 'Active', 'Inactive', 'Lost', 'Ragout', 'Normal']
+
+
+def horizon(months_back=None, months_forward=None):
+    return (engine.default_months_back if months_back is None else months_back,
+            engine.default_months_forward if months_forward is None else months_forward)
+
+
+def customer_forecast(customer_id, run_date, months_back, months_forward):
+    # Runs in a worker: (label counts, par-level forecast in results_store's par_levels layout) of one customer
+    with instrumentation.trace("portfolio_customer", customer_id=customer_id, run_date=run_date.isoformat()):
+        _, order_cycle_df, inactive_status_df = db.fetch_frames(customer_id)
+        desired_quantity_df = db.get_desired_quantity(list(order_cycle_df.item_type_id.unique()), customer_id)
+        with instrumentation.span("engine.compute_depletion", rows_in=order_cycle_df.shape[0]):
+            result = engine.compute_depletion(customer_id, order_cycle_df, inactive_status_df, desired_quantity_df,
+                                              run_date, months_back, months_forward)
+        counts = dict(items=result.total_items, lost=result.n_lost, ragout=result.n_ragout, normal=result.n_normal)
+        return counts, results_store.par_level_table(result)
+
+
+def stored_forecast(customer_id, run_date, months_back, months_forward):
+    # The same from a batch run of run_date with the same horizon; None when there is none
+    stored = results_store.load_summary(customer_id, run_date)
+    if stored is None:
+        return None
+    par_df, meta = stored
+    if (meta.get('months_back'), meta.get('months_forward')) != (months_back, months_forward):
+        return None
+    return {key: meta[key] for key in ('items', 'lost', 'ragout', 'normal')}, par_df
+
+
+def summary_row(counts, par_df, periods, labels):
+    # One fleet table row: label counts, depletion rate and, from the current month on, the item types below
+    # their par level and the items missing to reach the desired quantities
+    items, lost, ragout, normal = counts['items'], counts['lost'], counts['ragout'], counts['normal']
+    inactive = lost + ragout + normal
+    row = {'Items': items, 'Active': items - inactive, 'Inactive': inactive, 'Lost': lost, 'Ragout': ragout, 'Normal': normal,
+           'Depletion Rate (%)': (lost + ragout) / items * 100 if items else np.nan}
+
+    months = par_df.groupby('period')
+    for period, label in zip(periods, labels):
+        month_df = months.get_group(period) if period in months.groups else par_df.iloc[:0]
+        row[f'Item Types Below Par ({label})'] = int((month_df['par_level'] < 100).sum())
+        row[f'Par Shortfall ({label})'] = int((month_df['desired_quantity'] - month_df['available']).clip(lower=0).sum())
+    return row
+
+
+def fleet_table(rows, names, sources):
+    fleet_df = pd.DataFrame.from_dict(rows, orient='index')
+    fleet_df.index.name = 'Customer ID'
+    fleet_df = fleet_df.reset_index()
+    fleet_df.insert(0, 'Customer', fleet_df['Customer ID'].map(names))
+    fleet_df['Source'] = fleet_df['Customer ID'].map(sources)
+    return fleet_df.sort_values('Depletion Rate (%)', ascending=False, kind='stable', ignore_index=True)
+
+
+def horizon_labels(run_date, months_back, months_forward):
+    # (periods, labels) of the fleet table's par columns: the current month and the forecast months
+    horizon_periods = engine.month_horizon(run_date, months_back, months_forward)
+    return [str(period) for period in horizon_periods[months_back:]], engine.month_labels(horizon_periods)[months_back:]
+
+
+def assemble(customer_ids, rows, par_frames, names, sources):
+    # Kept in the order of customer_ids until the fleet table is sorted
+    order = [customer_id for customer_id in customer_ids if customer_id in rows]
+    if not order:
+        return pd.DataFrame(), pd.DataFrame()
+    fleet_df = fleet_table({customer_id: rows[customer_id] for customer_id in order}, names or {}, sources)
+    par_df = pd.concat([par_frames[customer_id].assign(customer_id=customer_id) for customer_id in order], ignore_index=True)
+    return fleet_df, par_df
+
+
+def compute_portfolio(customer_ids, names=None, run_date=None, months_back=None, months_forward=None,
+                      workers=None, db_connections=None, use_stored=True):
+    # (fleet_df, par_df, failed): one row per customer sorted by depletion rate, the par-level forecasts of all
+    # customers in long form, and {customer_id: error} of the customers that could not be computed
+    run_date = run_date or datetime.date.today()
+    months_back, months_forward = horizon(months_back, months_forward)
+    periods, labels = horizon_labels(run_date, months_back, months_forward)
+
+    rows, par_frames, sources, failed = {}, {}, {}, {}
+
+    def add(customer_id, output, source):
+        counts, par_df = output
+        rows[customer_id] = summary_row(counts, par_df, periods, labels)
+        par_frames[customer_id] = par_df
+        sources[customer_id] = source
+
+    pending = []
+    for customer_id in customer_ids:
+        stored = stored_forecast(customer_id, run_date, months_back, months_forward) if use_stored else None
+        if stored is None:
+            pending.append(customer_id)
+        else:
+            add(customer_id, stored, 'batch')
+
+    if pending:
+        workers = workers or default_workers
+        workers, pool_size = batch_scoring.pool_layout(workers, db_connections or default_db_connections or workers, len(pending))
+        start = time.perf_counter()
+        for customer_id, output, error in batch_scoring.map_customers(customer_forecast, pending, workers, pool_size,
+                                                                      run_date, months_back, months_forward):
+            if error is not None:
+                failed[customer_id] = repr(error)
+                logger.error("customer %s failed: %r", customer_id, error)
+                continue
+            add(customer_id, output, 'computed')
+        logger.info("computed %d customers on %d workers in %.1fs (%d read from batch results)",
+                    len(pending) - len(failed), workers, time.perf_counter() - start, len(customer_ids) - len(pending))
+
+    fleet_df, par_df = assemble(customer_ids, rows, par_frames, names, sources)
+    return fleet_df, par_df, failed
+
+
+def stored_portfolio(customer_ids, names=None, run_date=None):
+    # (fleet_df, par_df, missing, run_date) from the batch run of run_date (the latest run by default) alone:
+    # nothing is computed, and the customers that run did not score are returned in missing
+    if run_date is None:
+        run_dates = results_store.run_dates()
+        run_date = run_dates[-1] if run_dates else None
+    if run_date is None:
+        return pd.DataFrame(), pd.DataFrame(), list(customer_ids), None
+
+    rows, par_frames, missing = {}, {}, []
+    for customer_id in customer_ids:
+        stored = results_store.load_summary(customer_id, run_date)
+        if stored is None:
+            missing.append(customer_id)
+            continue
+        par_df, meta = stored
+        periods, labels = horizon_labels(run_date, *horizon(meta.get('months_back'), meta.get('months_forward')))
+        rows[customer_id] = summary_row(meta, par_df, periods, labels)
+        par_frames[customer_id] = par_df
+
+    fleet_df, par_df = assemble(customer_ids, rows, par_frames, names, dict.fromkeys(rows, 'batch'))
+    return fleet_df, par_df, missing, run_date
+
+
+@st.cache_data(ttl=db.fetch_data_ttl, show_spinner="Reading batch results...")
+def fetch_stored_portfolio(customer_ids, names, run_date):
+    # stored_portfolio cached per process on (customers, batch run date); names is a tuple of (id, name) pairs
+    return stored_portfolio(list(customer_ids), dict(names), run_date)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Depletion rate and par-level forecast of many customers in one table")
+    parser.add_argument("--customers", type=int, nargs="+", help="customer ids (default: every customer of fetch_inventory_list)")
+    parser.add_argument("--workers", type=int, default=default_workers, help="scoring processes")
+    parser.add_argument("--db-connections", type=int, default=None, help="database connections shared by all workers (default: one per worker)")
+    parser.add_argument("--date", type=datetime.date.fromisoformat, default=datetime.date.today(), help="reference date, YYYY-MM-DD")
+    parser.add_argument("--months-back", type=int)
+    parser.add_argument("--months-forward", type=int)
+    parser.add_argument("--no-stored", action="store_true", help="compute every customer, even those a batch run already scored")
+    parser.add_argument("--sort", default="Depletion Rate (%)", help="fleet table column to sort by, descending")
+    parser.add_argument("--output", help="write the fleet table to this CSV file (and the forecasts next to it, as <name>_par_levels.csv)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    inventory_names, inventory_ids = db.fetch_inventory_list()
+    customer_ids = args.customers or inventory_ids
+    start = time.perf_counter()
+    fleet_df, par_df, failed = compute_portfolio(customer_ids, dict(zip(inventory_ids, inventory_names)), args.date,
+                                                 args.months_back, args.months_forward, args.workers, args.db_connections,
+                                                 use_stored=not args.no_stored)
+    elapsed = time.perf_counter() - start
+
+    if not fleet_df.empty:
+        fleet_df = fleet_df.sort_values(args.sort, ascending=False, kind='stable', ignore_index=True)
+    if args.output:
+        fleet_df.to_csv(args.output, index=False)
+        par_df.to_csv(os.path.splitext(args.output)[0] + "_par_levels.csv", index=False)
+    else:
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(fleet_df.to_string(index=False))
+
+    logger.info("%d customers (%d failed) in %.1fs", fleet_df.shape[0], len(failed), elapsed)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
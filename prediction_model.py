@@ -1,79 +1,146 @@
-import math 
 import random
 import pandas as pd 
 import numpy as np  
-import pickle 
-from lightgbm import LGBMClassifier
-from lightgbm import LGBMRegressor 
 import streamlit as st 
-from sklearn.preprocessing import MinMaxScaler  
 import database as db 
+import instrumentation 
+from model_registry import get_registry, ragout_features 
 
 
-def calculate_lifetime(pickup_date, birthday): 
-    return round((pickup_date - birthday).total_seconds()/3600/24, 3) 
+def calculate_lifetime(pickup_dates, birthdays): 
+    # Days between two datetime (or datetime.date) columns, rounded to 3 decimals
+    days = (pd.to_datetime(pickup_dates) - pd.to_datetime(birthdays)).dt.total_seconds()/3600/24
+    rounded = days.round(3)
+    # numpy rounds days * 1000, which can fall on the other side of a .0005 tie than round() of the exact value;
+    # the few values that close to a tie are rounded with round(), as the row-wise code did
+    scaled = days * 1000
+    near_tie = ((scaled - np.floor(scaled)) - 0.5).abs() < 1e-6
+    if near_tie.any():
+        rounded[near_tie] = days[near_tie].map(lambda value: round(value, 3))
+    return rounded
 
 
-def merge_prediction_prob(pred, prob): 
-    return "{} ({:.2f}%)".format(pred, prob*100)
+def merge_prediction_prob(predictions, probabilities): 
+    return pd.Series(predictions).astype(str).values + np.char.mod(" (%.2f%%)", np.asarray(probabilities)*100) 
+
+
+def build_feature_matrix(df): 
+    # Adds usage_period / usage_period_laundris to df and returns the model input as a C-contiguous float32 array
+    df["usage_period"]          = calculate_lifetime(df['last_updated_date'], df['birthday'])
+    df['usage_period_laundris'] = calculate_lifetime(df['last_updated_date'], df['creation_date']) 
+
+    data = np.empty((df.shape[0], len(ragout_features)), dtype=np.float32) 
+    for i, feature in enumerate(ragout_features): 
+        data[:, i] = df[feature].to_numpy(dtype=np.float32, na_value=np.nan) 
+
+    return data 
+
+
+def scale_features(scaler, data): 
+    # MinMaxScaler.transform is X * scale_ + min_; doing it in place keeps the float32 array 
+    # (and skips sklearn's feature-name check on a bare ndarray)
+    data *= scaler.scale_.astype(np.float32) 
+    data += scaler.min_.astype(np.float32) 
+    if getattr(scaler, "clip", False): 
+        lower, upper = scaler.feature_range 
+        np.clip(data, lower, upper, out=data) 
+
+    return data 
 
 
 def predict_ragout_group(df): 
-    df["usage_period"]          = df.apply(lambda x: calculate_lifetime(x['last_updated_date'], x['birthday']), axis=1)
-    df['usage_period_laundris'] = df.apply(lambda x: calculate_lifetime(x['last_updated_date'], x['creation_date']), axis=1) 
-
-    features = ['item_type_id', 
-                'customer_id', 
-                'total_washes', 
-                'pickup_count', 
-                'dropoff_count', 
-                'usage_period', 
-                'usage_period_laundris']  
-    
-    scaler_filename = "models/ragout_classification_scaler.pkl" 
-    model_filename = "models/ragout_classification_model_v1.pkl"  
-
-    scaler = MinMaxScaler() 
-    scaler = pickle.load(open(scaler_filename, 'rb')) 
-    model_lgbm = pickle.load(open(model_filename, 'rb')) 
-
-    data = scaler.transform(df[features]) 
+    registry = get_registry() 
+    scaler = registry.get("classification_scaler") 
+    model_lgbm = registry.get("classification_model") 
+
+    data = scale_features(scaler, build_feature_matrix(df)) 
 
     df['prediction'] =  model_lgbm.predict(data) 
     probabilities = model_lgbm.predict_proba(data) 
     df['prediction_confidence'] = np.max(probabilities, axis=1)
 
-    df["predicted_ragout"]= df.apply(lambda x: merge_prediction_prob(x['prediction'], x['prediction_confidence']), axis=1) 
+    df["predicted_ragout"]= merge_prediction_prob(df['prediction'], df['prediction_confidence']) 
 
     return df[['rfid_id', 'prediction','predicted_ragout']]
 
 
 def predict_ragout_time_group(df, addition): 
-    df["usage_period"]          = df.apply(lambda x: calculate_lifetime(x['last_updated_date'], x['birthday']), axis=1)
-    df['usage_period_laundris'] = df.apply(lambda x: calculate_lifetime(x['last_updated_date'], x['creation_date']), axis=1) 
-
-    features = ['item_type_id', 
-                'customer_id', 
-                'total_washes', 
-                'pickup_count', 
-                'dropoff_count', 
-                'usage_period', 
-                'usage_period_laundris']  
-    
-    scaler_filename = "models/ragout_regression_scaler.pkl" 
-    model_filename = "models/ragout_regression_model_v1.pkl"  
-
-    scaler = MinMaxScaler() 
-    scaler = pickle.load(open(scaler_filename, 'rb')) 
+    registry = get_registry() 
+    scaler = registry.get("regression_scaler") 
+    model_lgbm = registry.get("regression_model") 
 
-    model = LGBMRegressor(n_estimators=350, learning_rate=0.03, random_state=42) 
-    model_lgbm = pickle.load(open(model_filename, 'rb')) 
+    data = scale_features(scaler, build_feature_matrix(df)) 
 
-    data = scaler.transform(df[features]) 
-
-    df['predicted_ragout_time'] = model_lgbm.predict(data) 
-    df['predicted_ragout_time'] = df['predicted_ragout_time'].apply(math.ceil) + addition + 15 
+    df['predicted_ragout_time'] = np.ceil(model_lgbm.predict(data)).astype(int) + addition + 15 
 
     df.loc[df['usage_period'] < 90, 'predicted_ragout_time'] = 200 
 
     return df[['rfid_id', 'predicted_ragout_time']]
+
+
+def score_items(df, customer_id, inactive_days=90): 
+    # Scores every item of pickup_dropoff_count_df in one pass: features are built once, the classifier 
+    # runs once over the items inactive for more than `inactive_days` (label = argmax of the probabilities) 
+    # and the regressor runs once over the items that still need a ragout time (active and normal ones). 
+    registry = get_registry() 
+    classification_scaler = registry.get("classification_scaler") 
+    classification_model = registry.get("classification_model") 
+    regression_scaler = registry.get("regression_scaler") 
+    regression_model = registry.get("regression_model") 
+
+    features_df = df[['rfid_id', 'item_type_id', 'total_washes', 'pickup_count', 'dropoff_count', 'creation_date', 'birthday', 'last_updated_date']].copy() 
+    features_df['customer_id'] = customer_id 
+    with instrumentation.span("model.features", rows_in=df.shape[0]) as span: 
+        data = build_feature_matrix(features_df) 
+        span.rows_out = data.shape[0] 
+
+    n_items = df.shape[0] 
+    inactive = (df['inactive_time'] > inactive_days).to_numpy() 
+    inactive_time = df['inactive_time'].to_numpy() 
+
+    prediction = np.zeros(n_items, dtype=np.int64) 
+    confidence = np.zeros(n_items) 
+    if inactive.any(): 
+        with instrumentation.span("model.predict_proba", rows_in=int(inactive.sum())) as span: 
+            probabilities = classification_model.predict_proba(scale_features(classification_scaler, data[inactive])) 
+            span.rows_out = probabilities.shape[0] 
+        prediction[inactive] = classification_model.classes_[np.argmax(probabilities, axis=1)] 
+        confidence[inactive] = np.max(probabilities, axis=1) 
+
+    lost = (df['pickup_count'] <= 1).to_numpy() & (df['dropoff_count'] <= 1).to_numpy() & (prediction == 0) 
+    label = np.where(prediction == 1, 'ragout', np.where(lost, 'lost', 'normal')) 
+    normal = inactive & (label == 'normal') 
+
+    # Normal items were historically scored from calendar dates (main() truncates their dates for display 
+    # before predicting), so their usage features are whole days 
+    usage_period = features_df['usage_period'].to_numpy(copy=True) 
+    if normal.any(): 
+        normal_df = features_df.loc[normal, ['last_updated_date', 'birthday', 'creation_date']].apply(lambda x: x.dt.floor('D')) 
+        usage_period[normal] = calculate_lifetime(normal_df['last_updated_date'], normal_df['birthday']).to_numpy() 
+        data[normal, ragout_features.index('usage_period')] = usage_period[normal] 
+        data[normal, ragout_features.index('usage_period_laundris')] = calculate_lifetime(normal_df['last_updated_date'], normal_df['creation_date']).to_numpy() 
+
+    needs_time = ~inactive | normal 
+    ragout_time = np.zeros(n_items, dtype=np.int64) 
+    if needs_time.any(): 
+        addition = np.where(inactive, 0, 30)[needs_time] 
+        with instrumentation.span("model.predict", rows_in=int(needs_time.sum())) as span: 
+            predicted = regression_model.predict(scale_features(regression_scaler, data[needs_time])) 
+            span.rows_out = predicted.shape[0] 
+        ragout_time[needs_time] = np.ceil(predicted).astype(int) + addition + 15 
+    ragout_time[needs_time & (usage_period < 90)] = 200 
+
+    # Active items without any order cycle yet, and items seen in the last few days, last longer 
+    active = ~inactive 
+    ragout_time[active & (inactive_time < 30) & (df['last_operation'] == 'No order cycle').to_numpy()] = 250 
+    ragout_time[active & (inactive_time < 5)] += 45 
+
+    scored_df = pd.DataFrame({'rfid_id': df['rfid_id'].to_numpy()}) 
+    scored_df['prediction'] = pd.array(np.where(inactive, prediction, 0), dtype='Int64') 
+    scored_df.loc[~inactive, 'prediction'] = pd.NA 
+    scored_df['predicted_ragout'] = np.where(inactive, merge_prediction_prob(prediction, confidence), None) 
+    scored_df['Label'] = np.where(inactive, label, None) 
+    scored_df['predicted_ragout_time'] = pd.array(ragout_time, dtype='Int64') 
+    scored_df.loc[~needs_time, 'predicted_ragout_time'] = pd.NA 
+
+    return scored_df 
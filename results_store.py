@@ -0,0 +1,129 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+import disk_cache
+
+
+# Precomputed depletion results, one directory per run date and customer:
+#   <results_dir>/<date>/customer_<id>/{current, v-<ns>-<token>/{items.parquet, par_levels.parquet, meta.json}}
+# Versioned like the fetch_data disk cache: a store writes a new version directory and swaps the `current` pointer
+# with os.replace, so readers see the old or the new entry, and concurrent stores of a customer each win in turn.
+results_dir = os.environ.get("LAUNDRIS_RESULTS_DIR", os.path.join(".cache", "results"))
+
+
+def entry_path(customer_id, run_date):
+    return os.path.join(results_dir, run_date.isoformat(), f"customer_{customer_id}")
+
+
+def item_table(result):
+    # One row per item: its label (lost / ragout / normal, or active when seen in the last 90 days) and predictions
+    columns = ['rfid_id', 'item_type_id', 'item_type_name', 'last_operation', 'inactive_time']
+
+    inactive_df = result.inactive_items[columns + ['Label', 'prediction', 'predicted_ragout']]
+    if 'predicted_ragout_time' in result.normal_items:
+        inactive_df = inactive_df.merge(result.normal_items[['rfid_id', 'predicted_ragout_time', 'ragout_period']], on='rfid_id', how='left')
+
+    active_df = result.active_items[columns + ['predicted_ragout_time', 'ragout_period']].assign(Label='active')
+
+    items_df = pd.concat([inactive_df, active_df], ignore_index=True)
+    items_df['prediction'] = items_df['prediction'].astype('Int64')
+    items_df['predicted_ragout_time'] = items_df['predicted_ragout_time'].astype('Int64')
+    items_df['ragout_month'] = items_df['ragout_period'].astype(str).where(items_df['ragout_period'].notna())
+    return items_df.drop(columns='ragout_period').rename(columns={'Label': 'label'})
+
+
+def par_level_table(result):
+    par_df = result.par_forecast.copy()
+    par_df['period'] = par_df['period'].astype(str)
+    return par_df
+
+
+def store_results(customer_id, result, meta=None, run_date=None):
+    run_date = run_date or result.today
+    path = entry_path(customer_id, run_date)
+    os.makedirs(path, exist_ok=True)
+
+    tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=path)
+    try:
+        item_table(result).to_parquet(os.path.join(tmp_path, "items.parquet"), index=False)
+        par_level_table(result).to_parquet(os.path.join(tmp_path, "par_levels.parquet"), index=False)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(dict(meta or {}, customer_id=customer_id, run_date=run_date.isoformat(),
+                           created=datetime.datetime.now().isoformat(timespec="seconds")), f, default=str)
+
+        version = f"v-{time.time_ns()}-{os.path.basename(tmp_path)[len('.tmp-'):]}"
+        os.rename(tmp_path, os.path.join(path, version))
+        pointer_fd, pointer_tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=path)
+        with os.fdopen(pointer_fd, "w") as pointer:
+            pointer.write(version)
+        os.replace(pointer_tmp_path, os.path.join(path, disk_cache.pointer_name))
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    # Replaced versions stay for disk_cache.superseded_grace seconds, for readers that resolved them before the swap
+    disk_cache.remove_old_versions(path, current=version)
+    return path
+
+
+def run_dates():
+    if not os.path.isdir(results_dir):
+        return []
+    dates = []
+    for name in os.listdir(results_dir):
+        try:
+            dates.append(datetime.date.fromisoformat(name))
+        except ValueError:
+            continue
+    return sorted(dates)
+
+
+def read_entry(path, read):
+    # read(version_path) of the entry's current version, or None without one. A version removed while it was read
+    # (its reader took longer than the grace period) is read again through the new pointer.
+    for _ in range(disk_cache.load_attempts):
+        version_path = disk_cache.current_version(path)
+        if version_path is None:
+            # Entries stored before they were versioned hold the files directly
+            version_path = path if os.path.exists(os.path.join(path, "meta.json")) else None
+        if version_path is None:
+            return None
+        try:
+            return read(version_path)
+        except OSError:
+            continue
+    return None
+
+
+def read_meta(version_path):
+    with open(os.path.join(version_path, "meta.json")) as f:
+        return json.load(f)
+
+
+def find_read(customer_id, run_date, read):
+    # read() of the given run date's entry, or of the latest run that scored the customer; None if there is none
+    candidates = [run_date] if run_date else reversed(run_dates())
+    for candidate in candidates:
+        found = read_entry(entry_path(customer_id, candidate), read)
+        if found is not None:
+            return found
+    return None
+
+
+def load_results(customer_id, run_date=None):
+    # (items_df, par_levels_df, meta) of the given run date, or of the latest run that scored the customer; None if there is none
+    return find_read(customer_id, run_date, lambda version_path: (pd.read_parquet(os.path.join(version_path, "items.parquet")),
+                                                                  pd.read_parquet(os.path.join(version_path, "par_levels.parquet")),
+                                                                  read_meta(version_path)))
+
+
+def load_summary(customer_id, run_date=None):
+    # (par_levels_df, meta) like load_results, without reading the item table
+    return find_read(customer_id, run_date, lambda version_path: (pd.read_parquet(os.path.join(version_path, "par_levels.parquet")),
+                                                                  read_meta(version_path)))
@@ -0,0 +1,289 @@
+import datetime
+import io
+
+import numpy as np
+import pandas as pd
+
+
+# Seeded generator for the tables the dashboard reads, with production table and column names.
+# Orders are created once per customer per day, so order ids grow with time like the real ones.
+
+item_type_catalog = ["Bath Towel", "Hand Towel", "Wash Cloth", "Bath Mat", "King Sheet", "Queen Sheet", "Pillow Case", "Duvet Cover"]
+room_type_catalog = ["King", "Double Queen", "Suite"]
+location_type_catalog = ["room", "laundry_chute", "storage", "other"]
+
+
+def generate(n_tags=10_000, n_customers=None, seed=0, history_days=730, cycles_per_tag=3.0, bins_per_order=4, today=None):
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp(today or datetime.date.today(), tz='UTC')
+    history_start = today - pd.Timedelta(days=history_days)
+    n_customers = n_customers or int(np.clip(n_tags // 5_000, 1, 200))
+    customer_ids = np.arange(1, n_customers + 1)
+
+    customer_df = pd.DataFrame({
+        "customer_id": customer_ids,
+        "customer_name": [f"Hotel {i}" for i in customer_ids],
+        "status": "active",
+        "customer_type": "internal",
+        "entity_type": "hotel",
+        "par_level": rng.choice([2.0, 3.0, 4.0], n_customers),
+    })
+
+    # Item types: a fixed block of catalog entries per customer, half without their own par level
+    n_item_types = len(item_type_catalog)
+    item_type_df = pd.DataFrame({
+        "id": np.arange(1, n_customers * n_item_types + 1),
+        "customer_id": np.repeat(customer_ids, n_item_types),
+        "customer_item_type_name": np.tile(item_type_catalog, n_customers),
+        "ideal_par_level": np.where(rng.random(n_customers * n_item_types) < 0.5, np.nan, rng.choice([2.0, 3.0, 4.0], n_customers * n_item_types)),
+    })
+
+    n_room_types = len(room_type_catalog)
+    room_type_ids = np.arange(1, n_customers * n_room_types + 1)
+    hotelprofile_df = pd.DataFrame({
+        "customer_id": np.repeat(customer_ids, n_room_types),
+        "customer_room_type_id": room_type_ids,
+        "quantity": rng.integers(10, 200, n_customers * n_room_types),
+    })
+    roomprofile_df = pd.DataFrame({
+        "customer_room_type_id": np.repeat(room_type_ids, n_item_types),
+        "customer_item_type_id": (np.repeat(np.repeat(customer_ids - 1, n_room_types), n_item_types) * n_item_types
+                                  + np.tile(np.arange(1, n_item_types + 1), n_customers * n_room_types)),
+        "item_quantity": rng.integers(1, 5, n_customers * n_room_types * n_item_types),
+    })
+
+    # Locations: ten per hotel plus five shared facility locations
+    n_hotel_locations = 10
+    n_facility_locations = 5
+    location_df = pd.DataFrame({
+        "id": np.arange(1, n_customers * n_hotel_locations + n_facility_locations + 1),
+        "name": [f"Location {i}" for i in range(1, n_customers * n_hotel_locations + 1)] + [f"Facility {i}" for i in range(1, n_facility_locations + 1)],
+        "location_type": np.concatenate([rng.choice(location_type_catalog, n_customers * n_hotel_locations), np.repeat("facility", n_facility_locations)]),
+        "customer_id": np.concatenate([np.repeat(customer_ids, n_hotel_locations), np.zeros(n_facility_locations, dtype=int)]),
+        "side": np.concatenate([np.repeat("hotel", n_customers * n_hotel_locations), np.repeat("facility", n_facility_locations)]),
+    })
+
+    # Tags: customer sizes are skewed, a few large hotels and a long tail of small ones
+    customer_weights = rng.lognormal(0, 1, n_customers)
+    tag_customer = rng.choice(customer_ids, n_tags, p=customer_weights / customer_weights.sum())
+    age_days = rng.uniform(0, history_days, n_tags)
+    creation_date = today - pd.to_timedelta(age_days * 86400, unit='s').round('s')
+    birthday = creation_date - pd.to_timedelta(rng.uniform(0, 30, n_tags) * 86400, unit='s').round('s')
+    idle_days = np.minimum(rng.exponential(60, n_tags), age_days)
+    last_updated_date = today - pd.to_timedelta(idle_days * 86400, unit='s').round('s')
+    inactive = rng.random(n_tags) < 0.05
+    ragout_date = pd.Series(last_updated_date).where(inactive)
+    hotel_location = (tag_customer - 1) * n_hotel_locations + rng.integers(1, n_hotel_locations + 1, n_tags)
+    facility_location = n_customers * n_hotel_locations + rng.integers(1, n_facility_locations + 1, n_tags)
+    seen_draw = rng.random(n_tags)
+
+    rfid_df = pd.DataFrame({
+        "rfid_id": "E28011" + pd.Series(np.arange(n_tags)).map("{:018X}".format),
+        "customer_id": tag_customer,
+        "creation_date": creation_date,
+        "last_updated_date": last_updated_date,
+        "status": np.where(inactive, "inactive", "active"),
+        "ragout_date": ragout_date,
+        "total_washes": rng.poisson(np.maximum(age_days - idle_days, 0) / 7),
+        "last_scan_date": last_updated_date - pd.to_timedelta(rng.uniform(0, 5, n_tags) * 86400, unit='s').round('s'),
+        "item_type_id": (tag_customer - 1) * n_item_types + rng.integers(1, n_item_types + 1, n_tags),
+        "last_seen_location_id": np.where(seen_draw < 0.7, hotel_location, np.where(seen_draw < 0.8, facility_location, np.nan)),
+        "location_id": hotel_location,
+        "birthday": birthday,
+    })
+
+    # Orders: one per customer per day, numbered in date order; the last two days are still waiting for their dropoff
+    order_day = np.repeat(np.arange(history_days), n_customers)
+    order_customer = np.tile(customer_ids, history_days)
+    actual_pickup_date = history_start + pd.to_timedelta(order_day * 86400 + rng.integers(6 * 3600, 12 * 3600, order_day.size), unit='s')
+    actual_dropoff_date = pd.Series(actual_pickup_date + pd.Timedelta(days=2)).where(order_day < history_days - 2)
+    order_df = pd.DataFrame({
+        "id": np.arange(1, order_day.size + 1),
+        "customer_id": order_customer,
+        "actual_pickup_date": actual_pickup_date,
+        "actual_dropoff_date": actual_dropoff_date,
+        "incoming_total_weight": rng.uniform(100, 500, order_day.size).round(1),
+    })
+
+    # Order cycles: each tag is picked up (and mostly dropped off again) a few times during its active life
+    cycles = rng.poisson(cycles_per_tag, n_tags)
+    cycle_tag = np.repeat(np.arange(n_tags), cycles)
+    cycle_age = rng.uniform(idle_days[cycle_tag], age_days[cycle_tag])
+    cycle_day = np.clip(history_days - 1 - cycle_age.astype(int), 0, history_days - 1)
+    cycle_order = cycle_day * n_customers + tag_customer[cycle_tag]
+
+    pickup_bin = cycle_order * 2 * bins_per_order + rng.integers(0, bins_per_order, cycle_tag.size)
+    has_dropoff = rng.random(cycle_tag.size) < 0.9
+    dropoff_bin = cycle_order * 2 * bins_per_order + bins_per_order + rng.integers(0, bins_per_order, cycle_tag.size)
+
+    rfid_ids = rfid_df["rfid_id"].to_numpy()
+    order_binrfids_rfids_df = pd.DataFrame({
+        "binrfids_id": np.concatenate([pickup_bin, dropoff_bin[has_dropoff]]),
+        "rfid_id": np.concatenate([rfid_ids[cycle_tag], rfid_ids[cycle_tag[has_dropoff]]]),
+    }).drop_duplicates(ignore_index=True)
+    order_order_pickup_bins_df = pd.DataFrame({"binrfids_id": pickup_bin, "order_id": cycle_order}).drop_duplicates(ignore_index=True)
+    order_order_dropoff_bins_df = pd.DataFrame({"binrfids_id": dropoff_bin[has_dropoff], "order_id": cycle_order[has_dropoff]}).drop_duplicates(ignore_index=True)
+
+    # Bin rows are written as the bins are scanned, so in production tables they sit in bin id (time) order
+    order_binrfids_rfids_df = order_binrfids_rfids_df.sort_values("binrfids_id", kind="stable", ignore_index=True)
+    order_order_pickup_bins_df = order_order_pickup_bins_df.sort_values(["binrfids_id", "order_id"], ignore_index=True)
+    order_order_dropoff_bins_df = order_order_dropoff_bins_df.sort_values(["binrfids_id", "order_id"], ignore_index=True)
+
+    return {
+        "customer": customer_df,
+        "customer_customerinventoryitemtype": item_type_df,
+        "customer_roomprofile": roomprofile_df,
+        "customer_hotelprofile": hotelprofile_df,
+        "inventory_location": location_df,
+        "rfid": rfid_df,
+        "order_order": order_df,
+        "order_binrfids_rfids": order_binrfids_rfids_df,
+        "order_order_pickup_bins": order_order_pickup_bins_df,
+        "order_order_dropoff_bins": order_order_dropoff_bins_df,
+    }
+
+
+def largest_customer(tables):
+    return int(tables["rfid"]["customer_id"].value_counts().idxmax())
+
+
+def customer_tables(tables, customer_id):
+    # Same rows and column names as database.read_customer_tables(customer_id, conn) returns
+    rfid_df = tables["rfid"]
+    rfid_df = rfid_df[rfid_df.customer_id == customer_id].drop(columns="customer_id").reset_index(drop=True)
+
+    binrfids_df = tables["order_binrfids_rfids"]
+    binrfids_df = binrfids_df[binrfids_df.rfid_id.isin(rfid_df.rfid_id)].reset_index(drop=True)
+    pickup_bins_df = tables["order_order_pickup_bins"]
+    pickup_bins_df = pickup_bins_df[pickup_bins_df.binrfids_id.isin(binrfids_df.binrfids_id)].reset_index(drop=True)
+    dropoff_bins_df = tables["order_order_dropoff_bins"]
+    dropoff_bins_df = dropoff_bins_df[dropoff_bins_df.binrfids_id.isin(binrfids_df.binrfids_id)].reset_index(drop=True)
+
+    order_df = tables["order_order"][["id", "actual_pickup_date", "actual_dropoff_date", "incoming_total_weight"]].rename(columns={"id": "order_id"})
+    item_type_df = tables["customer_customerinventoryitemtype"].rename(columns={"id": "item_type_id", "customer_item_type_name": "item_type_name"})
+    location_df = tables["inventory_location"].rename(columns={"id": "last_seen_location_id", "name": "last_seen_location_name", "customer_id": "location_customer_id"})
+    location_ids = pd.concat([rfid_df.last_seen_location_id, rfid_df.location_id])
+
+    return {
+        "rfid": rfid_df,
+        "order_binrfids_rfids": binrfids_df,
+        "order_order_pickup_bins": pickup_bins_df,
+        "order_order_dropoff_bins": dropoff_bins_df,
+        "item_type": item_type_df.loc[item_type_df.item_type_id.isin(rfid_df.item_type_id), ["item_type_id", "item_type_name"]].reset_index(drop=True),
+        "location": location_df.loc[location_df.last_seen_location_id.isin(location_ids),
+                                    ["last_seen_location_id", "last_seen_location_name", "location_type", "location_customer_id", "side"]].reset_index(drop=True),
+        "pickup_order": order_df[order_df.order_id.isin(pickup_bins_df.order_id)].reset_index(drop=True),
+        "dropoff_order": order_df[order_df.order_id.isin(dropoff_bins_df.order_id)].reset_index(drop=True),
+    }
+
+
+def order_cycle_event_chunks(tables, customer_id, chunk_rows=100_000):
+    # The rows database.order_cycle_events_sql streams for a customer (one per rfid x bin x pickup/dropoff order,
+    # ordered by rfid_id, binrfids_id and the order ids), built a block of RFIDs at a time and cut into chunk_rows rows
+    rfid_ids = np.sort(tables["rfid"].loc[tables["rfid"].customer_id == customer_id, "rfid_id"].to_numpy())
+    binrfids_df = tables["order_binrfids_rfids"]
+    binrfids_df = binrfids_df[binrfids_df.rfid_id.isin(rfid_ids)]
+    orders_df = tables["order_order"].set_index("id")
+
+    pending = []
+    pending_rows = 0
+    block_size = max(1, chunk_rows // 4)
+    for start in range(0, len(rfid_ids), block_size):
+        block_df = binrfids_df[binrfids_df.rfid_id.isin(rfid_ids[start:start + block_size])]
+        block_df = block_df.merge(tables["order_order_pickup_bins"].rename(columns={"order_id": "pickup_order_id"}), on="binrfids_id", how="left")
+        block_df = block_df.merge(tables["order_order_dropoff_bins"].rename(columns={"order_id": "dropoff_order_id"}), on="binrfids_id", how="left")
+        block_df = block_df.sort_values(["rfid_id", "binrfids_id", "pickup_order_id", "dropoff_order_id"], kind="stable", ignore_index=True)
+        block_df["last_pickup_date"] = orders_df["actual_pickup_date"].reindex(block_df["pickup_order_id"]).set_axis(block_df.index)
+        block_df["last_dropoff_date"] = orders_df["actual_dropoff_date"].reindex(block_df["dropoff_order_id"]).set_axis(block_df.index)
+        block_df = block_df[["rfid_id", "binrfids_id", "pickup_order_id", "last_pickup_date", "dropoff_order_id", "last_dropoff_date"]]
+
+        pending.append(block_df)
+        pending_rows += block_df.shape[0]
+        if pending_rows >= chunk_rows:
+            rows_df = pd.concat(pending, ignore_index=True)
+            full_chunks = rows_df.shape[0] // chunk_rows * chunk_rows
+            for chunk_start in range(0, full_chunks, chunk_rows):
+                yield rows_df.iloc[chunk_start:chunk_start + chunk_rows].reset_index(drop=True)
+            pending = [rows_df.iloc[full_chunks:]]
+            pending_rows = rows_df.shape[0] - full_chunks
+
+    if pending_rows:
+        yield pd.concat(pending, ignore_index=True)
+
+
+def inventory_list(tables):
+    # database.fetch_inventory_list
+    df = tables["customer"]
+    df = df[(df.status == "active") & (df.customer_type == "internal") & (df.entity_type == "hotel")]
+    return df.customer_name.to_list(), df.customer_id.to_list()
+
+
+def item_type_names(tables):
+    # database.fetch_item_type_names
+    return tables["customer_customerinventoryitemtype"][["id", "customer_item_type_name"]].rename(columns={"id": "item_type_id", "customer_item_type_name": "item_type_name"})
+
+
+def desired_quantity(tables, item_type_ids, customer_id):
+    # database.get_desired_quantity
+    room_profile_df = tables["customer_roomprofile"].rename(columns={"customer_item_type_id": "item_type_id"})
+    room_profile_df = room_profile_df[room_profile_df.item_type_id.isin(item_type_ids)]
+    hotel_profile_df = tables["customer_hotelprofile"]
+    hotel_profile_df = hotel_profile_df[hotel_profile_df.customer_id == customer_id]
+    room_profile_df = pd.merge(room_profile_df, hotel_profile_df[["customer_room_type_id", "quantity"]], on="customer_room_type_id")
+
+    par_level_df = tables["customer_customerinventoryitemtype"].rename(columns={"id": "item_type_id"})
+    room_profile_df = pd.merge(room_profile_df, par_level_df[["item_type_id", "ideal_par_level", "customer_item_type_name"]], on="item_type_id")
+    customer_par_level = tables["customer"].set_index("customer_id").loc[customer_id, "par_level"]
+    room_profile_df["ideal_par_level"] = room_profile_df["ideal_par_level"].fillna(customer_par_level)
+
+    room_profile_df["Desired Quantity"] = room_profile_df["item_quantity"] * room_profile_df["quantity"] * room_profile_df["ideal_par_level"]
+    par_level_group = room_profile_df[["customer_item_type_name", "Desired Quantity"]].groupby("customer_item_type_name").sum().reset_index()
+    par_level_group.columns = ["Item Type", "Desired Quantity"]
+    return par_level_group
+
+
+postgres_schema = {
+    "customer": "customer_id integer primary key, customer_name text, status text, customer_type text, entity_type text, par_level double precision",
+    "customer_customerinventoryitemtype": "id integer primary key, customer_id integer, customer_item_type_name text, ideal_par_level double precision",
+    "customer_roomprofile": "customer_room_type_id integer, customer_item_type_id integer, item_quantity integer",
+    "customer_hotelprofile": "customer_id integer, customer_room_type_id integer, quantity integer",
+    "inventory_location": "id integer primary key, name text, location_type text, customer_id integer, side text",
+    "rfid": """rfid_id text primary key, customer_id integer, creation_date timestamptz, last_updated_date timestamptz, status text,
+               ragout_date timestamptz, total_washes integer, last_scan_date timestamptz, item_type_id integer,
+               last_seen_location_id integer, location_id integer, birthday timestamptz""",
+    "order_order": "id bigint primary key, customer_id integer, actual_pickup_date timestamptz, actual_dropoff_date timestamptz, incoming_total_weight double precision",
+    "order_binrfids_rfids": "binrfids_id bigint, rfid_id text",
+    "order_order_pickup_bins": "binrfids_id bigint, order_id bigint",
+    "order_order_dropoff_bins": "binrfids_id bigint, order_id bigint",
+}
+
+postgres_indexes = [
+    "CREATE INDEX ON rfid (customer_id)",
+    "CREATE INDEX ON order_binrfids_rfids (rfid_id)",
+    "CREATE INDEX ON order_binrfids_rfids (binrfids_id)",
+    "CREATE INDEX ON order_order_pickup_bins (binrfids_id)",
+    "CREATE INDEX ON order_order_dropoff_bins (binrfids_id)",
+    "CREATE INDEX ON customer_hotelprofile (customer_id)",
+]
+
+
+def load_into_postgres(tables, conn):
+    # Recreates the tables in the connected (local, throwaway) database and bulk-loads them with COPY
+    with conn.cursor() as cursor:
+        for name, columns in postgres_schema.items():
+            cursor.execute(f"DROP TABLE IF EXISTS {name}")
+            cursor.execute(f"CREATE TABLE {name} ({columns})")
+
+            df = tables[name].copy()
+            for column in df.columns:
+                if pd.api.types.is_float_dtype(df[column]) and column.endswith("_id"):
+                    df[column] = df[column].astype("Int64")
+            buffer = io.StringIO()
+            df.to_csv(buffer, index=False, header=False, date_format="%Y-%m-%d %H:%M:%S%z")
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {name} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+        for index_sql in postgres_indexes:
+            cursor.execute(index_sql)
+        cursor.execute("ANALYZE")
+    conn.commit()
@@ -0,0 +1,124 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+# The modules read their settings at import time, so the caches, logs and stores go to a throwaway directory
+_scratch_dir = tempfile.mkdtemp(prefix="laundris-tests-")
+for name, value in {
+    "LAUNDRIS_DISK_CACHE": "0",
+    "LAUNDRIS_TRACE_LOG": "0",
+    "LAUNDRIS_CACHE_DIR": os.path.join(_scratch_dir, "cache"),
+    "LAUNDRIS_RESULTS_DIR": os.path.join(_scratch_dir, "results"),
+    "LAUNDRIS_LIFETIME_DB": os.path.join(_scratch_dir, "lifetime.sqlite"),
+    "LAUNDRIS_HISTORY_DB": os.path.join(_scratch_dir, "history.sqlite"),
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic_data  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def tables():
+    # Small enough to run every parity check in seconds, big enough that every customer has every label
+    return synthetic_data.generate(n_tags=4000, n_customers=4, seed=11)
+
+
+@pytest.fixture(scope="session")
+def customer_ids(tables):
+    return synthetic_data.inventory_list(tables)[1]
+
+
+def start_postgres(tmp_path_factory):
+    # A throwaway server from the pgserver package (bundled Postgres binaries); None when it is not installed
+    try:
+        import pgserver
+    except ImportError:
+        return None, None
+    server = pgserver.get_server(str(tmp_path_factory.mktemp("pgdata")), cleanup_mode="stop")
+    return server, server.get_uri()
+
+
+@pytest.fixture(scope="session")
+def postgres_dsn(tmp_path_factory, tables):
+    # LAUNDRIS_TEST_DSN points at a local, throwaway database (its tables are replaced); without it a server is
+    # started with pgserver. The synthetic tables are loaded and database.py is pointed at the database.
+    import psycopg2
+
+    import database as db
+
+    dsn = os.environ.get("LAUNDRIS_TEST_DSN")
+    server = None
+    if not dsn:
+        server, dsn = start_postgres(tmp_path_factory)
+        if dsn is None:
+            pytest.skip("Postgres tests need LAUNDRIS_TEST_DSN or the pgserver package")
+
+    conn = psycopg2.connect(dsn)
+    try:
+        synthetic_data.load_into_postgres(tables, conn)
+    finally:
+        conn.close()
+
+    params = psycopg2.extensions.parse_dsn(dsn)
+    settings = {"LAUNDRIS_DB_HOST": params.get("host", "localhost"), "LAUNDRIS_DB_PORT": params.get("port", "5432"),
+                "LAUNDRIS_DB_NAME": params.get("dbname", "postgres"), "LAUNDRIS_DB_USER": params.get("user", "postgres"),
+                "LAUNDRIS_DB_PASSWORD": params.get("password", "")}
+    saved = {name: os.environ.get(name) for name in settings}
+    os.environ.update(settings)
+    db._pool, db._backend = None, None
+
+    yield dsn
+
+    if db._pool is not None:
+        db._pool.close()
+    db._pool, db._backend = None, None
+    for name, value in saved.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+    if server is not None:
+        server.cleanup()
+
+
+@pytest.fixture
+def postgres_conn(postgres_dsn):
+    import psycopg2
+
+    conn = psycopg2.connect(postgres_dsn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def writable_conn(postgres_dsn, tables, monkeypatch):
+    # A database of its own for tests that write to it; database.py is pointed at it for the test
+    import psycopg2
+
+    import database as db
+
+    admin_conn = psycopg2.connect(postgres_dsn)
+    admin_conn.autocommit = True
+    admin_conn.cursor().execute("DROP DATABASE IF EXISTS laundris_writable")
+    admin_conn.cursor().execute("CREATE DATABASE laundris_writable")
+
+    params = psycopg2.extensions.parse_dsn(postgres_dsn)
+    params["dbname"] = "laundris_writable"
+    conn = psycopg2.connect(**params)
+    synthetic_data.load_into_postgres(tables, conn)
+
+    monkeypatch.setenv("LAUNDRIS_DB_NAME", "laundris_writable")
+    saved_pool, db._pool = db._pool, None
+    yield conn
+
+    conn.close()
+    if db._pool is not None:
+        db._pool.close()
+    db._pool = saved_pool
+    admin_conn.cursor().execute("DROP DATABASE laundris_writable")
+    admin_conn.close()
@@ -0,0 +1,51 @@
+import http.client
+import threading
+
+import pytest
+
+import api
+
+
+@pytest.mark.parametrize("host", ["", "0.0.0.0", "10.1.2.3", "::"])
+def test_other_interfaces_need_a_token(host):
+    with pytest.raises(ValueError):
+        api.check_bind(host, None)
+    api.check_bind(host, "secret")
+
+
+@pytest.mark.parametrize("host", ["127.0.0.1", "localhost", "::1"])
+def test_localhost_needs_no_token(host):
+    api.check_bind(host, None)
+
+
+def test_start_server_defaults_to_localhost(monkeypatch):
+    monkeypatch.setattr(api, "_server", None)
+    server = api.start_server(port=0)
+    try:
+        assert server.server_address[0] == "127.0.0.1"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_token_is_required_on_every_endpoint_but_health():
+    server = api.make_server("127.0.0.1", 0, "secret")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn = http.client.HTTPConnection(*server.server_address[:2], timeout=10)
+
+    def get(path, headers=None):
+        conn.request("GET", path, headers=headers or {})
+        response = conn.getresponse()
+        response.read()
+        return response.status, response.getheader("WWW-Authenticate")
+
+    try:
+        assert get("/health") == (200, None)
+        assert get("/customers")[0] == 401
+        assert get("/customers", {"Authorization": "Bearer wrong"})[0] == 401
+        assert get("/customers/1/depletion", {"Authorization": "Basic secret"}) == (401, 'Bearer realm="laundris"')
+        assert get("/nothing", {"Authorization": "Bearer secret"})[0] == 404
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,42 @@
+import datetime
+import itertools
+
+import pytest
+
+import batch_scoring
+import database as db
+
+
+@pytest.mark.parametrize("workers, db_connections, n_customers, layout", [
+    (4, 8, 100, (4, 2)),
+    (4, 7, 100, (4, 1)),
+    (8, 3, 100, (3, 1)),
+    (4, 8, 2, (2, 4)),
+    (4, 8, 0, (1, 8)),
+    (1, 1, 1, (1, 1)),
+])
+def test_pool_layout(workers, db_connections, n_customers, layout):
+    assert batch_scoring.pool_layout(workers, db_connections, n_customers) == layout
+
+
+def test_pool_layout_stays_within_the_connection_budget():
+    for workers, db_connections, n_customers in itertools.product(range(1, 20), range(1, 20), range(0, 20)):
+        layout_workers, pool_size = batch_scoring.pool_layout(workers, db_connections, n_customers)
+        assert 1 <= layout_workers <= workers and pool_size >= 1
+        assert layout_workers * pool_size <= db_connections
+
+
+@pytest.mark.parametrize("workers, db_connections", [(0, 4), (4, 0), (-1, 4)])
+def test_pool_layout_rejects_empty_budgets(workers, db_connections):
+    with pytest.raises(ValueError):
+        batch_scoring.pool_layout(workers, db_connections, 10)
+
+
+def test_run_scores_every_customer_against_postgres(postgres_dsn, customer_ids):
+    # The parent's pool is closed while the workers hold the connection budget
+    db.get_pool()
+    summary = batch_scoring.run(customer_ids, workers=3, db_connections=4, run_date=datetime.date.today(), warm_cache=False)
+    assert not summary["failed"]
+    assert set(summary["customers"]) == set(customer_ids)
+    assert (summary["workers"], summary["pool_size"]) == (3, 1)
+    assert db._pool is None
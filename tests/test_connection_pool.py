@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from connection_pool import ConnectionPool, PoolTimeout
+
+
+@pytest.fixture
+def pool(postgres_dsn):
+    import psycopg2
+
+    pool = ConnectionPool(lambda: psycopg2.connect(postgres_dsn), minconn=2, maxconn=3, health_check_interval=0, timeout=1)
+    yield pool
+    pool.close()
+
+
+def backend_pid(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_backend_pid()")
+    return cursor.fetchone()[0]
+
+
+def test_sql_error_keeps_the_connection(pool):
+    import psycopg2
+
+    with pool.connection() as conn:
+        pid = backend_pid(conn)
+
+    with pytest.raises(psycopg2.errors.UndefinedTable):
+        with pool.connection() as conn:
+            conn.cursor().execute("SELECT * FROM no_such_table")
+
+    # The aborted transaction was rolled back, so the same session is handed out again and still works
+    with pool.connection() as conn:
+        assert backend_pid(conn) == pid
+    stats = pool.snapshot()
+    assert stats["created"] == 2 and stats["discarded"] == 0 and stats["reconnects"] == 0
+
+
+def test_closed_connection_is_discarded_and_minconn_refilled(pool):
+    with pytest.raises(RuntimeError):
+        with pool.connection() as conn:
+            conn.close()
+            raise RuntimeError("network went away")
+
+    stats = pool.snapshot()
+    assert stats["discarded"] == 1 and stats["created"] == 3
+    assert stats["size"] == pool.minconn and stats["idle"] == pool.minconn
+
+
+def test_terminated_backend_is_replaced_on_checkout(pool, postgres_conn):
+    with pool.connection() as conn:
+        pid = backend_pid(conn)
+    postgres_conn.cursor().execute("SELECT pg_terminate_backend(%s)", (pid,))
+    postgres_conn.commit()
+    time.sleep(0.1)
+
+    # health_check_interval=0, so the idle connection is checked (and replaced) before being handed out
+    with pool.connection() as conn:
+        assert backend_pid(conn) != pid
+    assert pool.snapshot()["reconnects"] == 1
+
+
+def test_checkouts_wait_for_a_free_connection(pool):
+    held = [pool.connection() for _ in range(pool.maxconn)]
+    for context in held:
+        context.__enter__()
+
+    with pytest.raises(PoolTimeout):
+        with pool.connection():
+            pass
+
+    timer = threading.Timer(0.2, held[0].__exit__, (None, None, None))
+    timer.start()
+    with pool.connection() as conn:
+        assert backend_pid(conn)
+    timer.join()
+    for context in held[1:]:
+        context.__exit__(None, None, None)
+
+    stats = pool.snapshot()
+    assert stats["checkouts"] == pool.maxconn + 1  # the timed-out attempt is not a checkout
+    assert stats["max_wait_time"] >= 0.15
+    assert stats["size"] == pool.maxconn and stats["in_use"] == 0
@@ -0,0 +1,37 @@
+import datetime
+
+import pytest
+
+import database as db
+import depletion_engine as engine
+import synthetic_data
+
+
+@pytest.fixture
+def customer_frames(tables, customer_ids):
+    customer_id = customer_ids[0]
+    frames = db.build_order_cycle_frames(synthetic_data.customer_tables(tables, customer_id), customer_id, include_exploded=False)
+    desired_quantity_df = synthetic_data.desired_quantity(tables, list(frames[1].item_type_id.unique()), customer_id)
+    return customer_id, frames[1], frames[2], desired_quantity_df
+
+
+def test_small_customer_has_every_label_column(customer_frames):
+    # Two inactive items: at most two labels, so the pivot misses at least one column
+    customer_id, order_cycle_df, inactive_status_df, desired_quantity_df = customer_frames
+    order_cycle_df = order_cycle_df[order_cycle_df.inactive_time > engine.inactive_days].head(2)
+    result = engine.compute_depletion(customer_id, order_cycle_df, inactive_status_df, desired_quantity_df, datetime.date.today())
+    assert list(result.label_heatmap.columns) == ['Lost', 'Ragout', 'Normal']
+    assert result.label_heatmap.to_numpy().sum() == 2
+
+
+@pytest.mark.parametrize("n_items", [0, 1, 50])
+def test_customer_without_active_items(customer_frames, n_items):
+    # Churned customers, or every item inactive: the active frame is empty
+    customer_id, order_cycle_df, inactive_status_df, desired_quantity_df = customer_frames
+    order_cycle_df = order_cycle_df[order_cycle_df.inactive_time > engine.inactive_days].head(n_items)
+    result = engine.compute_depletion(customer_id, order_cycle_df, inactive_status_df, desired_quantity_df, datetime.date.today())
+
+    assert result.active_items.empty and result.total_items == n_items
+    assert isinstance(result.active_items['ragout_period'].dtype, type(engine.ragout_periods([1.0], datetime.date.today()).dtype))
+    assert result.n_lost + result.n_ragout + result.n_normal == n_items
+    assert not result.par_forecast.empty or n_items == 0
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import database as db
+
+
+@pytest.fixture
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(db, "_desired_quantities", {})
+    monkeypatch.setattr(db, "_desired_quantities_state", {"version": None, "checked_at": 0.0, "generation": 0})
+
+
+def test_profile_version_changes_with_every_write(writable_conn):
+    versions = [db.fetch_profile_version(writable_conn)]
+    for sql in ["UPDATE customer_roomprofile SET item_quantity = item_quantity + 1 WHERE ctid = (SELECT min(ctid) FROM customer_roomprofile)",
+                "INSERT INTO customer_hotelprofile VALUES (-1, -1, 1)",
+                "DELETE FROM customer_hotelprofile WHERE ctid = (SELECT min(ctid) FROM customer_hotelprofile)",
+                "UPDATE customer SET par_level = par_level WHERE customer_id = (SELECT min(customer_id) FROM customer)"]:
+        writable_conn.cursor().execute(sql)
+        writable_conn.commit()
+        versions.append(db.fetch_profile_version(writable_conn))
+    assert len(set(versions)) == len(versions)
+
+    # Reads do not change it
+    assert db.fetch_profile_version(writable_conn) == versions[-1]
+
+
+def test_cached_quantities_follow_profile_writes(writable_conn, customer_ids, empty_cache, monkeypatch):
+    monkeypatch.setattr(db, "desired_quantity_check_interval", 0)
+    cached_df = db.get_desired_quantities(customer_ids)
+    assert_frame_equal(cached_df, db.fetch_desired_quantities(customer_ids, writable_conn))
+
+    writable_conn.cursor().execute("UPDATE customer SET par_level = par_level * 2")
+    writable_conn.commit()
+    updated_df = db.get_desired_quantities(customer_ids)
+    assert_frame_equal(updated_df, db.fetch_desired_quantities(customer_ids, writable_conn))
+    assert (updated_df.desired_quantity.sum() > cached_df.desired_quantity.sum())
+
+
+class SlowBackend:
+    # Takes `delay` seconds for customer 1's rows
+    def __init__(self, delay):
+        self.delay = delay
+
+    def profile_version(self):
+        return "v1"
+
+    def desired_quantities(self, customer_ids):
+        if 1 in customer_ids:
+            time.sleep(self.delay)
+        return pd.DataFrame({"customer_id": customer_ids, "item_type_id": 1, "item_type_name": "towel", "desired_quantity": 10.0})
+
+
+def test_cache_miss_does_not_block_other_sessions(empty_cache, monkeypatch):
+    monkeypatch.setattr(db, "_backend", SlowBackend(delay=1.0))
+    db.get_desired_quantities([2])
+
+    slow = threading.Thread(target=db.get_desired_quantities, args=([1],))
+    slow.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    assert db.get_desired_quantities([2]).customer_id.tolist() == [2]
+    assert time.monotonic() - start < 0.5
+    slow.join()
+    assert set(db._desired_quantities) == {1, 2}
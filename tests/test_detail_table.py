@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import detail_table
+
+
+@pytest.fixture
+def items():
+    n = 250
+    return pd.DataFrame({
+        "rfid_id": [f"E200{i:05d}" for i in range(n)],
+        "Label": np.where(np.arange(n) % 3 == 0, "lost", "normal"),
+        "item_type_name": np.where(np.arange(n) % 2 == 0, "Towel", "Sheet"),
+        "predicted_ragout_time": pd.array([None if i % 5 == 0 else i % 7 for i in range(n)], dtype="Int64"),
+    })
+
+
+@pytest.mark.parametrize("page, first, last", [(0, 0, 99), (1, 100, 199), (2, 200, 249), (3, 200, 249), (50, 200, 249)])
+def test_pages_end_at_the_last_row(items, page, first, last):
+    # 250 rows in pages of 100; a page past the end gives the last one
+    page_df, total = detail_table.query_page(items, page=page, rows=100)
+    assert total == 250
+    assert page_df.index.tolist() == list(range(first, last + 1))
+
+
+def test_exactly_full_pages(items):
+    page_df, total = detail_table.query_page(items.head(200), page=2, rows=100)
+    assert (total, detail_table.page_count(total, 100)) == (200, 2)
+    assert page_df.index.tolist() == list(range(100, 200))
+    page_df, total = detail_table.query_page(items.head(0), page=3, rows=100)
+    assert total == 0 and page_df.empty and detail_table.page_count(total, 100) == 1
+
+
+def test_search_filters_and_sort(items):
+    page_df, total = detail_table.query_page(items, search=" e200001", filters={"Label": ["lost"], "item_type_name": []},
+                                             sort_by="predicted_ragout_time", descending=True, rows=10)
+    expected = items[items.rfid_id.str.startswith("E200001") & (items.Label == "lost")]
+    assert total == expected.shape[0] == 33
+    assert set(page_df.index) <= set(expected.index) and page_df.shape[0] == 10
+    times = page_df["predicted_ragout_time"]
+    assert times.notna().all() and times.is_monotonic_decreasing
+
+    # Missing values sort last either way
+    page_df, _ = detail_table.query_page(expected, sort_by="predicted_ragout_time", page=3, rows=10)
+    assert page_df["predicted_ragout_time"].isna().all()
+
+
+def test_missing_predicted_time_is_an_empty_cell(items):
+    page_df = detail_table.format_page(items.head(6).copy(), {"predicted_ragout_time": "{} days"})
+    assert page_df["predicted_ragout_time"].tolist() == ["", "1 days", "2 days", "3 days", "4 days", ""]
+    floats = items.head(2).assign(predicted_ragout_time=[np.nan, 12.0])
+    assert detail_table.format_page(floats, {"predicted_ragout_time": "{} days"})["predicted_ragout_time"].tolist() == ["", "12.0 days"]
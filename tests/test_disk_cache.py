@@ -0,0 +1,121 @@
+import os
+import threading
+
+import pytest
+from pandas.testing import assert_frame_equal
+
+import database as db
+import disk_cache
+import synthetic_data
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "cache_dir", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def frames(tables, customer_ids):
+    customer_id = customer_ids[0]
+    return db.build_order_cycle_frames(synthetic_data.customer_tables(tables, customer_id), customer_id, include_exploded=False)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_frames_round_trip(cache_dir, frames, compact):
+    frames = db.compact_frames(frames) if compact else frames
+    key = disk_cache.fetch_data_key(1)
+    assert disk_cache.store_frames(key, db.cached_frames(frames))
+
+    loaded = disk_cache.load_frames(key, db.fetch_data_frame_names[1:])
+    # Includes the datetime.date columns, whose missing values must come back as NaT rather than None
+    assert_frame_equal(loaded["pickup_dropoff_count_df"], frames[1])
+    assert_frame_equal(loaded["inactive_status_df"], frames[2])
+
+
+def test_replacing_an_entry_never_shows_readers_a_miss(cache_dir, frames, monkeypatch):
+    key = disk_cache.fetch_data_key(1)
+    cached = db.cached_frames(frames)
+    disk_cache.store_frames(key, cached)
+
+    misses = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            if disk_cache.load_frames(key, ["pickup_dropoff_count_df"]) is None:
+                misses.append(1)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for _ in range(20):
+        disk_cache.store_frames(key, cached)
+    done.set()
+    for reader in readers:
+        reader.join()
+
+    assert not misses
+    # Replaced versions stay for the grace period, then go with the next store
+    versions = lambda: [name for name in os.listdir(disk_cache.entry_path(key)) if name.startswith("v-")]
+    assert len(versions()) == 21
+    monkeypatch.setattr(disk_cache, "superseded_grace", 0)
+    disk_cache.store_frames(key, cached)
+    assert versions() == [os.path.basename(disk_cache.current_version(disk_cache.entry_path(key)))]
+
+
+def test_reader_whose_version_is_removed_reads_the_new_one(cache_dir, frames, monkeypatch):
+    key = disk_cache.fetch_data_key(1)
+    cached = db.cached_frames(frames)
+    disk_cache.store_frames(key, cached)
+    path = disk_cache.entry_path(key)
+    old_version = disk_cache.current_version(path)
+
+    # The reader resolved the pointer, then two stores replaced and removed its version before it opened a file
+    read_version = disk_cache.read_version
+    def replaced_read(version_path, names):
+        if version_path == old_version:
+            monkeypatch.setattr(disk_cache, "superseded_grace", 0)
+            disk_cache.store_frames(key, cached)
+            disk_cache.store_frames(key, cached)
+            assert not os.path.exists(old_version)
+        return read_version(version_path, names)
+    monkeypatch.setattr(disk_cache, "read_version", replaced_read)
+
+    loaded = disk_cache.load_frames(key, db.fetch_data_frame_names[1:])
+    assert_frame_equal(loaded["pickup_dropoff_count_df"], frames[1])
+
+
+def test_evict_removes_least_recently_read_entries(cache_dir, frames):
+    cached = db.cached_frames(frames)
+    for customer_id in [1, 2, 3]:
+        disk_cache.store_frames(disk_cache.fetch_data_key(customer_id), cached)
+    os.utime(disk_cache.entry_path(disk_cache.fetch_data_key(1)), (0, 0))
+
+    entry_bytes = disk_cache.entry_size(disk_cache.entry_path(disk_cache.fetch_data_key(2)))
+    disk_cache.evict(max_bytes=2 * entry_bytes)
+    assert disk_cache.load_frames(disk_cache.fetch_data_key(1), ["pickup_dropoff_count_df"]) is None
+    assert disk_cache.load_frames(disk_cache.fetch_data_key(2), ["pickup_dropoff_count_df"]) is not None
+
+
+def test_missing_frame_is_a_miss_for_that_frame_only(cache_dir, frames):
+    key = disk_cache.fetch_data_key(1)
+    disk_cache.store_frames(key, db.cached_frames(frames))
+
+    loaded = disk_cache.load_frames(key, db.fetch_data_frame_names)
+    assert set(loaded) == {"pickup_dropoff_count_df", "inactive_status_df"}
+
+
+def test_fetch_frames_adds_the_exploded_frame_to_an_entry(postgres_dsn, cache_dir, customer_ids, monkeypatch):
+    monkeypatch.setenv("LAUNDRIS_DISK_CACHE", "1")
+    customer_id = customer_ids[0]
+    key = disk_cache.fetch_data_key(customer_id, source=db.backend_name)
+
+    frames = db.fetch_frames(customer_id)
+    assert frames[0] is None
+    frames = db.fetch_frames(customer_id, include_exploded=True)
+    assert frames[0] is not None
+
+    # The entry now holds all three frames, so both kinds of request are hits
+    assert set(disk_cache.load_frames(key, db.fetch_data_frame_names)) == set(db.fetch_data_frame_names)
+    assert db.fetch_frames(customer_id, include_exploded=True)[0] is not None
@@ -0,0 +1,50 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import figures
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = figures.FigureCache(max_entries=16)
+    monkeypatch.setattr(figures, "_cache", cache)
+    return cache
+
+
+def pivot(scale=1):
+    return pd.DataFrame({'Lost': [1, 2], 'Ragout': [3 * scale, 4], 'Normal': [5, 6]}, index=pd.Index(['Sheet', 'Towel'], name='item_type_name'))
+
+
+def test_equal_inputs_hit_and_changed_inputs_miss(cache):
+    labels, scale = dict(x="Category", y="Item Type"), ['#eb827f', '#FFFFFF']
+    first = figures.heatmap("label_heatmap", pivot(), labels, scale)
+    # Equal content built separately, so none of the objects is the same
+    second = figures.heatmap("label_heatmap", pivot(), dict(labels), list(scale))
+    assert cache.stats == {"hits": 1, "misses": 1}
+    assert json.loads(second.to_json()) == json.loads(first.to_json())
+
+    figures.heatmap("label_heatmap", pivot(scale=2), labels, scale)
+    figures.heatmap("label_heatmap", pivot(), labels, scale, x=['A', 'B', 'C'])
+    figures.heatmap("par_heatmap", pivot(), labels, scale)
+    assert cache.stats == {"hits": 1, "misses": 4}
+
+
+def test_object_arrays_hash_by_value():
+    months = ['January', 'February', 'March']
+    # Same values in distinct string objects, so the arrays hold different pointers
+    copies = [''.join(list(month)) for month in months]
+    assert figures.content_hash(np.array(months, dtype=object)) == figures.content_hash(np.array(copies, dtype=object))
+    assert figures.content_hash(np.array(months, dtype=object)) != figures.content_hash(np.array(months[::-1], dtype=object))
+    assert figures.content_hash(np.array([1, 'a', None], dtype=object)) == figures.content_hash(np.array([1, 'a', None], dtype=object))
+
+
+def test_callers_get_their_own_figure(cache):
+    first = figures.bar("lost_by_item_type", pd.DataFrame({'Item Type': ['Sheet'], 'Items Count': [3]}), x='Item Type', y='Items Count')
+    first.update_layout(title="changed by a caller")
+    second = figures.bar("lost_by_item_type", pd.DataFrame({'Item Type': ['Sheet'], 'Items Count': [3]}), x='Item Type', y='Items Count')
+    assert cache.stats["hits"] == 1
+    assert second.layout.title.text is None
+    assert second is not first
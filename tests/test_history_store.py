@@ -0,0 +1,56 @@
+import datetime
+import threading
+
+import pandas as pd
+
+import history_store
+
+
+def snapshot(n_item_types, par_level):
+    return pd.DataFrame({'item_type_name': [f"type {i}" for i in range(n_item_types)], 'total': 10, 'available': 8,
+                         'lost': 1, 'ragout': 1, 'desired_quantity': 10.0, 'par_level': par_level})
+
+
+def test_threads_share_one_connection(monkeypatch, tmp_path):
+    monkeypatch.setattr(history_store, "history_db", str(tmp_path / "history.sqlite"))
+    start = datetime.date(2026, 1, 1)
+    connections, errors = set(), []
+
+    def worker(customer_id):
+        try:
+            with history_store.connection() as conn:
+                connections.add(id(conn))
+            for day in range(20):
+                history_store.write_snapshot(customer_id, start + datetime.timedelta(days=day), snapshot(5, float(day)))
+                history_store.load_history(customer_id)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(customer_id,)) for customer_id in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors and len(connections) == 1
+    df = history_store.load_history(3, start, start + datetime.timedelta(days=9))
+    assert df.shape[0] == 50 and df['par_level'].max() == 9.0
+
+    # Pointed at another file, the next use opens that one
+    monkeypatch.setattr(history_store, "history_db", str(tmp_path / "other.sqlite"))
+    assert history_store.load_history(3).empty
+
+
+def test_trend_adds_the_daily_totals(monkeypatch, tmp_path):
+    monkeypatch.setattr(history_store, "history_db", str(tmp_path / "history.sqlite"))
+    start = datetime.date(2026, 1, 1)
+    assert history_store.trend(1, start).empty
+    for day in range(3):
+        history_store.write_snapshot(1, start + datetime.timedelta(days=day), snapshot(2, 80.0).assign(available=[8, 2 * day]))
+    history_store.write_snapshot(2, start, snapshot(2, 80.0))
+
+    df = history_store.trend(1, start + datetime.timedelta(days=1))
+    totals = df[df['item_type_name'] == history_store.all_item_types]
+    assert df.shape[0] == 6 and set(df['customer_id']) == {1}
+    assert totals['total'].tolist() == [20, 20] and totals['available'].tolist() == [10, 12]
+    assert totals['par_level'].tolist() == [50.0, 60.0]
@@ -0,0 +1,88 @@
+import datetime
+
+from pandas.testing import assert_frame_equal
+
+import database as db
+import incremental
+
+
+def full_read(customer_id):
+    return db.compact_frames(db.read_customer_frames(customer_id))
+
+
+def assert_same_frames(frames, expected_frames):
+    for df, expected_df in zip(db.compact_frames(frames)[1:], expected_frames[1:]):
+        assert_frame_equal(df.reset_index(drop=True), expected_df.reset_index(drop=True))
+
+
+def test_delta_refresh_matches_full_read(writable_conn, tables, customer_ids):
+    # An open order picked up with an active RFID; the test customer is that RFID's customer
+    rfid_df, bins_df, orders_df = tables["rfid"], tables["order_binrfids_rfids"], tables["order_order"]
+    active_rfid_df = rfid_df[rfid_df.status == 'active']
+    pickup_df = tables["order_order_pickup_bins"].merge(bins_df, on='binrfids_id').merge(active_rfid_df[['rfid_id', 'customer_id']], on='rfid_id')
+    pickup_df = pickup_df[pickup_df.order_id.isin(orders_df.loc[orders_df.actual_dropoff_date.isnull(), 'id'])]
+    open_order_id, open_order_rfid, customer_id = int(pickup_df.order_id.iloc[0]), pickup_df.rfid_id.iloc[0], int(pickup_df.customer_id.iloc[0])
+
+    other_customer_id = next(other_id for other_id in customer_ids if other_id != customer_id)
+    customer_rfids = active_rfid_df.loc[(active_rfid_df.customer_id == customer_id) & (active_rfid_df.rfid_id != open_order_rfid), 'rfid_id'].tolist()
+    other_rfid = active_rfid_df.loc[active_rfid_df.customer_id == other_customer_id, 'rfid_id'].iloc[0]
+    deactivated_rfid, new_bin_rfid, deleted_rfid, moved_out_rfid = customer_rfids[:4]
+
+    snapshot = incremental.CustomerSnapshot(customer_id)
+    assert_same_frames(snapshot.refresh(), full_read(customer_id))
+
+    new_bin_id, new_order_id = int(bins_df.binrfids_id.max()) + 1, int(orders_df.id.max()) + 1
+    with writable_conn.cursor() as cursor:
+        cursor.execute("UPDATE rfid SET status = 'inactive', last_updated_date = now() WHERE rfid_id = %s", (deactivated_rfid,))
+        cursor.execute("INSERT INTO order_order VALUES (%s, %s, now(), NULL, 12.5)", (new_order_id, customer_id))
+        cursor.execute("INSERT INTO order_binrfids_rfids VALUES (%s, %s)", (new_bin_id, new_bin_rfid))
+        cursor.execute("INSERT INTO order_order_pickup_bins VALUES (%s, %s)", (new_bin_id, new_order_id))
+        cursor.execute("UPDATE order_order SET actual_dropoff_date = actual_pickup_date + interval '2 days' WHERE id = %s", (open_order_id,))
+        cursor.execute("DELETE FROM rfid WHERE rfid_id = %s", (deleted_rfid,))
+        cursor.execute("UPDATE rfid SET customer_id = %s WHERE rfid_id = %s", (other_customer_id, moved_out_rfid))
+        cursor.execute("UPDATE rfid SET customer_id = %s WHERE rfid_id = %s", (customer_id, other_rfid))
+    writable_conn.commit()
+
+    frames = snapshot.refresh()
+    assert_same_frames(frames, full_read(customer_id))
+    assert snapshot.stats["full_refreshes"] == 1 and snapshot.stats["delta_refreshes"] == 1
+    assert snapshot.stats["last_removed_rfids"] == 2
+    assert {new_bin_rfid, other_rfid, open_order_rfid} <= set(frames[1].rfid_id)
+    assert not {deactivated_rfid, deleted_rfid, moved_out_rfid} & set(frames[1].rfid_id)
+    # Only the changed RFIDs (and those in the closed order's bins) are re-read
+    assert snapshot.stats["last_affected_rfids"] < len(customer_rfids) / 10
+
+    # The closed order left the open set; the new one joined it
+    assert open_order_id not in set(snapshot.open_orders_df.order_id)
+    assert new_order_id in set(snapshot.open_orders_df.order_id)
+
+    # Nothing changed since: only the RFIDs at the rfid watermark are read again
+    assert_same_frames(snapshot.refresh(), full_read(customer_id))
+    assert snapshot.stats["last_affected_rfids"] <= 1
+
+
+def test_new_day_ages_unchanged_rows(writable_conn, customer_ids):
+    snapshot = incremental.CustomerSnapshot(customer_ids[0])
+    frames = snapshot.refresh()
+    snapshot.finalized_on -= datetime.timedelta(days=1)
+    snapshot.frames = tuple(df.assign(inactive_time=0) for df in snapshot.frames)
+
+    aged_frames = snapshot.refresh()
+    assert_frame_equal(aged_frames[1].reset_index(drop=True), frames[1].reset_index(drop=True))
+
+
+def test_new_process_applies_deltas_to_the_snapshot_on_disk(writable_conn, tables, customer_ids, monkeypatch):
+    monkeypatch.setenv("LAUNDRIS_DISK_CACHE", "1")
+    customer_id = customer_ids[2]
+    incremental.CustomerSnapshot(customer_id).refresh()
+
+    rfid_df = tables["rfid"]
+    changed_rfid = rfid_df.loc[(rfid_df.customer_id == customer_id) & (rfid_df.status == 'active'), 'rfid_id'].iloc[0]
+    with writable_conn.cursor() as cursor:
+        cursor.execute("UPDATE rfid SET total_washes = total_washes + 1, last_updated_date = now() WHERE rfid_id = %s", (changed_rfid,))
+    writable_conn.commit()
+
+    # Another process: no snapshot in memory, and the disk copy is older than the change
+    snapshot = incremental.CustomerSnapshot(customer_id)
+    assert_same_frames(snapshot.refresh(), full_read(customer_id))
+    assert snapshot.stats["disk_loads"] == 1 and snapshot.stats["full_refreshes"] == 0 and snapshot.stats["delta_refreshes"] == 1
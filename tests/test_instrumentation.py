@@ -0,0 +1,63 @@
+import threading
+import tracemalloc
+import urllib.request
+
+import pytest
+
+import instrumentation
+
+
+@pytest.fixture
+def trace_memory(monkeypatch):
+    monkeypatch.setattr(instrumentation, "trace_memory", True)
+    yield
+    tracemalloc.stop()
+
+
+def test_span_records_its_peak_on_one_thread(trace_memory):
+    with instrumentation.span("outer") as outer:
+        with instrumentation.span("inner") as inner:
+            data = bytes(4 * 1024 * 1024)
+            del data
+
+    assert inner.peak_bytes >= 4 * 1024 * 1024
+    assert outer.peak_bytes >= inner.peak_bytes
+
+
+def test_spans_overlapping_another_thread_record_no_peak(trace_memory):
+    started, done = threading.Event(), threading.Event()
+    spans = {}
+
+    def worker():
+        with instrumentation.span("worker") as spans["worker"]:
+            started.set()
+            done.wait(5)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    started.wait(5)
+    with instrumentation.span("main") as spans["main"]:
+        data = bytes(1024 * 1024)
+        del data
+    done.set()
+    thread.join()
+
+    # Both spans saw the other's reset_peak, so neither peak means anything
+    assert spans["main"].peak_bytes is None and spans["worker"].peak_bytes is None
+
+    with instrumentation.span("alone") as alone:
+        pass
+    assert alone.peak_bytes is not None
+
+
+def test_metrics_server_binds_localhost(monkeypatch):
+    monkeypatch.setattr(instrumentation, "_server", None)
+    server = instrumentation.start_metrics_server(port=0)
+    try:
+        host, port = server.server_address
+        assert host == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert b"laundris_process_resident_bytes" in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
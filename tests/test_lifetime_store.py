@@ -0,0 +1,131 @@
+import datetime
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lifetime_store
+from lifetime_store import LifetimeStore
+
+
+@pytest.fixture
+def unseeded(monkeypatch, tmp_path):
+    monkeypatch.setattr(lifetime_store, "seed_csv", str(tmp_path / "missing.csv"))
+    return str(tmp_path / "lifetime.sqlite")
+
+
+def events(customer_id, rfid_ids, lifetimes, item_type_id=7):
+    return pd.DataFrame({"customer_id": customer_id, "rfid_id": [str(rfid_id) for rfid_id in rfid_ids],
+                         "item_type_id": item_type_id, "lifetime": np.asarray(lifetimes, dtype=float)})
+
+
+def test_processes_sharing_the_file_keep_each_others_events(unseeded):
+    # Two stores stand for two processes: each folds its own events, neither drops the other's
+    first, second = LifetimeStore(unseeded), LifetimeStore(unseeded)
+    first.load(), second.load()
+    with first.transaction() as conn:
+        assert first.add_rows(conn, events(1, range(0, 50), np.arange(50) + 100.5)) == 50
+    with second.transaction() as conn:
+        assert second.add_rows(conn, events(1, range(50, 100), np.arange(50, 100) + 100.5)) == 50
+    # Already counted by the other process
+    with first.transaction() as conn:
+        assert first.add_rows(conn, events(1, range(40, 60), np.zeros(20))) == 0
+
+    lifetimes = pd.Series(np.arange(100) + 100.5)
+    row = first.read("SELECT count, total, m2, min, max, p50 FROM lifetime_stats WHERE customer_id = 1").iloc[0]
+    assert row["count"] == 100 and row["total"] == pytest.approx(lifetimes.sum())
+    assert row["m2"] == pytest.approx(((lifetimes - lifetimes.mean()) ** 2).sum())
+    assert (row["min"], row["max"]) == (lifetimes.min(), lifetimes.max())
+    assert abs(row["p50"] - lifetimes.median()) <= lifetime_store.bin_days
+
+
+def test_refresh_folds_the_backend_ragout_events_once(postgres_dsn, tables, customer_ids, unseeded):
+    store = LifetimeStore(unseeded)
+    expected = lifetime_store.lifetime_events(tables["rfid"])
+    assert store.refresh(force=True) == expected.shape[0]
+    assert store.refresh(force=True) == 0
+    # Within the interval a lookup does not start another read
+    assert float(store.state()["refreshed_at"]) > 0
+
+    customer_id = customer_ids[0]
+    lookup = store.lookup(customer_id).set_index("item_type_id")
+    grouped = expected[expected.customer_id == customer_id].groupby("item_type_id")["lifetime"]
+    assert lookup["count"].to_dict() == grouped.count().to_dict()
+    np.testing.assert_allclose(lookup["mean"].sort_index(), grouped.mean().sort_index())
+    np.testing.assert_allclose(lookup["std"].sort_index(), grouped.std().sort_index())
+
+
+class FailingBackend:
+    def read_sql(self, sql, params=None, name=None):
+        raise ConnectionError("backend down")
+
+
+class BlockingBackend:
+    def __init__(self, backend):
+        self.backend, self.release = backend, threading.Event()
+
+    def read_sql(self, sql, params=None, name=None):
+        self.release.wait(10)
+        return self.backend.read_sql(sql, params, name=name)
+
+
+def test_failed_read_is_retried_instead_of_waiting_an_interval(postgres_dsn, tables, unseeded, monkeypatch):
+    store = LifetimeStore(unseeded)
+    backend = lifetime_store.db.get_backend()
+    monkeypatch.setattr(lifetime_store.db, "get_backend", lambda: FailingBackend())
+    assert store.refresh() == 0
+    # Nothing was read, so the interval has not started
+    assert float(store.state()["refreshed_at"]) == 0 and not store.due()
+    store.retry_at = 0.0
+    assert store.due()
+
+    monkeypatch.setattr(lifetime_store.db, "get_backend", lambda: backend)
+    assert store.refresh() == lifetime_store.lifetime_events(tables["rfid"]).shape[0]
+    assert float(store.state()["refreshed_at"]) > 0 and not store.due()
+
+
+def test_lookup_does_not_wait_for_the_refresh(postgres_dsn, tables, customer_ids, unseeded, monkeypatch):
+    store = LifetimeStore(unseeded)
+    blocking = BlockingBackend(lifetime_store.db.get_backend())
+    monkeypatch.setattr(lifetime_store.db, "get_backend", lambda: blocking)
+    try:
+        assert store.lookup(customer_ids[0]).empty
+        thread = store.refresh_thread
+        assert thread.is_alive()
+        # The running refresh is not started twice
+        assert store.refresh_in_background() is None
+    finally:
+        blocking.release.set()
+    thread.join(30)
+    assert not store.lookup(customer_ids[0]).empty and store.refresh_thread is thread
+
+
+def test_seed_watermark_comes_from_the_export(tmp_path):
+    export = pd.DataFrame({"item_type_id": [7, 7], "customer_id": [1, 1], "lifetime": [100.0, 200.0]})
+    export.to_csv(tmp_path / "undated.csv", index=False)
+    export.assign(last_updated_date=["2024-02-27 10:00:00+00:00", "2024-02-28 09:30:00+00:00"]).to_csv(tmp_path / "dated.csv", index=False)
+    store = LifetimeStore(str(tmp_path / "lifetime.sqlite"))
+
+    with pytest.raises(ValueError):
+        store.seed(str(tmp_path / "undated.csv"))
+    store.seed(str(tmp_path / "undated.csv"), datetime.date(2024, 3, 1))
+    assert pd.Timestamp(store.state()["watermark"]) == pd.Timestamp("2024-03-01", tz="UTC")
+    store.seed(str(tmp_path / "dated.csv"))
+    assert pd.Timestamp(store.state()["watermark"]) == pd.Timestamp("2024-02-28 09:30", tz="UTC")
+    assert store.size() == 1
+
+
+def test_undated_export_is_not_seeded_on_first_use(tmp_path, monkeypatch):
+    pd.DataFrame({"item_type_id": [7], "customer_id": [1], "lifetime": [100.0]}).to_csv(tmp_path / "undated.csv", index=False)
+    monkeypatch.setattr(lifetime_store, "seed_csv", str(tmp_path / "undated.csv"))
+    monkeypatch.setattr(lifetime_store, "seed_as_of", None)
+    store = LifetimeStore(str(tmp_path / "lifetime.sqlite"))
+    store.load()
+    assert store.size() == 0
+    assert pd.Timestamp(store.state()["watermark"]) == pd.Timestamp(lifetime_store.epoch)
+
+    monkeypatch.setattr(lifetime_store, "seed_as_of", "2024-03-01")
+    dated = LifetimeStore(str(tmp_path / "dated.sqlite"))
+    dated.load()
+    assert dated.size() == 1
@@ -0,0 +1,23 @@
+import pickle
+import threading
+import tracemalloc
+
+from model_registry import ModelRegistry
+
+
+def test_concurrent_loads_report_their_own_peak(tmp_path):
+    # Each artifact unpickles into about 8 MB; without the shared lock one load's tracemalloc.stop() cut off the others
+    with open(tmp_path / "artifact.pkl", "wb") as f:
+        pickle.dump([bytes(1024) for _ in range(8192)], f)
+    specs = {"artifact": ("artifact.pkl", True, [])}
+
+    registries = [ModelRegistry(specs, str(tmp_path)) for _ in range(8)]
+    threads = [threading.Thread(target=registry.load, args=("artifact",)) for registry in registries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for registry in registries:
+        assert registry.info["artifact"]["load_peak_bytes"] >= 8 * 1024 * 1024
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,394 @@
+import datetime
+import math
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import database as db
+import depletion_engine as engine
+import embedded_backend
+import prediction_model as ml
+import synthetic_data
+from model_registry import get_registry, ragout_features
+
+
+# Each optimized path against the code it replaced. The reference_* functions are the original implementations
+# (fetch_data's pandas joins over whole tables, the groupby/apply summary, the row-wise features), kept here verbatim
+# apart from reading their inputs from the synthetic tables instead of the database.
+
+
+def full_tables(tables, customer_id):
+    # What the original fetch_data read: the customer's rfid rows and every row of the other tables
+    rfid_df = tables["rfid"]
+    return {
+        "rfid": rfid_df[rfid_df.customer_id == customer_id].drop(columns="customer_id").reset_index(drop=True),
+        "order_binrfids_rfids": tables["order_binrfids_rfids"],
+        "order_order_pickup_bins": tables["order_order_pickup_bins"],
+        "order_order_dropoff_bins": tables["order_order_dropoff_bins"],
+        "item_type": tables["customer_customerinventoryitemtype"][["id", "customer_item_type_name"]]
+            .rename(columns={"id": "item_type_id", "customer_item_type_name": "item_type_name"}),
+        "location": tables["inventory_location"].rename(columns={"id": "last_seen_location_id", "name": "last_seen_location_name",
+                                                                 "customer_id": "location_customer_id"}),
+        "order": tables["order_order"][["id", "actual_pickup_date", "actual_dropoff_date", "incoming_total_weight"]].rename(columns={"id": "order_id"}),
+    }
+
+
+def reference_summary(df):
+    # The original per-RFID summary: counts, last operation of the last row, latest pickup and dropoff via groupby.apply
+    pickup_count_df = df.groupby('rfid_id')['pickup_order_id'].count().reset_index(name='pickup_count')
+    dropoff_count_df = df.groupby('rfid_id')['dropoff_order_id'].count().reset_index(name='dropoff_count')
+    summary_df = pd.merge(pickup_count_df, dropoff_count_df, on='rfid_id')
+
+    df = df.copy()
+    df['last_operation'] = 'pickup'
+    df.loc[df['pickup_order_id'].isnull(), 'last_operation'] = 'dropoff'
+    df.loc[df['pickup_order_id'].isnull() & df['dropoff_order_id'].isnull(), 'last_operation'] = 'No order cycle'
+
+    last_pickup_date = df[['rfid_id', 'last_pickup_date', 'pickup_order_id']].groupby('rfid_id').apply(lambda x: x.sort_values('last_pickup_date', ascending=False).iloc[0]).reset_index(drop=True)
+    last_dropoff_date = df[['rfid_id', 'last_dropoff_date']].groupby('rfid_id').apply(lambda x: x.sort_values('last_dropoff_date', ascending=False).iloc[0]).reset_index(drop=True)
+    last_operation_df = df.groupby('rfid_id')['last_operation'].last().reset_index()
+
+    summary_df = pd.merge(summary_df, last_operation_df, on='rfid_id', how='left')
+    summary_df = pd.merge(summary_df, last_pickup_date, on='rfid_id', how='left')
+    return pd.merge(summary_df, last_dropoff_date, on='rfid_id', how='left')
+
+
+def reference_fetch_data(tables, customer_id):
+    # The original fetch_data after its reads
+    today = pd.Timestamp(datetime.date.today(), tz='UTC')
+    rfid_df = tables["rfid"]
+
+    df = pd.merge(rfid_df, tables["order_binrfids_rfids"], on='rfid_id', how='left')
+    df = pd.merge(df, tables["order_order_pickup_bins"], on='binrfids_id', how='left')
+    df.rename(columns={"order_id": "pickup_order_id"}, inplace=True)
+    df = pd.merge(df, tables["order_order_dropoff_bins"], on='binrfids_id', how='left')
+    df.rename(columns={"order_id": "dropoff_order_id"}, inplace=True)
+
+    pickup_order_df = tables["order"].rename(columns={"order_id": "pickup_order_id", "actual_pickup_date": "last_pickup_date", "incoming_total_weight": "pickup_weight"})
+    dropoff_order_df = tables["order"].rename(columns={"order_id": "dropoff_order_id", "actual_dropoff_date": "last_dropoff_date", "incoming_total_weight": "dropoff_weight"})
+    df = pd.merge(df, pickup_order_df, on='pickup_order_id', how='left')
+    df = pd.merge(df, dropoff_order_df, on='dropoff_order_id', how='left')
+
+    summary_df = reference_summary(df)
+    pickup_dropoff_count_df = pd.merge(summary_df[['rfid_id', 'pickup_count', 'dropoff_count']], rfid_df, on='rfid_id', how='left')
+    pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, tables["item_type"], on='item_type_id', how='left')
+    pickup_dropoff_count_df['last_updated_date'] = pd.to_datetime(pickup_dropoff_count_df['last_updated_date'], format='%Y-%m-%d %H:%M:%S')
+    pickup_dropoff_count_df['inactive_time'] = (today - pickup_dropoff_count_df['last_updated_date']).dt.days
+
+    pickup_dropoff_count_df['last_seen_location_id'] = pickup_dropoff_count_df['last_seen_location_id'].fillna(pickup_dropoff_count_df['location_id'])
+    pickup_dropoff_count_df.drop(['location_id'], axis=1, inplace=True)
+    pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, tables["location"], on='last_seen_location_id', how='left')
+    pickup_dropoff_count_df['last_seen_location_name'] = pickup_dropoff_count_df['last_seen_location_name'].fillna("Not specified")
+
+    pickup_dropoff_count_df = pd.merge(pickup_dropoff_count_df, summary_df[['rfid_id', 'last_operation', 'last_pickup_date', 'pickup_order_id', 'last_dropoff_date']],
+                                       on='rfid_id', how='left')
+    pickup_dropoff_count_df['last_pickup_date'] = pickup_dropoff_count_df['last_pickup_date'].dt.date
+    pickup_dropoff_count_df['last_dropoff_date'] = pickup_dropoff_count_df['last_dropoff_date'].dt.date
+    pickup_dropoff_count_df['last_scan_date'] = pickup_dropoff_count_df['last_scan_date'].dt.date
+    pickup_dropoff_count_df.loc[pickup_dropoff_count_df.inactive_time < 0, 'inactive_time'] = 0
+
+    pickup_dropoff_count_df.loc[pickup_dropoff_count_df.location_type == 'other', 'location_type'] = None
+    pickup_dropoff_count_df.loc[pickup_dropoff_count_df.location_type == 'laundry_chute', 'location_type'] = 'Laundry Chute'
+    pickup_dropoff_count_df['location_type'] = pickup_dropoff_count_df['location_type'].fillna(pickup_dropoff_count_df['last_seen_location_name'])
+    pickup_dropoff_count_df.loc[(pickup_dropoff_count_df.location_customer_id != customer_id) & (pickup_dropoff_count_df.location_type != 'Not specified'), 'location_type'] = 'Other customer'
+    pickup_dropoff_count_df.loc[pickup_dropoff_count_df.side == 'facility', 'location_type'] = 'Facility'
+
+    pickup_dropoff_count_df = pickup_dropoff_count_df[pickup_dropoff_count_df.status == 'active']
+    inactive_status_df = pickup_dropoff_count_df[pickup_dropoff_count_df.status == 'inactive']
+    return pickup_dropoff_count_df.drop(columns=['status']), inactive_status_df
+
+
+def reference_lifetime(pickup_date, birthday):
+    return round((pickup_date - birthday).total_seconds()/3600/24, 3)
+
+
+def reference_features(df):
+    df = df.copy()
+    df["usage_period"] = df.apply(lambda x: reference_lifetime(x['last_updated_date'], x['birthday']), axis=1)
+    df['usage_period_laundris'] = df.apply(lambda x: reference_lifetime(x['last_updated_date'], x['creation_date']), axis=1)
+    return df
+
+
+def reference_item_heatmap(order_cycle_df, ragout_df, lost_df, normal_items_df, inactive_status_df, desired_quantity_df,
+                           today, months_back, months_forward):
+    # The original chained item_heatmap, one count_by/merge/fillna step per month. It was hard-wired to 2 months back
+    # and 2 forward; here the same steps run for every month of the horizon, oldest past month last as in the original
+    reference_date = pd.Timestamp(today, tz='UTC')
+    periods = engine.month_horizon(today, months_back, months_forward)
+    names = engine.month_labels(periods)
+    past_months, current_month, next_months = names[:months_back][::-1], names[months_back], names[months_back + 1:]
+
+    item_heatmap = engine.count_by(order_cycle_df, 'item_type_name', ['Item Type', 'Total Items Count'])
+    item_heatmap = item_heatmap.merge(engine.count_by(ragout_df, 'item_type_name', ['Item Type', 'Current Ragout Items']), on='Item Type', how='left')
+    item_heatmap = item_heatmap.merge(engine.count_by(lost_df, 'item_type_name', ['Item Type', 'Current Lost Items']), on='Item Type', how='left')
+
+    pickedup_items_df = normal_items_df[normal_items_df.side == 'facility']
+    item_heatmap = item_heatmap.merge(engine.count_by(pickedup_items_df, 'item_type_name', ['Item Type', 'On Facility Items Count']), on='Item Type', how='left')
+
+    current_month_df = normal_items_df[normal_items_df.ragout_period == periods[months_back]]
+    item_heatmap = item_heatmap.merge(engine.count_by(current_month_df, 'item_type_name', ['Item Type', f'Ragout on {current_month}']), on='Item Type', how='left')
+    item_heatmap = pd.merge(item_heatmap, desired_quantity_df, on='Item Type')
+
+    # previous months data: the last 60 days of ragouts count for last month, then 30 days per month; lost items
+    # cumulatively, by how long they have been missing
+    for k, month in enumerate(past_months, start=1):
+        month_end = reference_date if k == 1 else reference_date - pd.Timedelta(days=30 * k)
+        month_start = reference_date - pd.Timedelta(days=30 * (k + 1))
+        month_df = inactive_status_df[(inactive_status_df.ragout_date < month_end) & (inactive_status_df.ragout_date > month_start)]
+        item_heatmap = pd.merge(item_heatmap, engine.count_by(month_df, 'item_type_name', ['Item Type', f'{month} Ragout Items']), on='Item Type', how='left')
+        month_lost_df = lost_df[(lost_df.inactive_time - 30 * k) > 110]
+        item_heatmap = pd.merge(item_heatmap, engine.count_by(month_lost_df, 'item_type_name', ['Item Type', f'{month} Lost Items']), on='Item Type', how='left')
+
+    item_heatmap.fillna(0, inplace=True)
+
+    item_heatmap['Current Available Items'] = item_heatmap['Total Items Count'] - item_heatmap['Current Lost Items'] - item_heatmap['Current Ragout Items'] - item_heatmap[f'Ragout on {current_month}']
+    for month, older_month in zip(past_months, past_months[1:]):
+        item_heatmap[f'{month} Lost Items'] = item_heatmap[f'{month} Lost Items'] - item_heatmap[f'{older_month} Lost Items']
+    for month in past_months:
+        item_heatmap['Current Lost Items'] = item_heatmap['Current Lost Items'] - item_heatmap[f'{month} Lost Items']
+
+    available = item_heatmap['Total Items Count']
+    for month in past_months[::-1]:
+        available = available - item_heatmap[f'{month} Lost Items']
+        item_heatmap[f'Available Items ({month})'] = available
+        item_heatmap[f'{month}'] = (item_heatmap[f'Available Items ({month})'] / item_heatmap['Desired Quantity'] * 100).apply(engine.get_rounded_value)
+
+    available = item_heatmap['Current Available Items']
+    for offset, month in enumerate(next_months, start=1):
+        month_df = normal_items_df[normal_items_df.ragout_period == periods[months_back + offset]]
+        item_heatmap = item_heatmap.merge(engine.count_by(month_df, 'item_type_name', ['Item Type', f'Ragout on {month}']), on='Item Type', how='left')
+        item_heatmap.fillna(0, inplace=True)
+        available = available - item_heatmap[f'Ragout on {month}']
+        item_heatmap[f'Available on {month}'] = available
+
+    item_heatmap[f'{current_month}'] = (item_heatmap['Current Available Items'] / item_heatmap['Desired Quantity'] * 100).apply(engine.get_rounded_value)
+    for month in next_months:
+        item_heatmap[f'{month}'] = (item_heatmap[f'Available on {month}'] / item_heatmap['Desired Quantity'] * 100).apply(engine.get_rounded_value)
+
+    par_heatmap_data = item_heatmap[['Item Type'] + names]
+
+    renames = {"Current Available Items": f"Available Items ({current_month})", "Current Lost Items": f"{current_month} Lost Items",
+               "Current Ragout Items": f"{current_month} Ragout Items"}
+    for month in names:
+        renames[f"{month}"] = f"Par level ({month})"
+    for month in next_months:
+        renames.update({f"Ragout on {month}": f"{month} Ragout Items", f"Available on {month}": f"Available Items ({month})"})
+    item_heatmap = item_heatmap.drop(columns=f'Ragout on {current_month}').rename(columns=renames)
+
+    available_heatmap_data = item_heatmap[['Item Type'] + [f"Available Items ({month})" for month in names]]
+
+    # Lost items of the coming months are projected as the average of the past and current months
+    for month in next_months:
+        item_heatmap[f'{month} Lost Items'] = (sum(item_heatmap[f'{past} Lost Items'] for past in names[:months_back + 1]) / (months_back + 1)).apply(math.ceil)
+    return item_heatmap, par_heatmap_data.set_index("Item Type"), available_heatmap_data.set_index("Item Type")
+
+
+def assert_frames_equal(left, right):
+    assert_frame_equal(left.reset_index(drop=True), right.reset_index(drop=True))
+
+
+def customer_frames(tables, customer_id, compact=True):
+    frames = db.build_order_cycle_frames(synthetic_data.customer_tables(tables, customer_id), customer_id, include_exploded=False)
+    return db.compact_frames(frames) if compact else frames
+
+
+def test_customer_scoped_tables_match_full_table_pipeline(tables, customer_ids):
+    # user-001: the joins over the customer's rows give the frames the joins over whole tables gave
+    for customer_id in customer_ids:
+        expected_df, expected_inactive_df = reference_fetch_data(full_tables(tables, customer_id), customer_id)
+        _, order_cycle_df, inactive_status_df = customer_frames(tables, customer_id, compact=False)
+        assert_frames_equal(order_cycle_df, expected_df)
+        assert_frames_equal(inactive_status_df, expected_inactive_df)
+
+
+def test_customer_scoped_sql_matches_full_table_reads(postgres_conn, tables, customer_ids):
+    # user-001 against Postgres: customer_table_queries return exactly the rows of the whole tables the customer uses
+    full_sql = {name: f"SELECT * FROM {name}" for name in ["order_binrfids_rfids", "order_order_pickup_bins", "order_order_dropoff_bins"]}
+    full = {name: pd.read_sql(sql, postgres_conn) for name, sql in full_sql.items()}
+    full["order"] = pd.read_sql("SELECT id AS order_id, actual_pickup_date, actual_dropoff_date, incoming_total_weight FROM order_order", postgres_conn)
+    full["item_type"] = pd.read_sql("SELECT id AS item_type_id, customer_item_type_name AS item_type_name FROM customer_customerinventoryitemtype", postgres_conn)
+    full["location"] = pd.read_sql("SELECT id AS last_seen_location_id, name AS last_seen_location_name, location_type, customer_id as location_customer_id, side FROM inventory_location", postgres_conn)
+
+    for customer_id in customer_ids:
+        customer_tables = db.read_customer_tables(customer_id, postgres_conn)
+        expected_df, _ = reference_fetch_data(dict(full, rfid=customer_tables["rfid"]), customer_id)
+        _, order_cycle_df, _ = db.build_order_cycle_frames(customer_tables, customer_id, include_exploded=False)
+        assert_frames_equal(order_cycle_df, expected_df)
+
+
+def test_order_cycle_summary_matches_groupby_apply(tables, customer_ids):
+    # user-002
+    for customer_id in customer_ids:
+        df = db.explode_order_cycles(synthetic_data.customer_tables(tables, customer_id))
+        assert_frames_equal(db.summarize_order_cycles(df), reference_summary(df))
+
+
+def test_feature_matrix_matches_row_wise_features(tables, customer_ids):
+    # user-008: the vectorized usage periods are the row-wise ones, and the float32 matrix holds the same features
+    for customer_id in customer_ids:
+        df = customer_frames(tables, customer_id, compact=False)[1].assign(customer_id=customer_id)
+        expected_df = reference_features(df)
+        data = ml.build_feature_matrix(df)
+        assert_frame_equal(df[['usage_period', 'usage_period_laundris']], expected_df[['usage_period', 'usage_period_laundris']])
+        np.testing.assert_array_equal(data, expected_df[ragout_features].to_numpy(dtype=np.float32))
+
+
+def test_predictions_match_row_wise_pipeline(tables, customer_ids):
+    # user-008: same labels and ragout times as scaler.transform + predict on the row-wise float64 features
+    registry = get_registry()
+    for customer_id in customer_ids:
+        df = customer_frames(tables, customer_id, compact=False)[1].assign(customer_id=customer_id)
+        inactive_df, active_df = df[df.inactive_time > 90], df[df.inactive_time <= 90]
+
+        expected_df = reference_features(inactive_df)
+        data = registry.get("classification_scaler").transform(expected_df[ragout_features])
+        probabilities = registry.get("classification_model").predict_proba(data)
+        predicted_df = ml.predict_ragout_group(inactive_df.copy())
+        np.testing.assert_array_equal(predicted_df['prediction'].to_numpy(), registry.get("classification_model").predict(data))
+        expected_labels = ["{} ({:.2f}%)".format(prediction, probability*100)
+                           for prediction, probability in zip(predicted_df['prediction'], probabilities.max(axis=1))]
+        assert predicted_df['predicted_ragout'].tolist() == expected_labels
+
+        expected_df = reference_features(active_df)
+        data = registry.get("regression_scaler").transform(expected_df[ragout_features])
+        expected_time = pd.Series(registry.get("regression_model").predict(data)).apply(math.ceil).to_numpy() + 30 + 15
+        expected_time[expected_df['usage_period'].to_numpy() < 90] = 200
+        np.testing.assert_array_equal(ml.predict_ragout_time_group(active_df.copy(), 30)['predicted_ragout_time'].to_numpy(), expected_time)
+
+
+def test_compact_frames_give_identical_results(tables, customer_ids):
+    # user-016: the compact schema only changes the storage; the values, and everything computed from them, are the same
+    today = datetime.date.today()
+    for customer_id in customer_ids:
+        frames = customer_frames(tables, customer_id, compact=False)
+        compact = db.compact_frames(frames)
+        for df, compact_df in zip(frames[1:], compact[1:]):
+            assert list(df.columns) == list(compact_df.columns)
+            for column in df.columns:
+                assert df[column].astype(object).where(df[column].notna(), None).tolist() == \
+                    compact_df[column].astype(object).where(compact_df[column].notna(), None).tolist(), column
+
+        desired_quantity_df = synthetic_data.desired_quantity(tables, list(frames[1].item_type_id.unique()), customer_id)
+        result = engine.compute_depletion(customer_id, frames[1], frames[2], desired_quantity_df, today)
+        compact_result = engine.compute_depletion(customer_id, compact[1], compact[2], desired_quantity_df, today)
+        for name in ["par_forecast", "item_heatmap", "par_heatmap", "availability_heatmap", "label_heatmap"]:
+            assert_frame_equal(getattr(compact_result, name), getattr(result, name), check_dtype=False, check_categorical=False,
+                               check_index_type=False, check_column_type=False)
+        for name in ["inactive_items", "active_items", "ragout_items", "normal_items", "lost_items"]:
+            columns = ["rfid_id", "Label", "prediction", "predicted_ragout", "predicted_ragout_time"]
+            columns = [column for column in columns if column in getattr(result, name).columns]
+            assert_frame_equal(getattr(compact_result, name)[columns].reset_index(drop=True), getattr(result, name)[columns].reset_index(drop=True),
+                               check_dtype=False)
+
+
+@pytest.mark.parametrize("chunk_rows", [97, 1000, 100_000])
+def test_streamed_summary_matches_exploded_summary(tables, customer_ids, chunk_rows):
+    # user-017: the summary folded chunk by chunk (RFIDs cut across chunks) is the one built from the exploded frame
+    for customer_id in customer_ids:
+        customer_tables = synthetic_data.customer_tables(tables, customer_id)
+        expected_df = db.summarize_order_cycles(db.explode_order_cycles(customer_tables))
+        streamed_df = db.complete_order_cycle_summary(
+            db.summarize_order_cycle_chunks(synthetic_data.order_cycle_event_chunks(tables, customer_id, chunk_rows)), customer_tables["rfid"])
+        assert_frames_equal(streamed_df, expected_df)
+
+
+def test_streamed_frames_match_postgres_reads(postgres_conn, customer_ids, monkeypatch):
+    # user-017 against Postgres: the named-cursor read gives the frames of the regular reads
+    monkeypatch.setattr(db, "stream_chunk_rows", 500)
+    for customer_id in customer_ids:
+        expected = db.build_order_cycle_frames(db.read_customer_tables(customer_id, postgres_conn), customer_id, include_exploded=False)
+        streamed = db.stream_customer_frames(customer_id)
+        assert_frames_equal(streamed[1], expected[1])
+        assert_frames_equal(streamed[2], expected[2])
+
+
+def shuffled(df, seed):
+    return df.sample(frac=1, random_state=seed)
+
+
+def test_last_operation_does_not_depend_on_row_order(tables, customer_ids):
+    # user-017: the bin tables come back from the database in any order; the summary follows binrfids_id
+    for customer_id in customer_ids:
+        customer_tables = synthetic_data.customer_tables(tables, customer_id)
+        expected_df = db.summarize_order_cycles(db.explode_order_cycles(customer_tables))
+        for seed in range(3):
+            shuffled_tables = dict(customer_tables, **{name: shuffled(customer_tables[name], seed) for name in
+                                                       ["order_binrfids_rfids", "order_order_pickup_bins", "order_order_dropoff_bins"]})
+            assert_frames_equal(db.summarize_order_cycles(db.explode_order_cycles(shuffled_tables)), expected_df)
+
+
+def test_streamed_frames_match_unordered_postgres_tables(writable_conn, customer_ids, monkeypatch):
+    # user-017: with the bin links stored in random physical order, the regular reads return them unordered,
+    # while the named cursor orders them on the server; both give the same frames
+    monkeypatch.setattr(db, "stream_chunk_rows", 500)
+    with writable_conn.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE links AS SELECT * FROM order_binrfids_rfids ORDER BY random()")
+        cursor.execute("TRUNCATE order_binrfids_rfids")
+        cursor.execute("INSERT INTO order_binrfids_rfids SELECT * FROM links")
+    writable_conn.commit()
+
+    for customer_id in customer_ids:
+        tables = db.read_customer_tables(customer_id, writable_conn)
+        assert not tables["order_binrfids_rfids"]["binrfids_id"].is_monotonic_increasing
+        expected = db.build_order_cycle_frames(tables, customer_id, include_exploded=False)
+        streamed = db.stream_customer_frames(customer_id)
+        assert_frames_equal(streamed[1], expected[1])
+
+
+@pytest.fixture(scope="module")
+def snapshot_path(tables):
+    with tempfile.TemporaryDirectory(prefix="laundris-snapshot-") as path:
+        embedded_backend.write_snapshot(tables, path)
+        yield path
+
+
+@pytest.mark.parametrize("engine_name", ["duckdb", "sqlite"])
+def test_embedded_backends_match_pandas_pipeline(tables, customer_ids, snapshot_path, engine_name):
+    # user-018: the engine's joins and summary give the frames of the pandas pipeline
+    if engine_name == "duckdb":
+        pytest.importorskip("duckdb")
+    backend = embedded_backend.EmbeddedBackend(engine_name, snapshot_path)
+    for customer_id in customer_ids:
+        expected = customer_frames(tables, customer_id)
+        frames = db.compact_frames(backend.customer_frames(customer_id))
+        assert_frames_equal(frames[1], expected[1])
+        assert_frames_equal(frames[2], expected[2])
+        desired_quantity_df = backend.desired_quantities([customer_id])
+        expected_df = synthetic_data.desired_quantity(tables, list(desired_quantity_df.item_type_id), customer_id)
+        got_df = desired_quantity_df.groupby("item_type_name")["desired_quantity"].sum()
+        np.testing.assert_allclose(got_df.loc[expected_df["Item Type"]].to_numpy(), expected_df["Desired Quantity"].to_numpy())
+
+
+def ragout_history(order_cycle_df, today, seed=0):
+    # Items in ragout status over the last 400 days (the synthetic customers have none); a few ragout dates lie ahead of today
+    rng = np.random.default_rng(seed)
+    df = order_cycle_df.sample(frac=0.2, random_state=seed).reset_index(drop=True)
+    seconds_ago = rng.integers(-10 * 86400, 400 * 86400, df.shape[0])
+    return df.assign(status='ragout', ragout_date=pd.Timestamp(today, tz='UTC') - pd.to_timedelta(seconds_ago, unit='s'))
+
+
+@pytest.mark.parametrize("months_back, months_forward", [(0, 0), (2, 2), (0, 12), (12, 0), (12, 12), (1, 3)])
+@pytest.mark.parametrize("today", [datetime.date.today(), datetime.date(datetime.date.today().year - 1, 12, 30)])
+@pytest.mark.parametrize("with_ragout_history", [False, True])
+def test_par_level_forecast_matches_chained_month_steps(tables, customer_ids, months_back, months_forward, today, with_ragout_history):
+    # user-013: one groupby over (item type, kind, month) events gives the tables of the per-month merges
+    customer_id = customer_ids[0]
+    frames = list(customer_frames(tables, customer_id))
+    if with_ragout_history:
+        frames[2] = ragout_history(frames[1], today)
+    desired_quantity_df = synthetic_data.desired_quantity(tables, list(frames[1].item_type_id.unique()), customer_id)
+    result = engine.compute_depletion(customer_id, frames[1], frames[2], desired_quantity_df, today, months_back, months_forward)
+    assert len(result.interval_names) == months_back + months_forward + 1
+
+    columns = ['rfid_id', 'item_type_name', 'side', 'last_operation', 'ragout_period', 'ragout_month', 'predicted_ragout_time']
+    normal_items_df = pd.concat([result.normal_items[columns], result.active_items[columns]])
+    item_heatmap, par_heatmap, availability_heatmap = reference_item_heatmap(
+        frames[1], result.ragout_items, result.lost_items, normal_items_df, frames[2], desired_quantity_df, today, months_back, months_forward)
+
+    assert sorted(item_heatmap.columns) == sorted(result.item_heatmap.columns)
+    assert_frame_equal(result.item_heatmap, item_heatmap[result.item_heatmap.columns], check_dtype=False)
+    assert_frame_equal(result.par_heatmap, par_heatmap, check_dtype=False)
+    assert_frame_equal(result.availability_heatmap, availability_heatmap, check_dtype=False)
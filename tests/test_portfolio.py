@@ -0,0 +1,31 @@
+import datetime
+
+from pandas.testing import assert_frame_equal
+
+import batch_scoring
+import portfolio
+import results_store
+
+
+def test_stored_portfolio_reads_the_batch_run_only(postgres_dsn, customer_ids, monkeypatch, tmp_path):
+    # The spawned workers read the results directory from the environment
+    monkeypatch.setenv("LAUNDRIS_RESULTS_DIR", str(tmp_path))
+    monkeypatch.setattr(results_store, "results_dir", str(tmp_path))
+    run_date = datetime.date.today() - datetime.timedelta(days=1)
+    scored = customer_ids[:2]
+    summary = batch_scoring.run(scored, workers=2, db_connections=2, run_date=run_date, warm_cache=False)
+    assert not summary["failed"]
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("stored_portfolio started a worker pool")
+    monkeypatch.setattr(batch_scoring, "map_customers", no_pool)
+
+    fleet_df, par_df, missing, latest = portfolio.stored_portfolio(customer_ids)
+    assert latest == run_date
+    assert missing == customer_ids[2:]
+    assert set(fleet_df['Customer ID']) == set(scored) and set(fleet_df['Source']) == {'batch'}
+    assert set(par_df['customer_id']) == set(scored)
+
+    # The same rows compute_portfolio builds from the stored results
+    expected_df, _, _ = portfolio.compute_portfolio(scored, run_date=run_date)
+    assert_frame_equal(fleet_df.drop(columns='Customer'), expected_df.drop(columns='Customer'))
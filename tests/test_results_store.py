@@ -0,0 +1,55 @@
+import datetime
+import threading
+
+import pytest
+from pandas.testing import assert_frame_equal
+
+import database as db
+import depletion_engine as engine
+import results_store
+import synthetic_data
+
+
+@pytest.fixture
+def result(tables, customer_ids):
+    customer_id = customer_ids[0]
+    frames = db.build_order_cycle_frames(synthetic_data.customer_tables(tables, customer_id), customer_id, include_exploded=False)
+    desired_quantity_df = synthetic_data.desired_quantity(tables, list(frames[1].item_type_id.unique()), customer_id)
+    return engine.compute_depletion(customer_id, frames[1], frames[2], desired_quantity_df, datetime.date.today())
+
+
+def test_readers_never_miss_an_entry_while_it_is_stored(result, monkeypatch, tmp_path):
+    monkeypatch.setattr(results_store, "results_dir", str(tmp_path))
+    run_date = result.today
+    results_store.store_results(result.customer_id, result, {"items": result.total_items}, run_date)
+
+    misses, errors = [], []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            try:
+                if results_store.load_results(result.customer_id, run_date) is None:
+                    misses.append(1)
+            except Exception as e:
+                errors.append(e)
+
+    def store():
+        for _ in range(40):
+            results_store.store_results(result.customer_id, result, {"items": result.total_items}, run_date)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    # Two runs storing the same customer at once
+    writers = [threading.Thread(target=store) for _ in range(2)]
+    for thread in readers + writers:
+        thread.start()
+    for writer in writers:
+        writer.join()
+    done.set()
+    for reader in readers:
+        reader.join()
+
+    assert not misses and not errors
+    items_df, par_df, meta = results_store.load_results(result.customer_id)
+    assert meta["items"] == result.total_items
+    assert_frame_equal(par_df, results_store.par_level_table(result))